@@ -8,3 +8,7 @@ find /tmp/uncurl -maxdepth 1 -mtime +30 -type d '!' -exec test -e "{}/sc_analysi
 
 # delete all test upload files
 ls -d /tmp/uncurl/*-yjz-test-upload | xargs rm -rf
+
+# remove the shared arrays of deleted datasets, and keep the array store under
+# ARRAY_STORE_MAX_BYTES (see uncurl_app/array_store.py)
+python -m uncurl_app.array_store
@@ -11,7 +11,8 @@ setup(
     url='https://github.com/yjzhang/uncurl_app',
     license='MIT',
     scripts = [
-            'uncurl_app_split_seq'
+            'uncurl_app_split_seq',
+            'uncurl_app_precompute'
     ],
     install_requires=install_requires,
     packages=find_packages("."),
@@ -0,0 +1,81 @@
+# Local stand-in for the Enrichr API, for testing the Enrichr client, its
+# caching and its timeout handling offline.
+#
+# To run: python test/fake_enrichr.py --port 5001
+# and set ENRICHR_URL to http://localhost:5001 in the app config (or in the
+# environment).
+
+import argparse
+import hashlib
+import json
+import time
+
+from flask import Flask, request
+
+
+def fake_results(genes, gene_set, n=20):
+    """
+    Returns deterministic Enrichr-style results for a gene list and gene set
+    library.
+    """
+    results = []
+    for i in range(n):
+        h = hashlib.sha1(json.dumps([genes, gene_set, i]).encode()).hexdigest()
+        pval = (i + 1)*1e-4
+        results.append([i + 1, '{0} term {1}'.format(gene_set, h[:8]), pval,
+            -float(int(h[:4], 16) % 100)/10, float(n - i), genes[:3],
+            pval*n, 0, 0])
+    return results
+
+
+def create_fake_enrichr_app(delay=0, libraries=None):
+    """
+    Returns a Flask app implementing the Enrichr addList and enrich
+    endpoints.
+
+    Args:
+        delay (float): seconds to wait before each response, for testing
+            timeouts.
+        libraries (list or None): gene set libraries that can be queried.
+            If None, all libraries can be queried.
+
+    The app's 'requests' attribute counts the requests to each endpoint.
+    """
+    app = Flask(__name__)
+    app.config['DELAY'] = delay
+    lists = {}
+    app.requests = {'addList': 0, 'enrich': 0}
+
+    @app.route('/addList', methods=['POST'])
+    def add_list():
+        app.requests['addList'] += 1
+        time.sleep(app.config['DELAY'])
+        genes = [x.strip() for x in request.form['list'].split('\n') if x.strip()]
+        user_list_id = len(lists) + 1
+        lists[user_list_id] = genes
+        return json.dumps({'userListId': user_list_id,
+            'shortId': hashlib.sha1(str(user_list_id).encode()).hexdigest()[:8]})
+
+    @app.route('/enrich')
+    def enrich():
+        app.requests['enrich'] += 1
+        time.sleep(app.config['DELAY'])
+        user_list_id = int(request.args['userListId'])
+        gene_set = request.args['backgroundType']
+        if user_list_id not in lists:
+            return json.dumps({'error': 'unknown user list id'}), 404
+        if libraries is not None and gene_set not in libraries:
+            return json.dumps({'error': 'unknown library'}), 404
+        return json.dumps({gene_set: fake_results(lists[user_list_id], gene_set)})
+
+    app.lists = lists
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Enrichr API.')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--delay', type=float, default=0,
+            help='seconds to wait before each response')
+    args = parser.parse_args()
+    create_fake_enrichr_app(delay=args.delay).run(port=args.port)
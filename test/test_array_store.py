@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+from scipy import sparse
+
+from uncurl_app import array_store
+
+
+class ArrayStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.dir, 'store')
+        self.path = os.path.join(self.dir, 'dataset')
+        os.makedirs(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_dense_and_sparse(self):
+        dense = np.random.rand(20, 10)
+        handle = array_store.put(self.store_dir, self.path, 'v1', 'dense', dense)
+        loaded = array_store.load(handle)
+        np.testing.assert_array_equal(loaded, dense)
+        self.assertFalse(loaded.flags.writeable)
+        for fmt in ['csr', 'csc', 'coo']:
+            matrix = sparse.random(20, 10, density=0.2, format=fmt)
+            handle = array_store.put(self.store_dir, self.path, 'v1', fmt, matrix)
+            loaded = handle.load()
+            self.assertTrue(sparse.issparse(loaded))
+            np.testing.assert_array_equal(loaded.toarray(), matrix.toarray())
+        objects = np.array(['a', None, 1], dtype=object)
+        handle = array_store.put(self.store_dir, self.path, 'v1', 'objects', objects)
+        self.assertEqual(list(handle.load()), ['a', None, 1])
+        # handles are found again by name
+        handle = array_store.get(self.store_dir, self.path, 'v1', 'csc')
+        self.assertEqual(handle.format, 'csc')
+        self.assertEqual(handle.shape, (20, 10))
+        self.assertIsNone(array_store.get(self.store_dir, self.path, 'v1', 'missing'))
+
+    def test_get_or_put(self):
+        calls = []
+        def func():
+            calls.append(1)
+            return np.arange(5)
+        handle = array_store.get_or_put(self.store_dir, self.path, 'v1', 'a', func)
+        handle = array_store.get_or_put(self.store_dir, self.path, 'v1', 'a', func)
+        np.testing.assert_array_equal(handle.load(), np.arange(5))
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(array_store.get_or_put(self.store_dir, self.path, 'v1',
+            'none', lambda: None))
+
+    def test_old_versions_removed(self):
+        old = array_store.put(self.store_dir, self.path, 'v1', 'a', np.arange(5))
+        new = array_store.put(self.store_dir, self.path, 'v2', 'a', np.arange(6))
+        self.assertFalse(old.exists())
+        self.assertTrue(new.exists())
+        self.assertFalse(array_store.all_exist((new, old)))
+        self.assertTrue(array_store.all_exist((new, None, 1)))
+        array_store.remove_dataset(self.store_dir, self.path)
+        self.assertFalse(new.exists())
+
+    def test_sweep_deleted_datasets(self):
+        other = os.path.join(self.dir, 'other')
+        os.makedirs(other)
+        handle = array_store.put(self.store_dir, self.path, 'v1', 'a', np.arange(5))
+        other_handle = array_store.put(self.store_dir, other, 'v1', 'a', np.arange(5))
+        shutil.rmtree(other)
+        array_store.sweep(self.store_dir)
+        self.assertTrue(handle.exists())
+        self.assertFalse(other_handle.exists())
+        self.assertEqual(len(os.listdir(self.store_dir)), 2)
+
+    def test_sweep_max_bytes(self):
+        paths = [os.path.join(self.dir, str(i)) for i in range(3)]
+        handles = []
+        for path in paths:
+            os.makedirs(path)
+            handles.append(array_store.get_or_put(self.store_dir, path, 'v1', 'a',
+                lambda: np.zeros(1000), max_bytes=30000))
+            time.sleep(0.05)
+        self.assertTrue(all(h.exists() for h in handles))
+        # loading marks the first dataset as recently used, so the second
+        # one is removed when the store is too large.
+        handles[0].load()
+        array_store.get_or_put(self.store_dir, self.path, 'v1', 'a',
+                lambda: np.zeros(1000), max_bytes=30000)
+        self.assertEqual([h.exists() for h in handles], [True, False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from uncurl_app import artifact_cache
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_artifact_key(self):
+        key = artifact_cache.artifact_key('f', ('user', np.arange(3)), {'b': 1, 'a': 2})
+        self.assertTrue(key.startswith('f_'))
+        # the same arguments give the same key, independent of kwarg order
+        self.assertEqual(key, artifact_cache.artifact_key('f', ('user', [0, 1, 2]),
+            {'a': 2, 'b': 1}))
+        self.assertNotEqual(key, artifact_cache.artifact_key('f', ('user', [0, 1, 3]),
+            {'a': 2, 'b': 1}))
+        self.assertNotEqual(key, artifact_cache.artifact_key('g', ('user', [0, 1, 2]),
+            {'a': 2, 'b': 1}))
+
+    def test_store_load(self):
+        self.assertEqual(artifact_cache.load(self.path, 'v1', 'key'), (False, None))
+        self.assertTrue(artifact_cache.store(self.path, 'v1', 'key', {'a': np.arange(5)}))
+        found, value = artifact_cache.load(self.path, 'v1', 'key')
+        self.assertTrue(found)
+        np.testing.assert_array_equal(value['a'], np.arange(5))
+        # other versions don't see the artifact
+        self.assertEqual(artifact_cache.load(self.path, 'v2', 'key'), (False, None))
+
+    def test_old_versions_removed(self):
+        artifact_cache.store(self.path, 'v1', 'key', 1)
+        artifact_cache.store(self.path, 'v2', 'key', 2)
+        # storing doesn't remove other versions
+        self.assertEqual(artifact_cache.load(self.path, 'v1', 'key'), (True, 1))
+        artifact_cache.remove_old_versions(self.path, 'v2')
+        self.assertEqual(os.listdir(artifact_cache.get_artifact_dir(self.path)), ['v2'])
+        self.assertEqual(artifact_cache.load(self.path, 'v2', 'key'), (True, 2))
+        # by default, the current version is kept
+        version = artifact_cache.dataset_version(self.path)
+        artifact_cache.store(self.path, version, 'key', 3)
+        artifact_cache.remove_old_versions(self.path)
+        self.assertEqual(os.listdir(artifact_cache.get_artifact_dir(self.path)), [version])
+        artifact_cache.remove_artifacts(self.path)
+        self.assertFalse(os.path.exists(artifact_cache.get_artifact_dir(self.path)))
+
+    def test_corrupt_artifact(self):
+        artifact_dir = artifact_cache.get_artifact_dir(self.path, 'v1')
+        os.makedirs(artifact_dir)
+        with open(os.path.join(artifact_dir, 'key.pkl'), 'wb') as f:
+            f.write(b'not a pickle')
+        self.assertEqual(artifact_cache.load(self.path, 'v1', 'key'), (False, None))
+
+    def test_memoize_without_app(self):
+        calls = []
+        @artifact_cache.memoize
+        def f(user_id, x):
+            calls.append(x)
+            return x*2
+        self.assertEqual(f('user', 2), 4)
+        self.assertEqual(f('user', 2), 4)
+        # nothing is stored outside of an app context
+        self.assertEqual(calls, [2, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import fakeredis
+import numpy as np
+from flask import Flask
+
+from uncurl_app.cache import SharedLRU, TwoTierRedisCache, cache, dataset_context
+
+
+class TwoTierRedisCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.cache = self.make_cache()
+        self.app = Flask(__name__)
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def make_cache(self):
+        # two caches on the same redis behave like two workers
+        return TwoTierRedisCache(host=self.redis, key_prefix='test',
+                l1_min_bytes=1000, l1_check_interval=0)
+
+    def test_l1_hit(self):
+        array = np.arange(1000)
+        self.cache.set('a', array)
+        value = self.cache.get('a')
+        np.testing.assert_array_equal(value, array)
+        # the second get is served from L1
+        self.assertIs(self.cache.get('a'), value)
+        self.assertEqual(self.cache.l1_stats()[0], 1)
+        # small values aren't kept in L1
+        self.cache.set('b', np.arange(10))
+        self.cache.get('b')
+        self.assertEqual(self.cache.l1_stats()[0], 1)
+
+    def test_values_are_read_only(self):
+        array = np.arange(1000)
+        self.cache.set('a', (array, {'x': array}))
+        value = self.cache.get('a')
+        self.assertFalse(value[0].flags.writeable)
+        self.assertFalse(value[1]['x'].flags.writeable)
+        # the value passed to set isn't changed or kept in L1
+        self.assertTrue(array.flags.writeable)
+        array[0] = 5
+        self.assertEqual(self.cache.get('a')[0][0], 0)
+
+    def test_expiry(self):
+        self.cache.set('a', np.arange(1000), timeout=1)
+        self.assertIsNotNone(self.cache.get('a'))
+        self.cache.set('text', 'x'*50000, timeout=1)
+        self.assertIsNotNone(self.cache.get('text'))
+        time.sleep(1.1)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('text'))
+
+    def test_delete_in_other_worker(self):
+        other = self.make_cache()
+        self.cache.set('a', np.arange(1000))
+        self.cache.get('a')
+        other.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('b', np.arange(1000))
+        self.cache.get('b')
+        other.clear()
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_dataset_changed(self):
+        with open(os.path.join(self.data_dir, 'labels.txt'), 'w') as f:
+            f.write('0 1')
+        with self.app.app_context(), dataset_context(self.data_dir):
+            self.cache.set('a', np.arange(1000))
+            value = self.cache.get('a')
+            self.assertIs(self.cache.get('a'), value)
+        # the entry is dropped when the dataset changes, even when it's
+        # read outside of the dataset's context.
+        with open(os.path.join(self.data_dir, 'labels.txt'), 'w') as f:
+            f.write('0 1 2')
+        with self.app.app_context():
+            self.redis.set('testa', self.cache.serializer.dumps(np.arange(1000) + 1))
+            np.testing.assert_array_equal(self.cache.get('a'), np.arange(1000) + 1)
+
+
+class SharedLRUTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.app = Flask(__name__)
+        cache.config = {'CACHE_TYPE': 'uncurl_app.cache.TwoTierRedisCache',
+                'CACHE_REDIS_HOST': self.redis, 'CACHE_KEY_PREFIX': 'test'}
+        cache.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_lru(self):
+        lru = SharedLRU('test', max_entries=3)
+        for i in range(5):
+            lru.set(['genes', i], [i])
+        self.assertEqual(len(lru), 3)
+        self.assertIsNone(lru.get(['genes', 0]))
+        self.assertEqual(lru.get(['genes', 2]), [2])
+        lru.set(['genes', 5], [5])
+        # 2 was used more recently than 3
+        self.assertIsNone(lru.get(['genes', 3]))
+        self.assertEqual(lru.get(['genes', 2]), [2])
+        lru.delete(['genes', 2])
+        self.assertEqual(len(lru), 2)
+        self.assertIsNone(lru.get(['genes', 2]))
+
+    def test_concurrent_updates(self):
+        lru = SharedLRU('test', max_entries=10)
+        def set_values(start):
+            with self.app.app_context():
+                for i in range(start, start + 20):
+                    lru.set(['genes', i], i)
+                    lru.get(['genes', start])
+        threads = [threading.Thread(target=set_values, args=(i*100,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(lru), 10)
+        values = [k for k in self.redis.keys('testlru_test_*') if not k.endswith(b'index')]
+        self.assertEqual(len(values), 10)
+
+
+class CompressingRedisSerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = TwoTierRedisCache(host=fakeredis.FakeStrictRedis(),
+                compress_min_bytes=1000).serializer
+
+    def test_round_trip(self):
+        values = [5, 'short', 'x'*5000, np.arange(5000), {'a': list(range(2000))}, None]
+        for value in values:
+            loaded = self.serializer.loads(self.serializer.dumps(value))
+            if isinstance(value, np.ndarray):
+                np.testing.assert_array_equal(loaded, value)
+            else:
+                self.assertEqual(loaded, value)
+
+    def test_compressed_text(self):
+        from uncurl_app.cache import gzip_decompress
+        text = '{"data": [' + ', '.join(['1']*5000) + ']}'
+        dump = self.serializer.dumps(text)
+        self.assertTrue(dump.startswith(b'g'))
+        self.assertLess(len(dump), len(text))
+        loaded = self.serializer.loads(dump)
+        self.assertEqual(gzip_decompress(loaded.gzipped).decode('utf-8'), text)
+        # already compressed text isn't compressed again
+        values = self.serializer.stats['values']
+        self.assertEqual(self.serializer.dumps(loaded), dump)
+        self.assertEqual(self.serializer.stats['values'], values)
+        self.assertGreater(self.serializer.compression_ratio(), 1)
+
+    def test_small_values_not_compressed(self):
+        self.assertTrue(self.serializer.dumps('short').startswith(b'!'))
+        self.assertTrue(self.serializer.dumps(np.arange(10)).startswith(b'!'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from scipy import sparse
+import scipy.stats
+
+from uncurl_app import diffexp
+
+
+def random_data(genes=30, cells=80, seed=0):
+    """
+    Sparse count data of shape (genes, cells), with many zeros and tied
+    values.
+    """
+    rng = np.random.RandomState(seed)
+    data = rng.poisson(1.0, size=(genes, cells)).astype(float)
+    data[rng.rand(genes, cells) < 0.4] = 0
+    return sparse.csc_matrix(data)
+
+
+class WelchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = random_data()
+        self.dense = self.data.toarray()
+        self.labels = np.repeat([0, 1, 2, 3], [25, 20, 20, 15])
+
+    def test_one_vs_rest(self):
+        stats = diffexp.calculate_group_stats(self.data, self.labels)
+        ratios, pvals = diffexp.one_vs_rest_from_stats(stats)
+        self.assertEqual(pvals.shape, (4, 30))
+        for i in range(4):
+            x = self.dense[:, self.labels == i]
+            y = self.dense[:, self.labels != i]
+            expected = scipy.stats.ttest_ind(x, y, axis=1, equal_var=False,
+                    alternative='greater').pvalue
+            np.testing.assert_allclose(pvals[i], expected, rtol=1e-5)
+            np.testing.assert_allclose(ratios[i],
+                    (x.mean(1) + 1e-8)/(y.mean(1) + 1e-8))
+
+    def test_pairwise(self):
+        stats = diffexp.calculate_group_stats(self.data, self.labels)
+        ratios, pvals = diffexp.pairwise_from_stats(stats)
+        self.assertEqual(pvals.shape, (4, 4, 30))
+        for i in range(4):
+            for j in range(4):
+                if i == j:
+                    continue
+                x = self.dense[:, self.labels == i]
+                y = self.dense[:, self.labels == j]
+                expected = scipy.stats.ttest_ind(x, y, axis=1, equal_var=False,
+                        alternative='greater').pvalue
+                np.testing.assert_allclose(pvals[i, j], expected, rtol=1e-5)
+                r, p = diffexp.pair_from_stats(stats, i, j)
+                np.testing.assert_allclose(p, pvals[i, j])
+                np.testing.assert_allclose(r, ratios[i, j])
+
+    def test_blocks_and_processes(self):
+        # splitting the genes into blocks and processes doesn't change the
+        # results.
+        stats = diffexp.calculate_group_stats(self.data, self.labels)
+        block_stats = diffexp.calculate_group_stats(self.data, self.labels,
+                n_jobs=2, block_size=7)
+        np.testing.assert_allclose(block_stats.sums, stats.sums)
+        np.testing.assert_allclose(block_stats.sq_sums, stats.sq_sums)
+        np.testing.assert_allclose(block_stats.nnz, stats.nnz)
+        dense_stats = diffexp.calculate_group_stats(self.dense, self.labels)
+        np.testing.assert_allclose(dense_stats.sums, stats.sums)
+
+    def test_single_cell_group(self):
+        labels = np.array(self.labels)
+        labels[0] = 9
+        stats = diffexp.calculate_group_stats(self.data, labels)
+        self.assertEqual(list(stats.counts), [24, 20, 20, 15, 1])
+        ratios, pvals = diffexp.one_vs_rest_from_stats(stats)
+        self.assertTrue(np.isfinite(ratios).all())
+        self.assertTrue(((pvals >= 0) & (pvals <= 1)).all())
+        ratios, pvals = diffexp.pairwise_from_stats(stats)
+        self.assertTrue(np.isfinite(ratios).all())
+        self.assertTrue(((pvals >= 0) & (pvals <= 1)).all())
+
+
+class WilcoxonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = random_data(seed=1)
+        self.dense = self.data.toarray()
+        self.labels = np.repeat(['a', 'b', 'c'], [30, 25, 25])
+
+    def test_1_vs_rest(self):
+        label_values, pvals = diffexp.wilcoxon_1_vs_rest(self.data, self.labels)
+        self.assertEqual(list(label_values), ['a', 'b', 'c'])
+        for i, label in enumerate(label_values):
+            x = self.dense[:, self.labels == label]
+            y = self.dense[:, self.labels != label]
+            expected = scipy.stats.mannwhitneyu(x, y, axis=1,
+                    alternative='greater', method='asymptotic').pvalue
+            np.testing.assert_allclose(pvals[i], expected, rtol=1e-6)
+
+    def test_pair(self):
+        pvals = diffexp.wilcoxon_pair(self.data, self.labels, 'c', 'a')
+        x = self.dense[:, self.labels == 'c']
+        y = self.dense[:, self.labels == 'a']
+        expected = scipy.stats.mannwhitneyu(x, y, axis=1,
+                alternative='greater', method='asymptotic').pvalue
+        np.testing.assert_allclose(pvals, expected, rtol=1e-6)
+
+    def test_negative_values(self):
+        data = self.dense - (self.dense > 1)*3.0
+        pvals = diffexp.wilcoxon_pair(sparse.csr_matrix(data), self.labels, 'a', 'b')
+        x = data[:, self.labels == 'a']
+        y = data[:, self.labels == 'b']
+        expected = scipy.stats.mannwhitneyu(x, y, axis=1,
+                alternative='greater', method='asymptotic').pvalue
+        np.testing.assert_allclose(pvals, expected, rtol=1e-6)
+
+
+class FdrTest(unittest.TestCase):
+
+    def test_fdr_correction(self):
+        rng = np.random.RandomState(2)
+        pvals = rng.rand(3, 50)**3
+        fdr = diffexp.fdr_correction(pvals)
+        for i in range(3):
+            np.testing.assert_allclose(fdr[i],
+                    scipy.stats.false_discovery_control(pvals[i]))
+        self.assertEqual(diffexp.fdr_correction(np.zeros((2, 0))).shape, (2, 0))
+
+
+class SelectionDiffexpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = random_data(seed=3)
+        self.dense = self.data.toarray()
+
+    def test_overlapping_selections(self):
+        cells_1 = np.arange(80) < 50
+        cells_2 = np.arange(80) >= 30
+        ratios, pvals_1, pvals_2 = diffexp.selection_diffexp(self.data,
+                cells_1, cells_2)
+        x = self.dense[:, cells_1]
+        y = self.dense[:, cells_2]
+        np.testing.assert_allclose(pvals_1, scipy.stats.ttest_ind(x, y, axis=1,
+            equal_var=False, alternative='greater').pvalue, rtol=1e-5)
+        np.testing.assert_allclose(pvals_2, scipy.stats.ttest_ind(y, x, axis=1,
+            equal_var=False, alternative='greater').pvalue, rtol=1e-5)
+        np.testing.assert_allclose(ratios, (x.mean(1) + 1e-8)/(y.mean(1) + 1e-8))
+        # same results for dense data
+        dense_results = diffexp.selection_diffexp(self.dense, cells_1, cells_2)
+        np.testing.assert_allclose(dense_results[1], pvals_1)
+
+    def test_empty_selection(self):
+        cells_1 = np.arange(80) < 50
+        cells_2 = np.zeros(80, dtype=bool)
+        ratios, pvals_1, pvals_2 = diffexp.selection_diffexp(self.data,
+                cells_1, cells_2, use_fdr=True)
+        for x in [ratios, pvals_1, pvals_2]:
+            self.assertEqual(x.shape, (30,))
+            self.assertTrue(np.isfinite(x).all())
+
+
+class UpdateDiffexpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.data = random_data(genes=40, cells=90, seed=4)
+        self.labels = np.repeat([0, 1, 2], 30)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def check_update(self, new_labels, use_fdr=False):
+        for mode in ['1_vs_rest', 'pairwise']:
+            diffexp.calculate_diffexp(self.data, self.labels, mode=mode,
+                    use_fdr=use_fdr, cache_dir=self.cache_dir)
+        diffexp.update_diffexp(self.data, self.labels, new_labels,
+                use_fdr=use_fdr, cache_dir=self.cache_dir)
+        stats = diffexp.GroupStats.load(self.cache_dir + '/group_stats_{0}.npz'.format(
+            diffexp.data_signature(self.data, new_labels)))
+        expected_stats = diffexp.calculate_group_stats(self.data, new_labels)
+        np.testing.assert_allclose(stats.sums, expected_stats.sums)
+        np.testing.assert_allclose(stats.sq_sums, expected_stats.sq_sums)
+        np.testing.assert_allclose(stats.counts, expected_stats.counts)
+        ratios, pvals = diffexp.load_diffexp(self.data, new_labels,
+                mode='pairwise', use_fdr=use_fdr, cache_dir=self.cache_dir)
+        expected = diffexp.calculate_diffexp(self.data, new_labels,
+                mode='pairwise', use_fdr=use_fdr)
+        np.testing.assert_allclose(ratios, expected[0])
+        np.testing.assert_allclose(pvals, expected[1])
+        top_genes, top_pvals = diffexp.load_diffexp(self.data, new_labels,
+                use_fdr=use_fdr, cache_dir=self.cache_dir)
+        expected = diffexp.calculate_diffexp(self.data, new_labels,
+                use_fdr=use_fdr)
+        self.assertEqual(sorted(top_genes.keys()), sorted(expected[0].keys()))
+        for label in expected[0]:
+            np.testing.assert_allclose(np.array(top_genes[label])[:, 1],
+                    np.array(expected[0][label])[:, 1])
+            np.testing.assert_allclose(np.array(top_pvals[label])[:, 1],
+                    np.array(expected[1][label])[:, 1])
+
+    def test_split(self):
+        new_labels = np.array(self.labels)
+        new_labels[45:60] = 3
+        self.assertEqual(diffexp.match_groups(self.labels, new_labels), {0: 0, 2: 2})
+        self.check_update(new_labels)
+
+    def test_merge(self):
+        new_labels = np.array(self.labels)
+        new_labels[new_labels == 2] = 1
+        self.assertEqual(diffexp.match_groups(self.labels, new_labels), {0: 0})
+        self.check_update(new_labels, use_fdr=True)
+
+    def test_no_saved_results(self):
+        new_labels = np.array(self.labels)
+        new_labels[:10] = 5
+        diffexp.update_diffexp(self.data, self.labels, new_labels,
+                cache_dir=self.cache_dir)
+        ratios, pvals = diffexp.load_diffexp(self.data, new_labels,
+                mode='pairwise', cache_dir=self.cache_dir)
+        expected = diffexp.calculate_diffexp(self.data, new_labels, mode='pairwise')
+        np.testing.assert_allclose(pvals, expected[1])
+
+    def test_cells_changed(self):
+        # nothing is saved if the number of cells changed
+        diffexp.update_diffexp(self.data[:, :60], self.labels, self.labels[:60],
+                cache_dir=self.cache_dir)
+        self.assertIsNone(diffexp.load_diffexp(self.data[:, :60], self.labels[:60],
+            cache_dir=self.cache_dir))
+
+    def test_no_cache_dir(self):
+        new_labels = np.array(self.labels)
+        new_labels[:10] = 5
+        diffexp.update_diffexp(self.data, self.labels, new_labels)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import threading
+import time
+import unittest
+
+from flask import Flask
+from werkzeug.serving import make_server
+
+from uncurl_app import cache
+from uncurl_app import enrichr_client
+from uncurl_app.cache import SharedLRU
+from fake_enrichr import create_fake_enrichr_app
+
+
+class EnrichrClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_app = create_fake_enrichr_app()
+        self.server = make_server('127.0.0.1', 0, self.fake_app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        app = Flask('test_enrichr')
+        app.config['ENRICHR_URL'] = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        app.config['ENRICHR_TIMEOUT'] = 2
+        app.config['ENRICHR_DEADLINE'] = enrichr_client.DEFAULT_DEADLINE
+        app.config['ENRICHR_THREADS'] = enrichr_client.DEFAULT_THREADS
+        cache.config = {'CACHE_TYPE': 'simple'}
+        cache.init_app(app)
+        self.app = app
+        self.context = app.app_context()
+        self.context.push()
+        cache.clear()
+
+    def tearDown(self):
+        self.context.pop()
+        self.server.shutdown()
+
+    def test_enrich_cached(self):
+        genes = ['CD3E', 'CD8A', 'GZMB']
+        results = enrichr_client.enrich(genes, 'KEGG_2019_Human')
+        self.assertEqual(len(results), enrichr_client.NUM_RESULTS)
+        self.assertTrue(results[0][1].startswith('KEGG_2019_Human'))
+        results_2 = enrichr_client.enrich(genes, 'KEGG_2019_Human')
+        self.assertEqual(results, results_2)
+        self.assertEqual(self.fake_app.requests['addList'], 1)
+        self.assertEqual(self.fake_app.requests['enrich'], 1)
+        # the gene list id is reused for other libraries
+        enrichr_client.enrich(genes, 'GO_Biological_Process_2018')
+        self.assertEqual(self.fake_app.requests['addList'], 1)
+        self.assertEqual(self.fake_app.requests['enrich'], 2)
+
+    def test_expired_list_id(self):
+        genes = ['CD3E', 'CD8A']
+        enrichr_client.enrich(genes, 'KEGG_2019_Human')
+        self.fake_app.lists.clear()
+        results = enrichr_client.enrich(genes, 'GO_Biological_Process_2018')
+        self.assertEqual(len(results), enrichr_client.NUM_RESULTS)
+        self.assertEqual(self.fake_app.requests['addList'], 2)
+
+    def test_timeout(self):
+        self.fake_app.config['DELAY'] = 1.0
+        self.app.config['ENRICHR_TIMEOUT'] = 0.2
+        with self.assertRaises(enrichr_client.EnrichrTimeout):
+            enrichr_client.enrich(['CD3E'], 'KEGG_2019_Human')
+        # timeouts are not cached
+        self.fake_app.config['DELAY'] = 0
+        self.app.config['ENRICHR_TIMEOUT'] = 2
+        results = enrichr_client.enrich(['CD3E'], 'KEGG_2019_Human')
+        self.assertEqual(len(results), enrichr_client.NUM_RESULTS)
+
+    def test_deadline(self):
+        # adding the list and querying takes two requests
+        self.fake_app.config['DELAY'] = 0.3
+        with self.assertRaises(enrichr_client.EnrichrTimeout):
+            enrichr_client.enrich(['CD3E'], 'KEGG_2019_Human', deadline=0.4)
+
+    def test_start_enrich_pending(self):
+        self.fake_app.config['DELAY'] = 0.3
+        status, results = enrichr_client.start_enrich(['CD3E'], 'KEGG_2019_Human', wait=0)
+        self.assertEqual(status, 'pending')
+        # repeated requests don't start another query
+        status, results = enrichr_client.start_enrich(['CD3E'], 'KEGG_2019_Human', wait=0)
+        self.assertEqual(status, 'pending')
+        for i in range(20):
+            time.sleep(0.2)
+            status, results = enrichr_client.start_enrich(['CD3E'], 'KEGG_2019_Human', wait=0)
+            if status != 'pending':
+                break
+        self.assertEqual(status, 'done')
+        self.assertEqual(len(results), enrichr_client.NUM_RESULTS)
+        self.assertEqual(self.fake_app.requests['addList'], 1)
+
+    def test_circuit_breaker(self):
+        self.fake_app.config['DELAY'] = 0.5
+        self.app.config['ENRICHR_TIMEOUT'] = 0.1
+        for i in range(enrichr_client.breaker.max_failures):
+            status, message = enrichr_client.start_enrich(['GENE{0}'.format(i)],
+                    'KEGG_2019_Human', wait=2)
+            self.assertEqual(status, 'error')
+            self.assertTrue('timed out' in message)
+        n_requests = self.fake_app.requests['addList']
+        status, message = enrichr_client.start_enrich(['CD3E'], 'KEGG_2019_Human', wait=2)
+        self.assertEqual(status, 'error')
+        self.assertTrue('unavailable' in message)
+        self.assertEqual(self.fake_app.requests['addList'], n_requests)
+
+    def test_lru_bounded(self):
+        lru = SharedLRU('test', max_entries=3)
+        for i in range(5):
+            lru.set(['genes', i], i)
+        self.assertEqual(len(lru), 3)
+        self.assertEqual(lru.get(['genes', 0]), None)
+        self.assertEqual(lru.get(['genes', 2]), 2)
+        lru.set(['genes', 5], 5)
+        # 2 was used more recently than 3
+        self.assertEqual(lru.get(['genes', 3]), None)
+        self.assertEqual(lru.get(['genes', 2]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from scipy.stats import hypergeom
+
+from uncurl_app.gene_sets import GeneSetMatrix
+
+
+class GeneSetMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.names = ['T cell', 'B cell', 'NK cell', 'Monocyte']
+        self.gene_sets = [['CD3E', 'CD3D', 'CD8A', 'CD4'],
+                ['CD19', 'MS4A1', 'CD79A'],
+                ['GZMB', 'NKG7', 'CD8A', 'Klrd1'],
+                ['CD14', 'LYZ', 'CD4', 'FCGR3A', 'CD68']]
+        self.matrix = GeneSetMatrix(self.names, self.gene_sets)
+
+    def test_hypergeometric_test(self):
+        gene_lists = [['CD3E', 'CD8A', 'GZMB', 'UNKNOWN'],
+                ['cd19', 'ms4a1'],
+                ['UNKNOWN']]
+        results = self.matrix.hypergeometric_test(gene_lists)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[2], [])
+        n_genes = len(self.matrix.genes)
+        # same p-values as single hypergeometric tests
+        for genes, result in zip(gene_lists, results):
+            query = set(g.upper() for g in genes) & set(self.matrix.gene_index)
+            for i, pval, overlap in result:
+                set_genes = set(g.upper() for g in self.gene_sets[i])
+                k = len(query & set_genes)
+                self.assertEqual(len(overlap), k)
+                self.assertAlmostEqual(pval,
+                        hypergeom.sf(k - 1, n_genes, len(set_genes), len(query)))
+        self.assertEqual(results[0][0][0], 0)
+        self.assertEqual([x[0] for x in results[1]], [1])
+        self.assertEqual(results[1][0][2], ['CD19', 'MS4A1'])
+
+    def test_result_table(self):
+        tables = self.matrix.result_table([['KLRD1', 'NKG7']], max_results=1)
+        self.assertEqual(len(tables[0]), 2)
+        self.assertEqual(tables[0][1][0], 'NK cell')
+        self.assertEqual(tables[0][1][3], 'NKG7, Klrd1')
+
+
+if __name__ == '__main__':
+    unittest.main()
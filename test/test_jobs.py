@@ -0,0 +1,160 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from flask import Flask
+
+from uncurl_app import jobs
+
+
+def wait_for_job(path, job_id, timeout=10):
+    start = time.time()
+    while time.time() - start < timeout:
+        status = jobs.get_status(path, job_id)
+        if status is not None and status['status'] in (jobs.DONE, jobs.ERROR):
+            return status
+        time.sleep(0.05)
+    raise AssertionError('job did not finish')
+
+
+class JobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        shutil.rmtree(self.path)
+
+    def test_done(self):
+        statuses = []
+        def func(progress, x, y=0):
+            progress('adding', 0.5)
+            return x + y
+        job_id = jobs.submit(self.path, 'add', func, (1,), {'y': 2},
+                on_done=statuses.append)
+        status = wait_for_job(self.path, job_id)
+        self.assertEqual(status['name'], 'add')
+        self.assertEqual(status['status'], jobs.DONE)
+        self.assertEqual(status['result'], '3')
+        self.assertEqual(status['fraction'], 1.0)
+        self.assertEqual(status['progress'], 'adding')
+        self.assertEqual(status['pid'], os.getpid())
+        # on_done is called after the status is written
+        time.sleep(0.1)
+        self.assertEqual(statuses[0]['status'], jobs.DONE)
+        self.assertEqual([x['id'] for x in jobs.find_jobs(self.path, 'add')], [job_id])
+        self.assertEqual(jobs.find_jobs(self.path, 'add', running_only=True), [])
+
+    def test_error(self):
+        def func(progress):
+            raise ValueError('bad job')
+        job_id = jobs.submit(self.path, 'fail', func)
+        status = wait_for_job(self.path, job_id)
+        self.assertEqual(status['status'], jobs.ERROR)
+        self.assertEqual(status['result'], 'Error: bad job')
+
+    def test_invalid_job_id(self):
+        self.assertIsNone(jobs.get_status(self.path, '../secret'))
+        self.assertIsNone(jobs.get_status(self.path, 'abc123'))
+
+    def test_stale(self):
+        os.makedirs(jobs.get_job_dir(self.path))
+        now = time.time()
+        jobs.update_status(self.path, 'aa', status=jobs.RUNNING,
+                heartbeat=now - jobs.STALE_TIMEOUT - 1, host='other', pid=1)
+        self.assertEqual(jobs.get_status(self.path, 'aa')['status'], jobs.ERROR)
+        # the status file isn't changed
+        self.assertEqual(jobs._read_status(self.path, 'aa')['status'], jobs.RUNNING)
+        # a job on this host whose worker exited
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        jobs.update_status(self.path, 'bb', status=jobs.RUNNING, heartbeat=now,
+                host=jobs.socket.gethostname(), pid=process.pid)
+        self.assertEqual(jobs.get_status(self.path, 'bb')['status'], jobs.ERROR)
+        jobs.update_status(self.path, 'cc', status=jobs.RUNNING, heartbeat=now,
+                host=jobs.socket.gethostname(), pid=os.getpid())
+        self.assertEqual(jobs.get_status(self.path, 'cc')['status'], jobs.RUNNING)
+        # finished jobs are never stale
+        jobs.update_status(self.path, 'dd', status=jobs.DONE,
+                heartbeat=now - jobs.STALE_TIMEOUT - 1, host='other', pid=1)
+        self.assertEqual(jobs.get_status(self.path, 'dd')['status'], jobs.DONE)
+        self.assertEqual([x['id'] for x in jobs.find_jobs(self.path, running_only=True)],
+                ['cc'])
+        # stale jobs can be claimed again
+        self.assertTrue(jobs._claim_job(self.path, 'aa'))
+        self.assertFalse(jobs._claim_job(self.path, 'cc'))
+
+    def test_same_key(self):
+        calls = []
+        release = threading.Event()
+        def func(progress):
+            calls.append(1)
+            release.wait(10)
+            return 'ok'
+        key = ['v1', 'split_or_merge']
+        job_id = jobs.submit(self.path, 'job', func, key=key)
+        self.assertEqual(jobs.submit(self.path, 'job', func, key=key), job_id)
+        self.assertEqual(job_id, jobs.job_id_for_key(key))
+        self.assertNotEqual(jobs.submit(self.path, 'job', func, key=['v2']), job_id)
+        release.set()
+        wait_for_job(self.path, job_id)
+        # a finished job isn't run again
+        self.assertEqual(jobs.submit(self.path, 'job', func, key=key), job_id)
+        time.sleep(0.1)
+        self.assertEqual(len(calls), 2)
+
+    def test_same_key_after_error(self):
+        results = [ValueError('bad job'), 'ok']
+        def func(progress):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        key = ['v1', 'job']
+        job_id = jobs.submit(self.path, 'job', func, key=key)
+        self.assertEqual(wait_for_job(self.path, job_id)['status'], jobs.ERROR)
+        # a failed job is run again
+        self.assertEqual(jobs.submit(self.path, 'job', func, key=key), job_id)
+        status = wait_for_job(self.path, job_id)
+        self.assertEqual(status['status'], jobs.DONE)
+        self.assertEqual(status['result'], 'ok')
+
+    def test_exclusive(self):
+        calls = []
+        release = threading.Event()
+        def func(progress):
+            calls.append(1)
+            release.wait(10)
+        key = [self.path, 'split_or_merge']
+        results = []
+        def submit():
+            with self.app.app_context():
+                results.append(jobs.submit(self.path, 'job', func, key=key,
+                    exclusive=True))
+        threads = [threading.Thread(target=submit) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        job_ids = [x for x in results if x is not None]
+        self.assertEqual(len(job_ids), 1)
+        release.set()
+        wait_for_job(self.path, job_ids[0])
+        # finished exclusive jobs are run again
+        self.assertEqual(jobs.submit(self.path, 'job', func, key=key,
+            exclusive=True), job_ids[0])
+        wait_for_job(self.path, job_ids[0])
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import time
+import unittest
+
+import numpy as np
+from flask import Flask, current_app
+from scipy import sparse
+
+from uncurl_app import diffexp, plot_pool
+from uncurl_app.cache import cache
+
+
+def plot(x):
+    return json.dumps({'x': x})
+
+
+def slow_plot(x):
+    time.sleep(10)
+    return json.dumps({'x': x})
+
+
+def failing_plot(x):
+    raise ValueError('bad plot')
+
+
+def group_stats_plot(genes):
+    # more than one block of genes, so that diffexp would use a process pool
+    # with DIFFEXP_PROCESSES > 1
+    data = sparse.random(genes, 50, density=0.1, format='csc', random_state=0)
+    labels = np.repeat([0, 1], 25)
+    stats = diffexp.calculate_group_stats(data, labels,
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'])
+    return json.dumps({'shape': list(stats.sums.shape)})
+
+
+class PlotPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['PLOT_PROCESSES'] = 2
+        self.app.config['DIFFEXP_PROCESSES'] = 2
+        cache.config = {'CACHE_TYPE': 'simple'}
+        cache.init_app(self.app)
+
+    def test_run_plot(self):
+        with self.app.app_context():
+            result = plot_pool.run_plot('Dendrogram', ['a', 1], plot, (1,), wait=30)
+            self.assertEqual(json.loads(result), {'x': 1})
+            # the result is cached
+            self.assertEqual(plot_pool.run_plot('Dendrogram', ['a', 1], failing_plot, (1,)),
+                    result)
+
+    def test_error(self):
+        with self.app.app_context():
+            result = plot_pool.run_plot('Dendrogram', ['b'], failing_plot, (1,), wait=30)
+            self.assertEqual(result, 'Error: bad plot')
+
+    def test_deadline(self):
+        with self.app.app_context():
+            result = plot_pool.run_plot('Dendrogram', ['c'], slow_plot, (1,),
+                    deadline=1, wait=0.1)
+            self.assertEqual(json.loads(result)['status'], 'pending')
+            self.assertEqual(json.loads(plot_pool.run_plot('Dendrogram', ['c'], slow_plot,
+                (1,)))['status'], 'pending')
+            time.sleep(3)
+            result = plot_pool.run_plot('Dendrogram', ['c'], slow_plot, (1,))
+            self.assertEqual(result, 'Error: plot took too long to compute')
+
+    def test_cancel(self):
+        with self.app.app_context():
+            self.assertFalse(plot_pool.cancel_plot('Dendrogram', ['d']))
+            plot_pool.run_plot('Dendrogram', ['d'], slow_plot, (1,), wait=0.1)
+            self.assertTrue(plot_pool.cancel_plot('Dendrogram', ['d']))
+            time.sleep(3)
+            result = plot_pool.run_plot('Dendrogram', ['d'], slow_plot, (1,))
+            self.assertEqual(result, 'Error: plot was cancelled')
+
+    def test_diffexp_in_plot(self):
+        genes = diffexp.BLOCK_SIZE*2 + 1
+        with self.app.app_context():
+            result = plot_pool.run_plot('Dendrogram', ['f'], group_stats_plot,
+                    (genes,), wait=60)
+            self.assertEqual(json.loads(result)['shape'][0], genes)
+
+    def test_unpicklable_plot(self):
+        with self.app.app_context():
+            result = plot_pool.run_plot('Dendrogram', ['e'], lambda x: x, (1,), wait=30)
+            self.assertTrue(result.startswith('Error: could not start plot process'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@ from flask import Flask, render_template
 from flask_bootstrap import Bootstrap
 
 from . import interaction_views, views, flask_router, db_query, report
+from . import array_store, enrichr_client
 
 from .cache import cache
 
@@ -23,6 +24,61 @@ def create_app(config_filename=None):
     }
     app.config['NMF_ARGS'] = {
     }
+    # number of processes used for calculating differential expression
+    if 'DIFFEXP_PROCESSES' in os.environ:
+        app.config['DIFFEXP_PROCESSES'] = int(os.environ['DIFFEXP_PROCESSES'])
+    else:
+        app.config['DIFFEXP_PROCESSES'] = 2
+    # maximum number of plots (dendrograms, heatmaps) computed at the same
+    # time in each worker, see plot_pool.py
+    if 'PLOT_PROCESSES' in os.environ:
+        app.config['PLOT_PROCESSES'] = int(os.environ['PLOT_PROCESSES'])
+    else:
+        app.config['PLOT_PROCESSES'] = 2
+    # directory for memory-mapped arrays shared by all workers, see
+    # array_store.py
+    if 'ARRAY_STORE_DIR' in os.environ:
+        app.config['ARRAY_STORE_DIR'] = os.environ['ARRAY_STORE_DIR']
+    else:
+        app.config['ARRAY_STORE_DIR'] = array_store.default_store_dir()
+    # maximum total size of the array store, in bytes
+    if 'ARRAY_STORE_MAX_BYTES' in os.environ:
+        app.config['ARRAY_STORE_MAX_BYTES'] = int(os.environ['ARRAY_STORE_MAX_BYTES'])
+    else:
+        app.config['ARRAY_STORE_MAX_BYTES'] = array_store.DEFAULT_MAX_BYTES
+    # store expensive results (diffexp, heatmaps, dendrograms) on disk beside
+    # each dataset, see artifact_cache.py
+    if 'ARTIFACT_CACHE' in os.environ:
+        app.config['ARTIFACT_CACHE'] = os.environ['ARTIFACT_CACHE'].lower() not in ('0', 'false')
+    else:
+        app.config['ARTIFACT_CACHE'] = True
+    # run the CellMarker, CellMeSH and GO queries for each cluster after an
+    # analysis is done, see precompute.precompute_enrichment
+    if 'PRECOMPUTE_ENRICHMENT' in os.environ:
+        app.config['PRECOMPUTE_ENRICHMENT'] = os.environ['PRECOMPUTE_ENRICHMENT'].lower() not in ('0', 'false')
+    else:
+        app.config['PRECOMPUTE_ENRICHMENT'] = True
+    # url of the Enrichr API; this can be set to a local server from
+    # test/fake_enrichr.py for testing.
+    if 'ENRICHR_URL' in os.environ:
+        app.config['ENRICHR_URL'] = os.environ['ENRICHR_URL']
+    else:
+        app.config['ENRICHR_URL'] = enrichr_client.DEFAULT_URL
+    # timeout for each Enrichr request, and deadline for a whole query, in
+    # seconds
+    if 'ENRICHR_TIMEOUT' in os.environ:
+        app.config['ENRICHR_TIMEOUT'] = float(os.environ['ENRICHR_TIMEOUT'])
+    else:
+        app.config['ENRICHR_TIMEOUT'] = enrichr_client.DEFAULT_TIMEOUT
+    if 'ENRICHR_DEADLINE' in os.environ:
+        app.config['ENRICHR_DEADLINE'] = float(os.environ['ENRICHR_DEADLINE'])
+    else:
+        app.config['ENRICHR_DEADLINE'] = enrichr_client.DEFAULT_DEADLINE
+    # number of threads used for Enrichr queries in each worker
+    if 'ENRICHR_THREADS' in os.environ:
+        app.config['ENRICHR_THREADS'] = int(os.environ['ENRICHR_THREADS'])
+    else:
+        app.config['ENRICHR_THREADS'] = enrichr_client.DEFAULT_THREADS
     # set the test data dir correctly
     # find current directory, go up
     if 'TEST_DATA_DIR' in os.environ:
@@ -94,6 +150,19 @@ def create_app_split_seq(data_dir='./', config_filename=None):
     }
     app.config['NMF_ARGS'] = {
     }
+    app.config['DIFFEXP_PROCESSES'] = 2
+    app.config['PLOT_PROCESSES'] = 2
+    if 'ARRAY_STORE_DIR' in os.environ:
+        app.config['ARRAY_STORE_DIR'] = os.environ['ARRAY_STORE_DIR']
+    else:
+        app.config['ARRAY_STORE_DIR'] = array_store.default_store_dir()
+    app.config['ARRAY_STORE_MAX_BYTES'] = array_store.DEFAULT_MAX_BYTES
+    app.config['ARTIFACT_CACHE'] = True
+    app.config['PRECOMPUTE_ENRICHMENT'] = True
+    app.config['ENRICHR_URL'] = enrichr_client.DEFAULT_URL
+    app.config['ENRICHR_TIMEOUT'] = enrichr_client.DEFAULT_TIMEOUT
+    app.config['ENRICHR_DEADLINE'] = enrichr_client.DEFAULT_DEADLINE
+    app.config['ENRICHR_THREADS'] = enrichr_client.DEFAULT_THREADS
     if 'TEST_DATA_DIR' in os.environ:
         app.config['TEST_DATA_DIR'] = os.environ['TEST_DATA_DIR']
     else:
@@ -307,111 +307,185 @@ def z_score_diff(z1, z2, n1, n2):
 
 
 
-def dendrogram(data_sampled_all_genes, all_gene_names, selected_gene_names, cluster_name, cluster_data, use_log=False,
-        use_normalize=False):
+# colors used for the dendrogram branches, keyed by the color names returned
+# by scipy.cluster.hierarchy.dendrogram (same as plotly's create_dendrogram)
+DENDROGRAM_COLORS = {
+        'b': 'rgb(0,116,217)',
+        'c': 'rgb(35,205,205)',
+        'g': 'rgb(61,153,112)',
+        'k': 'rgb(40,35,35)',
+        'm': 'rgb(133,20,75)',
+        'r': 'rgb(255,65,54)',
+        'w': 'rgb(255,255,255)',
+        'y': 'rgb(255,220,0)',
+}
+for _i, _c in enumerate(['b', 'g', 'r', 'c', 'm', 'y', 'k', 'g', 'r', 'c']):
+    DENDROGRAM_COLORS['C' + str(_i)] = DENDROGRAM_COLORS[_c]
+
+
+def cluster_means_matrix(data_sampled_all_genes, cluster_data):
     """
-    Returns a json dendrogram from plotly...
+    Returns the sorted unique cluster labels, and an array of shape
+    (genes, k) containing the mean of each gene in each cluster.
+    """
+    from .diffexp import calculate_group_stats
+    stats = calculate_group_stats(data_sampled_all_genes, cluster_data)
+    return stats.label_values, stats.means()
+
+
+def dendrogram_tree(X):
+    """
+    Hierarchical clustering (complete linkage, euclidean distance) of the
+    rows of X.
+
+    Returns a dict with keys icoord, dcoord, color_list (the branches, as
+    returned by scipy.cluster.hierarchy.dendrogram) and leaves (the row
+    indices in left-to-right order).
+    """
+    from scipy.cluster import hierarchy
+    from scipy.spatial.distance import pdist
+    if X.shape[0] < 2:
+        return {'icoord': [], 'dcoord': [], 'color_list': [],
+                'leaves': list(range(X.shape[0]))}
+    Z = hierarchy.linkage(pdist(X), 'complete')
+    P = hierarchy.dendrogram(Z, no_plot=True)
+    return {'icoord': P['icoord'], 'dcoord': P['dcoord'],
+            'color_list': P['color_list'], 'leaves': P['leaves']}
+
+
+def _dendrogram_traces(tree, orientation, xaxis, yaxis):
+    """
+    Returns a list of plotly line traces for a tree from dendrogram_tree.
+    orientation is 'bottom' (leaves along the x axis) or 'right' (leaves
+    along the y axis, branches extending to the left).
+    """
+    traces = []
+    for icoord, dcoord, color in zip(tree['icoord'], tree['dcoord'], tree['color_list']):
+        if orientation == 'bottom':
+            x, y = icoord, dcoord
+        else:
+            x, y = [-d for d in dcoord], icoord
+        traces.append({
+            'type': 'scatter',
+            'x': x,
+            'y': y,
+            'mode': 'lines',
+            'marker': {'color': DENDROGRAM_COLORS.get(color, 'rgb(0,116,217)')},
+            'xaxis': xaxis,
+            'yaxis': yaxis,
+        })
+    return traces
+
+
+def dendrogram_figure(data_cluster_means, gene_names, cluster_names, cluster_tree=None, gene_tree=None):
+    """
+    Returns a json plot of a heatmap of cluster means, with dendrograms of the
+    clusters (top) and genes (left).
 
     Args:
-        data_subset (array): csc matrix, created from data_sampled_all_genes
+        data_cluster_means (array): shape (genes, k)
+        gene_names (list): length genes
+        cluster_names (list): length k
+        cluster_tree, gene_tree (dict): outputs of dendrogram_tree for the
+            clusters and genes. Calculated if not given.
+    """
+    if cluster_tree is None:
+        cluster_tree = dendrogram_tree(data_cluster_means.T)
+    if gene_tree is None:
+        gene_tree = dendrogram_tree(data_cluster_means)
+    # scipy places the leaves at 5, 15, 25, ...
+    cluster_leaves = cluster_tree['leaves']
+    gene_leaves = gene_tree['leaves']
+    x_tickvals = [5 + 10*i for i in range(len(cluster_leaves))]
+    y_tickvals = [5 + 10*i for i in range(len(gene_leaves))]
+    heat_data = data_cluster_means[gene_leaves, :][:, cluster_leaves]
+    data = _dendrogram_traces(cluster_tree, 'bottom', 'x', 'y2')
+    data += _dendrogram_traces(gene_tree, 'right', 'x2', 'y')
+    data.append({
+        'type': 'heatmap',
+        'x': x_tickvals,
+        'y': y_tickvals,
+        'z': heat_data,
+        'colorscale': 'Reds',
+        'showscale': False,
+    })
+    hidden_axis = {'mirror': False,
+            'showgrid': False,
+            'showline': False,
+            'zeroline': False,
+            'showticklabels': False,
+            'ticks': ''}
+    layout = {
+        'width': 700,
+        'height': 100+len(gene_names)*25,
+        'showlegend': False,
+        'hovermode': 'closest',
+        'xaxis': {'domain': [.15, 1],
+                  'mirror': False,
+                  'showgrid': False,
+                  'showline': False,
+                  'zeroline': False,
+                  'ticks': '',
+                  'tickmode': 'array',
+                  'tickvals': x_tickvals,
+                  'ticktext': [cluster_names[i] for i in cluster_leaves]},
+        'xaxis2': dict(hidden_axis, domain=[0, .15]),
+        'yaxis': {'domain': [0, .85],
+                  'mirror': False,
+                  'showgrid': False,
+                  'showline': False,
+                  'zeroline': False,
+                  'showticklabels': True,
+                  'side': 'right',
+                  'tickmode': 'array',
+                  'tickvals': y_tickvals,
+                  'ticktext': [gene_names[i] for i in gene_leaves],
+                  'ticks': ''},
+        'yaxis2': dict(hidden_axis, domain=[.825, .975]),
+        'font': {'size': 16},
+    }
+    return json.dumps({'data': data, 'layout': layout}, cls=SimpleEncoder)
+
+
+def dendrogram_means(data_sampled_all_genes, all_gene_names, selected_gene_names, cluster_data,
+        use_log=False, use_normalize=False, cluster_means=None):
     """
-    import plotly.graph_objects as go
-    import plotly.figure_factory as ff
-    # TODO
-    if not isinstance(cluster_data[0], str):
-        cluster_data = np.array(['c' + str(x) for x in cluster_data])
-    cluster_values = [x for x in sorted(set(cluster_data))]
-    cluster_indices = {c1 : i for i, c1 in enumerate(cluster_values)}
+    Returns the selected gene names that are present in the data, the cluster
+    names, and the (transformed) cluster means for these genes, an array of
+    shape (selected genes, k).
+
+    Args:
+        cluster_means (tuple or None): optionally, (label_values, means) as
+            returned by cluster_means_matrix, so that the means don't have
+            to be recalculated.
+    """
+    if cluster_means is None:
+        cluster_means = cluster_means_matrix(data_sampled_all_genes, cluster_data)
+    cluster_values, means = cluster_means
+    cluster_names = [x if isinstance(x, str) else 'c' + str(x) for x in cluster_values]
     gene_name_indices = {x: i for i, x in enumerate(all_gene_names)}
     selected_gene_names = [x for x in selected_gene_names if x in gene_name_indices]
-    gene_indices = np.array([gene_name_indices[x] for x in selected_gene_names])
+    gene_indices = np.array([gene_name_indices[x] for x in selected_gene_names], dtype=int)
     print('dendrogram selected gene names:', selected_gene_names)
     print('dendrogram selected gene ids:', gene_indices)
-    selected_gene_indices = {x: i for i, x in enumerate(selected_gene_names)}
-    # take mean across all clusters
-    data_cluster_means = np.zeros((len(all_gene_names), len(cluster_values)))
-    for i, c in enumerate(cluster_values):
-        data_cluster_means[:,i] = np.array(data_sampled_all_genes[:, cluster_data==c].mean(1)).flatten()
-    data_cluster_means = data_cluster_means[gene_indices, :]
+    data_cluster_means = means[gene_indices, :]
     if use_log:
         data_cluster_means = np.log(1+data_cluster_means)
     if use_normalize:
         # divide data by max value for each gene
-        data_cluster_means = data_cluster_means/data_cluster_means.max(1, keepdims=True)
-    # code based on https://plot.ly/python/dendrogram/
-    # create top dendrogram - plot of cells
-    fig = ff.create_dendrogram(data_cluster_means.T, orientation='bottom', labels=cluster_values)
-    for i in range(len(fig['data'])):
-        fig['data'][i]['yaxis'] = 'y2'
-    # Create Side Dendrogram - plot of genes
-    dendro_side = ff.create_dendrogram(data_cluster_means, orientation='right', labels=selected_gene_names)
-    for i in range(len(dendro_side['data'])):
-        dendro_side['data'][i]['xaxis'] = 'x2'
-
-    # Add Side Dendrogram Data to Figure
-    for data in dendro_side['data']:
-        fig.add_trace(data)
-
-    # Create Heatmap
-    # TODO: reorder selected_gene_names?
-    gene_labels_y = dendro_side['layout']['yaxis']['ticktext']
-    dendro_leaves_y = [selected_gene_indices[i] for i in gene_labels_y]
-    dendro_leaves_x = fig['layout']['xaxis']['ticktext']
-    dendro_leaves_x = [cluster_indices[i] for i in dendro_leaves_x]
-    heat_data = data_cluster_means[dendro_leaves_y,:]
-    heat_data = heat_data[:,dendro_leaves_x]
-
-    heatmap = [
-        go.Heatmap(
-            x = dendro_leaves_x,
-            y = selected_gene_names,
-            z = heat_data,
-            colorscale = 'Reds',
-            showscale = False,
-        )
-    ]
-    heatmap[0]['x'] = fig['layout']['xaxis']['tickvals']
-    heatmap[0]['y'] = dendro_side['layout']['yaxis']['tickvals']
-
-    # Add Heatmap Data to Figure
-    for data in heatmap:
-        fig.add_trace(data)
-    # Edit Layout
-    fig.update_layout({'width':700, 'height':100+len(selected_gene_names)*25,
-                         'showlegend':False, 'hovermode': 'closest',
-                         })
-    fig.update_layout(xaxis={'domain': [.15, 1],
-                                  'mirror': False,
-                                  'showgrid': False,
-                                  'showline': False,
-                                  'zeroline': False,
-                                  'ticks':""})
-    fig.update_layout(xaxis2={'domain': [0, .15],
-                                   'mirror': False,
-                                   'showgrid': False,
-                                   'showline': False,
-                                   'zeroline': False,
-                                   'showticklabels': False,
-                                   'ticks':""})
-    fig.update_layout(yaxis={'domain': [0, .85],
-                                  'mirror': False,
-                                  'showgrid': False,
-                                  'showline': False,
-                                  'zeroline': False,
-                                  'showticklabels': True,
-                                  'side': 'right',
-                                  'tickmode': 'array',
-                                  'tickvals': dendro_side['layout']['yaxis']['tickvals'],
-                                  'ticktext': gene_labels_y,
-                                  'ticks': ""
-                        })
-    fig.update_layout(yaxis2={'domain':[.825, .975],
-                                   'mirror': False,
-                                   'showgrid': False,
-                                   'showline': False,
-                                   'zeroline': False,
-                                   'showticklabels': False,
-                                   'ticks':""})
-    fig.update_layout({'font': {'size': 16}})
-    return fig.to_json()
+        data_cluster_means = data_cluster_means/np.maximum(data_cluster_means.max(1, keepdims=True), 1e-16)
+    return selected_gene_names, cluster_names, data_cluster_means
+
 
+def dendrogram(data_sampled_all_genes, all_gene_names, selected_gene_names, cluster_name, cluster_data, use_log=False,
+        use_normalize=False):
+    """
+    Returns a json dendrogram from plotly...
+
+    Args:
+        data_subset (array): csc matrix, created from data_sampled_all_genes
+    """
+    selected_gene_names, cluster_names, data_cluster_means = dendrogram_means(
+            data_sampled_all_genes, all_gene_names, selected_gene_names,
+            cluster_data, use_log=use_log, use_normalize=use_normalize)
+    return dendrogram_figure(data_cluster_means, selected_gene_names, cluster_names)
@@ -0,0 +1,318 @@
+# Store for large numpy arrays and sparse matrices, shared by all web
+# workers through memory-mapped .npy files.
+#
+# Arrays are stored per dataset and per dataset version (see
+# utils.dataset_version) under ARRAY_STORE_DIR, which defaults to a directory
+# in /dev/shm, so that all workers map the same pages instead of each keeping
+# a deserialized copy. Memoized functions return ArrayHandles (which are small
+# to pickle) instead of the arrays themselves.
+#
+# Arrays of datasets that no longer exist are removed by sweep, which also
+# keeps the store under a size limit by removing the least recently used
+# datasets. It's run after each new array is stored, and by cleanup.sh
+# (python -m uncurl_app.array_store).
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import numpy as np
+from scipy import sparse
+
+
+# default limit on the total size of the store, in bytes
+DEFAULT_MAX_BYTES = 4*1024**3
+
+
+def default_store_dir():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm/uncurl_arrays'
+    return os.path.join(tempfile.gettempdir(), 'uncurl_arrays')
+
+
+class ArrayHandle(object):
+    """
+    Reference to an array in the store.
+
+    Attributes:
+        directory (str): directory containing the .npy files
+        kind (str): 'dense', 'sparse' or 'object' (arrays of python objects,
+            which can't be memory-mapped)
+        format (str): sparse matrix format, 'csr' or 'csc'
+        shape (tuple): shape of the sparse matrix
+    """
+
+    def __init__(self, directory, kind, format=None, shape=None):
+        self.directory = directory
+        self.kind = kind
+        self.format = format
+        self.shape = shape
+
+    def exists(self):
+        return os.path.isdir(self.directory)
+
+    def load(self):
+        """
+        Returns the array. Dense arrays and the components of sparse
+        matrices are read-only memory maps.
+        """
+        _touch(os.path.dirname(self.directory))
+        if self.kind == 'object':
+            return np.load(os.path.join(self.directory, 'array.npy'), allow_pickle=True)
+        if self.kind == 'dense':
+            return np.load(os.path.join(self.directory, 'array.npy'), mmap_mode='r')
+        data = np.load(os.path.join(self.directory, 'data.npy'), mmap_mode='r')
+        indices = np.load(os.path.join(self.directory, 'indices.npy'), mmap_mode='r')
+        indptr = np.load(os.path.join(self.directory, 'indptr.npy'), mmap_mode='r')
+        if self.format == 'csc':
+            return sparse.csc_matrix((data, indices, indptr), shape=self.shape, copy=False)
+        return sparse.csr_matrix((data, indices, indptr), shape=self.shape, copy=False)
+
+
+def _dataset_dir(store_dir, path):
+    h = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(store_dir, h)
+
+
+def _path_filename(store_dir, path):
+    """
+    File containing the dataset path of a dataset directory in the store,
+    used by sweep to find the arrays of deleted datasets.
+    """
+    return _dataset_dir(store_dir, path) + '.path'
+
+
+def _touch(directory):
+    """
+    Marks a dataset version as recently used, for sweep.
+    """
+    try:
+        os.utime(directory, None)
+    except OSError:
+        pass
+
+
+def _array_dir(store_dir, path, version, name):
+    h = hashlib.sha1(name.encode()).hexdigest()[:16]
+    return os.path.join(_dataset_dir(store_dir, path), version, h)
+
+
+def _write(directory, array):
+    """
+    Writes an array to a new directory, returning an ArrayHandle.
+    """
+    os.makedirs(directory)
+    if sparse.issparse(array):
+        if array.format not in ('csr', 'csc'):
+            array = sparse.csr_matrix(array)
+        np.save(os.path.join(directory, 'data.npy'), array.data)
+        np.save(os.path.join(directory, 'indices.npy'), array.indices)
+        np.save(os.path.join(directory, 'indptr.npy'), array.indptr)
+        handle = ArrayHandle(directory, 'sparse', array.format, array.shape)
+    else:
+        array = np.asarray(array)
+        if array.dtype == object:
+            np.save(os.path.join(directory, 'array.npy'), array, allow_pickle=True)
+            handle = ArrayHandle(directory, 'object')
+        else:
+            np.save(os.path.join(directory, 'array.npy'), array)
+            handle = ArrayHandle(directory, 'dense')
+    with open(os.path.join(directory, 'handle.json'), 'w') as f:
+        json.dump({'kind': handle.kind, 'format': handle.format,
+            'shape': handle.shape}, f)
+    return handle
+
+
+def get(store_dir, path, version, name):
+    """
+    Returns an ArrayHandle if the array is stored, or None.
+    """
+    directory = _array_dir(store_dir, path, version, name)
+    try:
+        with open(os.path.join(directory, 'handle.json')) as f:
+            h = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    shape = tuple(h['shape']) if h['shape'] is not None else None
+    return ArrayHandle(directory, h['kind'], h['format'], shape)
+
+
+def put(store_dir, path, version, name, array):
+    """
+    Stores an array for the given dataset path, dataset version and name,
+    and returns an ArrayHandle. Arrays stored for older versions of the same
+    dataset are removed.
+    """
+    directory = _array_dir(store_dir, path, version, name)
+    # the path file is written before the dataset directory is created, so
+    # sweep never removes a dataset directory that's being written.
+    path_filename = _path_filename(store_dir, path)
+    if not os.path.exists(path_filename):
+        try:
+            os.makedirs(store_dir)
+        except OSError:
+            pass
+        with open(path_filename, 'w') as f:
+            f.write(os.path.abspath(path))
+    # write to a temporary directory, then rename, so that other workers
+    # never see a partially written array.
+    tmp_directory = directory + '.tmp' + uuid.uuid4().hex
+    handle = _write(tmp_directory, array)
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # another worker stored the same array first
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    handle.directory = directory
+    remove_old_versions(store_dir, path, version)
+    return handle
+
+
+def get_or_put(store_dir, path, version, name, func, max_bytes=None):
+    """
+    Returns an ArrayHandle for the given name, calling func() to create the
+    array if it isn't stored yet. If func() returns None, None is returned.
+    After a new array is stored, the store is swept (see sweep) with the
+    given max_bytes.
+    """
+    handle = get(store_dir, path, version, name)
+    if handle is not None:
+        return handle
+    array = func()
+    if array is None:
+        return None
+    handle = put(store_dir, path, version, name, array)
+    sweep(store_dir, max_bytes, keep=os.path.dirname(handle.directory))
+    return handle
+
+
+def remove_old_versions(store_dir, path, version):
+    """
+    Removes all stored arrays for the dataset at path except for the given
+    version. Workers that still have the old arrays mapped keep them until
+    they are unmapped.
+    """
+    dataset_dir = _dataset_dir(store_dir, path)
+    if not os.path.isdir(dataset_dir):
+        return
+    for v in os.listdir(dataset_dir):
+        if v != version:
+            shutil.rmtree(os.path.join(dataset_dir, v), ignore_errors=True)
+
+
+def remove_dataset(store_dir, path):
+    """
+    Removes all stored arrays for the dataset at path.
+    """
+    shutil.rmtree(_dataset_dir(store_dir, path), ignore_errors=True)
+
+
+def _dir_size(directory):
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def sweep(store_dir, max_bytes=None, keep=None):
+    """
+    Removes the stored arrays of datasets whose path no longer exists. Then,
+    if the store is larger than max_bytes, removes the least recently used
+    dataset versions (see ArrayHandle.load) until it fits, except for the
+    version directory keep.
+    """
+    if not os.path.isdir(store_dir):
+        return
+    versions = []
+    for name in os.listdir(store_dir):
+        dataset_dir = os.path.join(store_dir, name)
+        if name.endswith('.path'):
+            if not os.path.exists(_read(dataset_dir)):
+                _remove(dataset_dir)
+            continue
+        if not os.path.isdir(dataset_dir):
+            continue
+        path = _read(dataset_dir + '.path')
+        if not os.path.exists(path):
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+            _remove(dataset_dir + '.path')
+            continue
+        if max_bytes is None:
+            continue
+        for v in os.listdir(dataset_dir):
+            version_dir = os.path.join(dataset_dir, v)
+            try:
+                mtime = os.path.getmtime(version_dir)
+            except OSError:
+                continue
+            versions.append((mtime, version_dir))
+    if max_bytes is None:
+        return
+    sizes = {v: _dir_size(v) for _, v in versions}
+    total = sum(sizes.values())
+    for _, version_dir in sorted(versions):
+        if total <= max_bytes:
+            break
+        if version_dir == keep:
+            continue
+        shutil.rmtree(version_dir, ignore_errors=True)
+        total -= sizes[version_dir]
+        try:
+            # removes the dataset directory if it's empty
+            os.rmdir(os.path.dirname(version_dir))
+        except OSError:
+            pass
+
+
+def _read(filename):
+    """
+    Returns the contents of a path file, or '' if it can't be read.
+    """
+    try:
+        with open(filename) as f:
+            return f.read()
+    except (IOError, OSError):
+        return ''
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def load(value):
+    """
+    Returns value.load() if value is an ArrayHandle, otherwise value.
+    """
+    if isinstance(value, ArrayHandle):
+        return value.load()
+    return value
+
+
+def all_exist(value):
+    """
+    Returns False if value is an ArrayHandle, or a tuple containing
+    ArrayHandles, whose array has been removed from the store.
+    """
+    if isinstance(value, tuple):
+        return all(all_exist(x) for x in value)
+    if isinstance(value, ArrayHandle):
+        return value.exists()
+    return True
+
+
+if __name__ == '__main__':
+    # usage: python -m uncurl_app.array_store [store_dir]
+    # sweeps the store, using ARRAY_STORE_MAX_BYTES from the environment.
+    store_dir = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('ARRAY_STORE_DIR', default_store_dir())
+    sweep(store_dir, int(os.environ.get('ARRAY_STORE_MAX_BYTES', DEFAULT_MAX_BYTES)))
@@ -0,0 +1,145 @@
+# Disk cache for expensive results (custom diffexp, heatmaps, dendrograms).
+#
+# Results are stored beside each dataset, in
+# <dataset dir>/artifacts/<dataset version>/, so that they survive redis
+# restarts, are never used after the dataset changes (see
+# utils.dataset_version), and are removed together with the dataset. The
+# artifacts of older versions are removed by remove_old_versions, which is
+# run once after the dataset changes (after jobs that modify the dataset,
+# and in precompute), not on each store, so that slow writers and readers of
+# the previous version don't remove or lose the current version's directory.
+
+import hashlib
+import json
+import os
+import pickle
+import traceback
+import uuid
+from functools import wraps
+
+from flask import current_app, has_app_context
+
+from .utils import dataset_version
+
+ARTIFACT_DIR = 'artifacts'
+
+
+def get_artifact_dir(path, version=None):
+    """
+    Returns the artifact directory for a dataset, or for the given version
+    of the dataset.
+    """
+    if version is None:
+        return os.path.join(path, ARTIFACT_DIR)
+    return os.path.join(path, ARTIFACT_DIR, version)
+
+
+def _json_default(x):
+    # request forms (MultiDicts), numpy arrays and scalars
+    if hasattr(x, 'items') and hasattr(x, 'getlist'):
+        return sorted(x.items(multi=True))
+    if hasattr(x, 'tolist'):
+        return x.tolist()
+    return repr(x)
+
+
+def artifact_key(name, args, kwargs):
+    """
+    Returns a filename-safe key for a function name and its arguments.
+    """
+    key = json.dumps([name, list(args), sorted(kwargs.items())],
+            default=_json_default, sort_keys=True)
+    return name + '_' + hashlib.sha1(key.encode()).hexdigest()
+
+
+def load(path, version, key):
+    """
+    Returns (True, value) if the artifact is stored, or (False, None).
+    """
+    filename = os.path.join(get_artifact_dir(path, version), key + '.pkl')
+    if not os.path.exists(filename):
+        return False, None
+    try:
+        with open(filename, 'rb') as f:
+            return True, pickle.load(f)
+    except Exception:
+        print(traceback.format_exc())
+        return False, None
+
+
+def store(path, version, key, value):
+    """
+    Stores an artifact. Errors (e.g. read-only dataset directories) are only
+    printed.
+    """
+    artifact_dir = get_artifact_dir(path, version)
+    filename = os.path.join(artifact_dir, key + '.pkl')
+    tmp_filename = filename + '.tmp' + uuid.uuid4().hex
+    try:
+        os.makedirs(artifact_dir, exist_ok=True)
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+    except Exception:
+        print(traceback.format_exc())
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        return False
+    return True
+
+
+def remove_old_versions(path, version=None):
+    """
+    Removes the artifacts of all versions of a dataset except for the given
+    version (by default, the current version).
+    """
+    import shutil
+    if version is None:
+        version = dataset_version(path)
+    artifact_dir = get_artifact_dir(path)
+    if not os.path.isdir(artifact_dir):
+        return
+    for v in os.listdir(artifact_dir):
+        if v != version:
+            shutil.rmtree(os.path.join(artifact_dir, v), ignore_errors=True)
+
+
+def remove_artifacts(path):
+    """
+    Removes all artifacts of a dataset.
+    """
+    import shutil
+    shutil.rmtree(get_artifact_dir(path), ignore_errors=True)
+
+
+def _is_error(value):
+    return value is None or (isinstance(value, str) and value.startswith('Error'))
+
+
+def memoize(func):
+    """
+    Decorator for functions whose first argument is a user_id: results are
+    stored in the dataset's artifact directory, keyed by the function name,
+    arguments, and dataset version, and loaded from there before calling
+    the function. Use under cache.memoize(), so that redis is checked first.
+
+    Disabled if the app config has ARTIFACT_CACHE = False.
+    """
+    @wraps(func)
+    def wrapper(user_id, *args, **kwargs):
+        if not has_app_context() or not current_app.config.get('ARTIFACT_CACHE', True):
+            return func(user_id, *args, **kwargs)
+        from .interaction_views import user_id_to_path
+        path = user_id_to_path(user_id)
+        version = dataset_version(path)
+        # the key is calculated before the call, since some functions modify
+        # their arguments.
+        key = artifact_key(func.__name__, (user_id,) + args, kwargs)
+        found, value = load(path, version, key)
+        if found:
+            return value
+        value = func(user_id, *args, **kwargs)
+        if not _is_error(value):
+            store(path, version, key, value)
+        return value
+    return wrapper
@@ -1,4 +1,6 @@
 
+from contextlib import contextmanager
+
 from flask_caching import Cache
 
 cache = Cache()
@@ -12,3 +14,535 @@ def clear_cache_user_id(user_id):
     # TODO: this doesn't work due to hashing
     for key in r.scan_iter(match='*{0}*'.format(user_id)):
         r.delete(key)
+
+
+class SharedLRU(object):
+    """
+    Bounded LRU map of small values, shared by all workers through the cache.
+
+    Values are stored in the cache with the given timeout (in seconds). With
+    a redis cache, the keys are kept in a redis sorted set scored by the time
+    of their last use, and when it has more than max_entries keys, the least
+    recently used values are deleted; each update of the index is a single
+    transaction, so concurrent workers don't lose each other's updates.
+    Other caches are not shared between processes, and keep the index as a
+    list in the cache, updated under a lock.
+
+    Keys can be any json-serializable values.
+    """
+
+    def __init__(self, name, max_entries=1000, timeout=24*3600):
+        import threading
+        self.name = name
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        import hashlib
+        import json
+        h = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return 'lru_{0}_{1}'.format(self.name, h)
+
+    def _index_key(self):
+        return 'lru_{0}_index'.format(self.name)
+
+    def _redis_index(self):
+        """
+        Returns the redis client and the key of the index, or (None, None) if
+        the cache isn't a redis cache.
+        """
+        backend = cache.cache
+        if RedisCache is None or not isinstance(backend, RedisCache):
+            return None, None
+        return backend._write_client, backend._get_prefix() + self._index_key()
+
+    def _touch(self, cache_key, remove=False):
+        import time
+        client, index_key = self._redis_index()
+        if client is not None:
+            pipe = client.pipeline()
+            if remove:
+                pipe.zrem(index_key, cache_key)
+            else:
+                pipe.zadd(index_key, {cache_key: time.time()})
+            pipe.zrange(index_key, 0, -self.max_entries - 1)
+            pipe.zremrangebyrank(index_key, 0, -self.max_entries - 1)
+            pipe.expire(index_key, self.timeout)
+            evicted = [k.decode('utf-8') if isinstance(k, bytes) else k
+                    for k in pipe.execute()[1]]
+        else:
+            with self._lock:
+                # the cached list can be shared with other callers, so it is
+                # copied before it's changed.
+                index = list(cache.get(self._index_key()) or [])
+                if cache_key in index:
+                    index.remove(cache_key)
+                if not remove:
+                    index.append(cache_key)
+                evicted = index[:-self.max_entries]
+                index = index[-self.max_entries:]
+                cache.set(self._index_key(), index, timeout=self.timeout)
+        if evicted:
+            cache.delete_many(*evicted)
+
+    def get(self, key):
+        cache_key = self._key(key)
+        value = cache.get(cache_key)
+        if value is not None:
+            self._touch(cache_key)
+        return value
+
+    def set(self, key, value):
+        cache_key = self._key(key)
+        cache.set(cache_key, value, timeout=self.timeout)
+        self._touch(cache_key)
+
+    def delete(self, key):
+        cache_key = self._key(key)
+        cache.delete(cache_key)
+        self._touch(cache_key, remove=True)
+
+    def __len__(self):
+        client, index_key = self._redis_index()
+        if client is not None:
+            return client.zcard(index_key)
+        return len(cache.get(self._index_key()) or [])
+
+
+def _sizeof(value, depth=0):
+    """
+    Rough estimate of the memory used by a cached value, in bytes.
+    """
+    import sys
+    import numpy as np
+    from scipy import sparse
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sparse.issparse(value):
+        return sum(getattr(value, x).nbytes for x in ('data', 'indices', 'indptr', 'row', 'col')
+                if hasattr(value, x))
+    if depth < 3:
+        if isinstance(value, (list, tuple)):
+            return sys.getsizeof(value) + sum(_sizeof(x, depth + 1) for x in value)
+        if isinstance(value, dict):
+            return sys.getsizeof(value) + sum(_sizeof(k, depth + 1) + _sizeof(v, depth + 1)
+                    for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+def _current_dataset_path():
+    """
+    Returns the path of the dataset that the current request (or background
+    task, see dataset_context) is for, or None.
+    """
+    from flask import g, has_app_context, has_request_context, request
+    if has_app_context() and g.get('l1_dataset_path') is not None:
+        return g.l1_dataset_path
+    if not has_request_context() or not request.view_args or 'user_id' not in request.view_args:
+        return None
+    from .interaction_views import user_id_to_path
+    g.l1_dataset_path = user_id_to_path(request.view_args['user_id'])
+    return g.l1_dataset_path
+
+
+def _dataset_version(path):
+    """
+    Returns the current version of the dataset at path. In a request, each
+    version is calculated once per request; background tasks calculate it
+    each time, since they can change the dataset.
+    """
+    from flask import g, has_request_context
+    from .utils import dataset_version
+    if not has_request_context():
+        return dataset_version(path)
+    if 'l1_versions' not in g:
+        g.l1_versions = {}
+    if path not in g.l1_versions:
+        g.l1_versions[path] = dataset_version(path)
+    return g.l1_versions[path]
+
+
+@contextmanager
+def dataset_context(path):
+    """
+    Tags the L1 entries of TwoTierRedisCache stored in this app context with
+    the dataset at path, so that they are dropped when the dataset changes.
+    Requests for a dataset (with a user_id view arg) are tagged
+    automatically; this is for background tasks, e.g. jobs and precompute.
+
+        with app.app_context(), dataset_context(path):
+            ...
+    """
+    from flask import g
+    previous = g.get('l1_dataset_path')
+    g.l1_dataset_path = path
+    try:
+        yield path
+    finally:
+        g.l1_dataset_path = previous
+
+
+def _freeze(value, depth=0):
+    """
+    Makes the numpy arrays in a value loaded from the cache read-only, so
+    that values shared through the L1 cache can't be modified by accident.
+    """
+    import numpy as np
+    from scipy import sparse
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif sparse.issparse(value):
+        for x in ('data', 'indices', 'indptr', 'row', 'col'):
+            if isinstance(getattr(value, x, None), np.ndarray):
+                getattr(value, x).flags.writeable = False
+    elif depth < 3:
+        if isinstance(value, (list, tuple)):
+            for x in value:
+                _freeze(x, depth + 1)
+        elif isinstance(value, dict):
+            for x in value.values():
+                _freeze(x, depth + 1)
+
+
+class CompressedText(str):
+    """
+    A str loaded from a compressed cache value. The gzip-compressed utf-8
+    bytes are kept in .gzipped, so that the text can be served with
+    Content-Encoding: gzip (see gzip_response) or stored again without
+    compressing it again.
+    """
+
+
+def gzip_compress(data, level=1):
+    import zlib
+    # wbits=31 writes a gzip header, so that the bytes can be sent as-is
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    import zlib
+    return zlib.decompress(data, 31)
+
+
+def gzip_response(value):
+    """
+    Returns a response for a (json) string returned by a cached function.
+    If the value was loaded compressed from the cache and the client accepts
+    gzip, the compressed bytes are sent directly with Content-Encoding: gzip.
+    Otherwise, the value is returned unchanged.
+    """
+    from flask import request, make_response
+    gzipped = getattr(value, 'gzipped', None)
+    if gzipped is None or request.accept_encodings['gzip'] <= 0:
+        return value
+    response = make_response(gzipped)
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+try:
+    from flask_caching.backends.rediscache import RedisCache
+    from cachelib.serializers import RedisSerializer
+except ImportError:
+    RedisCache = None
+
+if RedisCache is not None:
+    class CompressingRedisSerializer(RedisSerializer):
+        """
+        Redis serializer that compresses values of at least min_bytes.
+
+        Strings (e.g. the plotly json returned by update_scatterplot_result)
+        are stored as gzip-compressed utf-8 and loaded as CompressedText;
+        other values are stored as zlib-compressed pickles. The number of
+        bytes before and after compression is recorded in self.stats.
+        """
+        # prefixes used to mark compressed values; uncompressed values start
+        # with '!' (pickles) or are ints.
+        GZIP_TEXT = b'g'
+        ZLIB_PICKLE = b'z'
+
+        def __init__(self, min_bytes=32*1024, level=1):
+            import threading
+            self.min_bytes = min_bytes
+            self.level = level
+            self.stats = {'values': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+            self._stats_lock = threading.Lock()
+
+        def _record(self, raw_bytes, compressed_bytes):
+            with self._stats_lock:
+                self.stats['values'] += 1
+                self.stats['raw_bytes'] += raw_bytes
+                self.stats['compressed_bytes'] += compressed_bytes
+
+        def compression_ratio(self):
+            """Returns raw bytes / compressed bytes over all compressed values."""
+            if self.stats['compressed_bytes'] == 0:
+                return None
+            return float(self.stats['raw_bytes'])/self.stats['compressed_bytes']
+
+        def compress_text(self, value):
+            """
+            Returns value as a CompressedText, compressing it if it isn't one
+            already.
+            """
+            if getattr(value, 'gzipped', None) is not None:
+                return value
+            raw = value.encode('utf-8')
+            text = CompressedText(value)
+            text.gzipped = gzip_compress(raw, self.level)
+            self._record(len(raw), len(text.gzipped))
+            return text
+
+        def dumps(self, value, protocol=None):
+            import pickle
+            if protocol is None:
+                protocol = pickle.HIGHEST_PROTOCOL
+            if type(value) is int:
+                return RedisSerializer.dumps(self, value, protocol)
+            if isinstance(value, str) and len(value) >= self.min_bytes:
+                return self.GZIP_TEXT + self.compress_text(value).gzipped
+            dump = pickle.dumps(value, protocol)
+            if len(dump) >= self.min_bytes:
+                import zlib
+                compressed = zlib.compress(dump, self.level)
+                self._record(len(dump), len(compressed))
+                if len(compressed) < len(dump):
+                    return self.ZLIB_PICKLE + compressed
+            return b'!' + dump
+
+        def loads(self, value):
+            if value is None:
+                return None
+            if value.startswith(self.GZIP_TEXT):
+                gzipped = value[1:]
+                text = CompressedText(gzip_decompress(gzipped).decode('utf-8'))
+                text.gzipped = gzipped
+                return text
+            if value.startswith(self.ZLIB_PICKLE):
+                import pickle
+                import zlib
+                return pickle.loads(zlib.decompress(value[1:]))
+            return RedisSerializer.loads(self, value)
+
+    class TwoTierRedisCache(RedisCache):
+        """
+        Redis cache with a size-bounded in-process cache (L1) in front of it,
+        so that large values (e.g. data matrices, pairwise diffexp arrays)
+        aren't fetched and unpickled from redis on every request.
+
+        Only values of at least CACHE_L1_MIN_BYTES are kept in L1, since
+        small values are cheap to fetch from redis. Values are put in L1 when
+        they are loaded from redis, and returned by reference afterwards, so
+        they must not be modified by the caller: numpy arrays (and the arrays
+        of sparse matrices) in L1 are made read-only, and other mutable
+        values (lists, dicts) are shared by all requests of the worker.
+        Strings are also put in L1 when they are set.
+
+        L1 entries are dropped when:
+            - they expire: each entry keeps the expiry time of its redis key.
+            - the L1 size (estimated in bytes) exceeds CACHE_L1_MAX_BYTES,
+              least recently used first.
+            - the dataset they were stored for (the dataset of the request,
+              or of dataset_context) has a different version (see
+              utils.dataset_version).
+            - any worker deletes a large key or clears the cache; this is
+              signalled through a generation key in redis, which is checked
+              at most every CACHE_L1_CHECK_INTERVAL seconds.
+
+        Values of at least CACHE_COMPRESS_MIN_BYTES are compressed in redis
+        at zlib level CACHE_COMPRESS_LEVEL (see CompressingRedisSerializer).
+
+        To use: set CACHE_TYPE to 'uncurl_app.cache.TwoTierRedisCache'.
+        """
+        GENERATION_KEY = '_l1_generation'
+
+        def __init__(self, *args, **kwargs):
+            import collections
+            import threading
+            self.l1_max_bytes = kwargs.pop('l1_max_bytes', 256*1024*1024)
+            self.l1_min_bytes = kwargs.pop('l1_min_bytes', 64*1024)
+            self.l1_check_interval = kwargs.pop('l1_check_interval', 1.0)
+            compress_min_bytes = kwargs.pop('compress_min_bytes', 32*1024)
+            compress_level = kwargs.pop('compress_level', 1)
+            RedisCache.__init__(self, *args, **kwargs)
+            self.serializer = CompressingRedisSerializer(compress_min_bytes,
+                    compress_level)
+            self._l1 = collections.OrderedDict()
+            self._l1_bytes = 0
+            self._l1_lock = threading.RLock()
+            self._l1_generation = None
+            self._l1_last_check = 0
+
+        @classmethod
+        def factory(cls, app, config, args, kwargs):
+            kwargs['l1_max_bytes'] = config.get('CACHE_L1_MAX_BYTES', 256*1024*1024)
+            kwargs['l1_min_bytes'] = config.get('CACHE_L1_MIN_BYTES', 64*1024)
+            kwargs['l1_check_interval'] = config.get('CACHE_L1_CHECK_INTERVAL', 1.0)
+            kwargs['compress_min_bytes'] = config.get('CACHE_COMPRESS_MIN_BYTES', 32*1024)
+            kwargs['compress_level'] = config.get('CACHE_COMPRESS_LEVEL', 1)
+            return super(TwoTierRedisCache, cls).factory(app, config, args, kwargs)
+
+        def _read_generation(self):
+            return self._read_client.get(self._get_prefix() + self.GENERATION_KEY)
+
+        def _bump_generation(self):
+            import uuid
+            generation = uuid.uuid4().hex
+            self._write_client.set(self._get_prefix() + self.GENERATION_KEY,
+                    generation)
+            self._l1_generation = generation.encode()
+
+        def _is_large(self, key):
+            # only large values can be in the L1 of other workers
+            key = self._get_prefix() + key
+            size = self._read_client.strlen(key)
+            if size >= self.l1_min_bytes:
+                return True
+            # compressed values can be large after decompression
+            return size > 0 and self._read_client.getrange(key, 0, 0) in \
+                    (CompressingRedisSerializer.GZIP_TEXT, CompressingRedisSerializer.ZLIB_PICKLE)
+
+        def _check_generation(self):
+            import time
+            now = time.time()
+            if now - self._l1_last_check < self.l1_check_interval:
+                return
+            self._l1_last_check = now
+            generation = self._read_generation()
+            if generation != self._l1_generation:
+                self._l1_clear()
+                self._l1_generation = generation
+
+        def _redis_expiry(self, key):
+            """
+            Returns the expiry time of a key in redis, or None if it
+            doesn't expire.
+            """
+            import time
+            ttl = self._read_client.pttl(self._get_prefix() + key)
+            if ttl is None or ttl < 0:
+                return None
+            return time.time() + ttl/1000.0
+
+        def _l1_clear(self):
+            with self._l1_lock:
+                self._l1.clear()
+                self._l1_bytes = 0
+
+        def _l1_pop(self, key):
+            with self._l1_lock:
+                entry = self._l1.pop(key, None)
+                if entry is not None:
+                    self._l1_bytes -= entry[1]
+
+        def _l1_put(self, key, value, expires=False):
+            """
+            Puts a value in L1, with the given expiry time (None if it
+            doesn't expire), or the expiry time of the key in redis if
+            expires is False.
+            """
+            size = _sizeof(value)
+            if size < self.l1_min_bytes or size > self.l1_max_bytes:
+                return
+            if expires is False:
+                expires = self._redis_expiry(key)
+            path = _current_dataset_path()
+            dataset = None if path is None else (path, _dataset_version(path))
+            with self._l1_lock:
+                self._l1_pop(key)
+                self._l1[key] = (value, size, dataset, expires)
+                self._l1_bytes += size
+                while self._l1_bytes > self.l1_max_bytes:
+                    k, entry = self._l1.popitem(last=False)
+                    self._l1_bytes -= entry[1]
+
+        def _l1_get(self, key):
+            """
+            Returns the L1 entry for a key, or None if there is no entry or
+            it is out of date.
+            """
+            import time
+            with self._l1_lock:
+                entry = self._l1.get(key)
+            if entry is None:
+                return None
+            value, size, dataset, expires = entry
+            if (expires is not None and time.time() >= expires) or \
+                    (dataset is not None and _dataset_version(dataset[0]) != dataset[1]):
+                self._l1_pop(key)
+                return None
+            with self._l1_lock:
+                if key in self._l1:
+                    self._l1.move_to_end(key)
+            return entry
+
+        def l1_stats(self):
+            """Returns the number of entries and estimated bytes in L1."""
+            return len(self._l1), self._l1_bytes
+
+        def compression_stats(self):
+            """
+            Returns a dict with the number of values compressed by this
+            worker, their total bytes before and after compression, and the
+            compression ratio.
+            """
+            stats = dict(self.serializer.stats)
+            stats['ratio'] = self.serializer.compression_ratio()
+            return stats
+
+        def get(self, key):
+            self._check_generation()
+            entry = self._l1_get(key)
+            if entry is not None:
+                return entry[0]
+            value = RedisCache.get(self, key)
+            if value is not None:
+                _freeze(value)
+                self._l1_put(key, value)
+            return value
+
+        def set(self, key, value, timeout=None):
+            import time
+            if isinstance(value, str) and len(value) >= self.serializer.min_bytes:
+                # keep the compressed bytes in L1 too, for gzip_response
+                value = self.serializer.compress_text(value)
+            result = RedisCache.set(self, key, value, timeout=timeout)
+            if isinstance(value, str):
+                timeout = self._normalize_timeout(timeout)
+                self._l1_put(key, value, None if timeout <= 0 else time.time() + timeout)
+            else:
+                # the caller still has a reference to the value, and can
+                # modify it; it's put in L1 when it's loaded from redis.
+                self._l1_pop(key)
+            return result
+
+        def add(self, key, value, timeout=None):
+            result = RedisCache.add(self, key, value, timeout=timeout)
+            self._l1_pop(key)
+            return result
+
+        def delete(self, key):
+            self._l1_pop(key)
+            is_large = self._is_large(key)
+            result = RedisCache.delete(self, key)
+            if is_large:
+                self._bump_generation()
+            return result
+
+        def delete_many(self, *keys):
+            for key in keys:
+                self._l1_pop(key)
+            is_large = any(self._is_large(key) for key in keys)
+            result = RedisCache.delete_many(self, *keys)
+            if is_large:
+                self._bump_generation()
+            return result
+
+        def clear(self):
+            self._l1_clear()
+            result = RedisCache.clear(self)
+            self._bump_generation()
+            return result
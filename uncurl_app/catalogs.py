@@ -0,0 +1,137 @@
+# Catalogs of the cell type databases (cell type names, the MeSH anatomy
+# tree), which don't change while the app is running.
+#
+# Each catalog is loaded once per process, the first time it's used, and
+# kept as an immutable value together with its json encoding, the gzipped
+# json and an ETag, so that it can be sent without being rebuilt or
+# recompressed on each request.
+
+import hashlib
+import json
+import threading
+
+from .cache import gzip_compress
+from .utils import SimpleEncoder
+
+# seconds that clients can use a catalog without revalidating it
+MAX_AGE = 3600
+
+
+def _sorted_names(id_names):
+    return tuple(sorted(x[1] for x in id_names))
+
+
+def load_cellmarker():
+    import cellmarker
+    return tuple(sorted(cellmarker.get_all_cells()))
+
+
+def load_cellmesh():
+    import cellmesh
+    return _sorted_names(cellmesh.get_all_cell_id_names(include_cell_components=False))
+
+
+def load_cellmesh_anatomy():
+    import cellmesh
+    return _sorted_names(cellmesh.get_all_cell_id_names(db_dir=cellmesh.ANATOMY_DB_DIR,
+        include_cell_components=False))
+
+
+def load_kegg():
+    import kegg_query
+    return tuple(sorted(kegg_query.get_all_cells(species='all')))
+
+
+def load_anatomy_names():
+    import cellmesh
+    return tuple(x[1] for x in cellmesh.get_all_cell_id_names(db_dir=cellmesh.ANATOMY_DB_DIR,
+        include_cell_lines=True, include_chromosomes=True))
+
+
+def load_cell_names():
+    import cellmesh
+    return tuple(x[1] for x in cellmesh.get_all_cell_id_names(include_cell_components=False))
+
+
+def load_mesh_tree():
+    import cellmesh
+    tree, id_to_name = cellmesh.get_cellmesh_anatomy_tree()
+    return {'tree': tree, 'id_to_name': id_to_name}
+
+
+LOADERS = {
+        # sorted cell types of each database, see db_query.get_all_cell_types
+        'cellmarker': load_cellmarker,
+        'cellmesh': load_cellmesh,
+        'cellmesh_anatomy': load_cellmesh_anatomy,
+        'kegg': load_kegg,
+        # names for the cellmesh inputs in the main view and db query index
+        'anatomy_names': load_anatomy_names,
+        'cell_names': load_cell_names,
+        'mesh_tree': load_mesh_tree,
+}
+
+
+class Catalog(object):
+    """
+    A loaded catalog.
+
+    Attributes:
+        value: the catalog (a tuple of names, or a dict for mesh_tree). This
+            is shared by all requests and must not be modified.
+        json (bytes): utf-8 json encoding of value
+        gzipped (bytes): gzip-compressed json
+        etag (str): hash of the json
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.json = json.dumps(value, cls=SimpleEncoder).encode('utf-8')
+        self.gzipped = gzip_compress(self.json, 9)
+        self.etag = hashlib.sha1(self.json).hexdigest()
+
+
+_catalogs = {}
+_lock = threading.Lock()
+
+
+def get_catalog(name):
+    """
+    Returns the Catalog with the given name, loading it the first time it's
+    used in this process.
+    """
+    if name not in _catalogs:
+        with _lock:
+            if name not in _catalogs:
+                _catalogs[name] = Catalog(LOADERS[name]())
+    return _catalogs[name]
+
+
+def get(name):
+    """
+    Returns the value of a catalog.
+    """
+    return get_catalog(name).value
+
+
+def json_response(name):
+    """
+    Returns a response with the json of a catalog, gzipped if the client
+    accepts gzip, with an ETag so that clients can revalidate it with
+    If-None-Match.
+    """
+    from flask import request, make_response
+    catalog = get_catalog(name)
+    if request.accept_encodings['gzip'] > 0:
+        response = make_response(catalog.gzipped)
+        response.headers['Content-Encoding'] = 'gzip'
+        # the gzipped and plain responses need different etags
+        response.set_etag(catalog.etag + '-gzip')
+    else:
+        response = make_response(catalog.json)
+        response.set_etag(catalog.etag)
+    response.mimetype = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    return response.make_conditional(request)
@@ -4,6 +4,8 @@ import json
 
 from flask import request, render_template, Blueprint
 
+from . import catalogs
+from .cache import cache
 from .utils import SimpleEncoder
 
 db_query = Blueprint('db_query', __name__,
@@ -16,12 +18,8 @@ def pmid_to_link(pmid):
 @db_query.route('/db_query')
 def db_query_index():
     # TODO: get anatomy terms?
-    import cellmesh
-    anatomy_id_names = cellmesh.get_all_cell_id_names(db_dir=cellmesh.ANATOMY_DB_DIR,
-            include_cell_lines=True, include_chromosomes=True)
-    anatomy_names = [x[1] for x in anatomy_id_names]
     return render_template('db_query_index.html',
-            anatomy_names=anatomy_names)
+            anatomy_names=catalogs.get('anatomy_names'))
 
 
 @db_query.route('/db_query/submit', methods=['POST'])
@@ -107,10 +105,36 @@ def db_query_submit():
         print(text)
         return 'Error: ' + str(e)
 
+@cache.memoize()
+def get_cellmarker_cell_genes(cell_type, cells_or_tissues, species):
+    """
+    Returns the list of CellMarker genes for a cell type.
+    """
+    import cellmarker
+    return list(cellmarker.get_cell_genes(cell_type, cells_or_tissues=cells_or_tissues, species=species))
+
+@cache.memoize()
+def get_cellmarker_cell_papers(cell_type, cells_or_tissues, species, start=0, end=None):
+    """
+    Returns rows of [cell type, gene, PMID links] for the genes start:end of
+    a cell type, so that a page of genes can be looked up without looking up
+    all genes of the cell type.
+    """
+    import cellmarker
+    genes = get_cellmarker_cell_genes(cell_type, cells_or_tissues, species)
+    papers = []
+    for g in genes[start:end]:
+        pmids = cellmarker.get_papers_cell_gene(cell_type, g, species=species)
+        papers.append([cell_type, g, ', '.join([pmid_to_link(p) for p in pmids])])
+    return papers
+
 @db_query.route('/db_query/cell_info', methods=['POST'])
 def get_cell_info():
     """
     Returns all genes/pmids associated with a cell type, ranked in order of hits, that pass a certain threshold.
+
+    If page_size is given, only the rows for page (starting at 0) are
+    returned, after the header.
     """
     # TODO
     db = request.form['database_select']
@@ -118,21 +142,26 @@ def get_cell_info():
         mode = request.form['mode']
     else:
         mode = 'gene_papers'
+    page = int(request.form.get('page', 0))
+    page_size = request.form.get('page_size', '')
+    if page_size:
+        start = page*int(page_size)
+        end = start + int(page_size)
+    else:
+        start = 0
+        end = None
     try:
         if db == 'cellmarker':
             cell_type = request.form['cellmarker_cell_type']
             cells_or_tissues = request.form['cells_or_tissues']
             species = request.form['species']
-            import cellmarker
-            genes = cellmarker.get_cell_genes(cell_type, cells_or_tissues=cells_or_tissues, species=species)
-            papers = []
-            for g in genes:
-                pmids = cellmarker.get_papers_cell_gene(cell_type, g, species=species)
-                papers.append([cell_type, g, ', '.join([pmid_to_link(p) for p in pmids])])
             if mode == 'gene_papers':
                 header = ['Cell type', 'Gene', 'PMIDs']
-                result = [header] + papers #[[cell_type, ', '.join(genes), '']]
+                papers = get_cellmarker_cell_papers(cell_type, cells_or_tissues, species,
+                        start, end)
+                return json.dumps([header] + papers, cls=SimpleEncoder)
             else:
+                genes = get_cellmarker_cell_genes(cell_type, cells_or_tissues, species)
                 result = [['Genes']] + [[x] for x in genes]
         elif db == 'cellmesh':
             cell_type = request.form['cellmesh_cell_type']
@@ -173,6 +202,7 @@ def get_cell_info():
             genes = kegg_query.get_cell_genes(cell_type, species=species)
             genes = genes[0]
             result = [['Genes']] + [[g] for g in genes]
+        result = result[:1] + result[1:][start:end]
         return json.dumps(result, cls=SimpleEncoder)
     except Exception as e:
         import traceback
@@ -185,23 +215,16 @@ def get_mesh_tree():
     """
     Returns a tree of all mesh terms.
     """
-    # TODO
-    import cellmesh
-    tree, id_to_name = cellmesh.get_cellmesh_anatomy_tree()
-    new_tree = {}
-    def process_tree(key, children, new_parent):
-        new_key = (key, id_to_name[key])
-        new_node = {}
-        new_parent[new_key] = new_node
-        for k, v in children.items():
-            process_tree(k, v, new_node)
-    for k, v in tree.items():
-        process_tree(k, v, new_tree)
-    results_dict = {
-            'tree': tree,
-            'id_to_name': id_to_name
-    }
-    return json.dumps(results_dict, cls=SimpleEncoder)
+    return catalogs.json_response('mesh_tree')
+
+@db_query.route('/db_query/catalog/<name>')
+def get_catalog(name):
+    """
+    Returns a catalog (see catalogs.LOADERS) as json.
+    """
+    if name not in catalogs.LOADERS:
+        return 'Error: unknown catalog ' + name, 404
+    return catalogs.json_response(name)
 
 @db_query.route('/db_query_genes')
 def db_query_genes():
@@ -221,7 +244,11 @@ def get_all_cell_types(query, species='all'):
     (not GO because there are plenty of other tools for GO)
 
     species only matters for kegg, not cellmarker or cellmesh (which share cell types between species)
+
+    The lists for species='all' are loaded once per process (see catalogs.py).
     """
+    if species == 'all':
+        return list(catalogs.get(query))
     if query == 'cellmarker':
         import cellmarker
         cells = cellmarker.get_all_cells()
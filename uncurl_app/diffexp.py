@@ -0,0 +1,718 @@
+# differential expression calculated directly from the sparse data matrix,
+# without going through SCAnalysis.calculate_diffexp.
+#
+# All groups are handled at once: per-group sums, sums of squares and nonzero
+# counts are calculated by multiplying the data matrix with a sparse
+# cells x groups indicator matrix, and all test statistics are derived from
+# those group statistics.
+
+import hashlib
+import os
+
+import numpy as np
+from scipy import sparse
+import scipy.stats
+
+# number of genes per block when splitting work across processes
+BLOCK_SIZE = 2000
+
+
+class GroupStats(object):
+    """
+    Per-group sufficient statistics for a data matrix of shape (genes, cells).
+
+    Attributes:
+        label_values (array): sorted unique labels, length k
+        counts (array): number of cells in each group, length k
+        sums (array): array of shape (genes, k), sum of each gene in each group
+        sq_sums (array): array of shape (genes, k), sum of squares
+        nnz (array): array of shape (genes, k), number of nonzero cells
+    """
+
+    def __init__(self, label_values, counts, sums, sq_sums, nnz):
+        self.label_values = np.asarray(label_values)
+        self.counts = np.asarray(counts, dtype=float)
+        self.sums = sums
+        self.sq_sums = sq_sums
+        self.nnz = nnz
+
+    @property
+    def k(self):
+        return len(self.label_values)
+
+    @property
+    def genes(self):
+        return self.sums.shape[0]
+
+    def means(self):
+        """Returns an array of shape (genes, k)."""
+        return self.sums/np.maximum(self.counts, 1)
+
+    def variances(self):
+        """Returns the sample variances, an array of shape (genes, k)."""
+        return _variance(self.sums, self.sq_sums, self.counts)
+
+    def gene_block(self, start, end):
+        """Returns a GroupStats object containing only genes start:end."""
+        return GroupStats(self.label_values, self.counts,
+                self.sums[start:end], self.sq_sums[start:end], self.nnz[start:end])
+
+    def subset(self, indices):
+        """Returns a GroupStats object containing only the given groups."""
+        return GroupStats(self.label_values[indices], self.counts[indices],
+                self.sums[:, indices], self.sq_sums[:, indices], self.nnz[:, indices])
+
+    def save(self, filename):
+        np.savez(filename, label_values=self.label_values,
+                counts=self.counts, sums=self.sums, sq_sums=self.sq_sums,
+                nnz=self.nnz)
+
+    @classmethod
+    def load(cls, filename):
+        f = np.load(filename)
+        return cls(f['label_values'], f['counts'], f['sums'], f['sq_sums'], f['nnz'])
+
+
+def _variance(sums, sq_sums, counts):
+    var = (sq_sums - sums**2/np.maximum(counts, 1))/np.maximum(counts - 1, 1)
+    var[var < 0] = 0
+    return var
+
+
+def _to_array(x):
+    if sparse.issparse(x):
+        return x.toarray()
+    return np.asarray(x)
+
+
+def indicator_matrix(labels):
+    """
+    Returns the sorted unique labels, and a sparse matrix of shape
+    (cells, k) where entry (i, j) is 1 if cell i has label j.
+    """
+    label_values, label_ids = np.unique(np.asarray(labels), return_inverse=True)
+    n = len(label_ids)
+    indicator = sparse.csc_matrix((np.ones(n), (np.arange(n), label_ids)),
+            shape=(n, len(label_values)))
+    return label_values, indicator
+
+
+def _block_stats(block, indicator):
+    """
+    Returns sums, sums of squares, and nonzero counts for each group,
+    for a block of genes.
+    """
+    if sparse.issparse(block):
+        nonzero = block.copy()
+        nonzero.data = np.ones(len(nonzero.data))
+        sq = block.multiply(block)
+    else:
+        block = np.asarray(block)
+        nonzero = (block != 0).astype(float)
+        sq = block**2
+    sums = _group_dot(block, indicator)
+    sq_sums = _group_dot(sq, indicator)
+    nnz = _group_dot(nonzero, indicator)
+    return sums, sq_sums, nnz
+
+
+def _group_dot(block, indicator):
+    """
+    Returns block.dot(indicator) as an array. A dense block is multiplied
+    from the sparse side, since ndarray.dot doesn't support sparse matrices.
+    """
+    if sparse.issparse(block):
+        return _to_array(block.dot(indicator))
+    return _to_array(indicator.T.dot(block.T)).T
+
+
+def _map_blocks(func, args_list, n_jobs=1):
+    """
+    Runs func on every tuple of arguments in args_list, using a process pool
+    if n_jobs > 1. Returns the results in order.
+    """
+    if n_jobs is None or n_jobs <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(args_list))) as executor:
+        return list(executor.map(func, *zip(*args_list)))
+
+
+def _gene_blocks(genes, block_size=BLOCK_SIZE):
+    return [(i, min(i + block_size, genes)) for i in range(0, genes, block_size)]
+
+
+def calculate_group_stats(data, labels, n_jobs=1, block_size=BLOCK_SIZE):
+    """
+    Calculates GroupStats for a data matrix and a 1d array of labels.
+
+    Args:
+        data (array or sparse matrix): array of shape (genes, cells)
+        labels (array): 1d array of length cells
+        n_jobs (int): number of processes to use. Genes are split into
+            blocks of block_size, and each block is handled by one process.
+    """
+    label_values, indicator = indicator_matrix(labels)
+    if sparse.issparse(data):
+        data = sparse.csr_matrix(data)
+    blocks = _gene_blocks(data.shape[0], block_size)
+    results = _map_blocks(_block_stats,
+            [(data[start:end], indicator) for start, end in blocks],
+            n_jobs)
+    sums = np.vstack([r[0] for r in results])
+    sq_sums = np.vstack([r[1] for r in results])
+    nnz = np.vstack([r[2] for r in results])
+    counts = np.array(indicator.sum(0)).flatten()
+    return GroupStats(label_values, counts, sums, sq_sums, nnz)
+
+
+def data_signature(data, labels):
+    """
+    Returns a short hash identifying a data matrix and a labeling.
+    """
+    h = hashlib.sha1()
+    h.update(str(data.shape).encode())
+    if sparse.issparse(data):
+        h.update(str(data.nnz).encode())
+    h.update(repr(float(data.sum())).encode())
+    h.update('\n'.join(str(x) for x in labels).encode())
+    return h.hexdigest()[:16]
+
+
+def get_group_stats(data, labels, cache_dir=None, n_jobs=1):
+    """
+    Returns GroupStats for the given data and labels, loading them from
+    cache_dir if they have already been calculated.
+    """
+    if cache_dir is None:
+        return calculate_group_stats(data, labels, n_jobs=n_jobs)
+    filename = os.path.join(cache_dir,
+            'group_stats_{0}.npz'.format(data_signature(data, labels)))
+    if os.path.exists(filename):
+        try:
+            return GroupStats.load(filename)
+        except Exception as e:
+            print('could not load group stats:', e)
+    stats = calculate_group_stats(data, labels, n_jobs=n_jobs)
+    _makedirs(cache_dir)
+    stats.save(filename)
+    return stats
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        pass
+
+
+def fdr_correction(pvals):
+    """
+    Benjamini-Hochberg FDR correction, applied along the last axis.
+    """
+    pvals = np.asarray(pvals)
+    n = pvals.shape[-1]
+    if n == 0:
+        return pvals
+    order = np.argsort(pvals, axis=-1)
+    ranked = np.take_along_axis(pvals, order, axis=-1)*n/np.arange(1, n + 1)
+    ranked = np.flip(np.minimum.accumulate(np.flip(ranked, -1), axis=-1), -1)
+    fdr = np.empty(pvals.shape)
+    np.put_along_axis(fdr, order, np.minimum(ranked, 1.0), axis=-1)
+    return fdr
+
+
+def t_test_from_stats(m1, v1, n1, m2, v2, n2, eps=1e-8):
+    """
+    One-sided Welch's t-test that group 1 has a higher mean than group 2,
+    given per-gene means, variances, and group sizes. All inputs can be
+    arrays that broadcast against each other.
+
+    Returns an array of p-values.
+    """
+    n1 = np.maximum(n1, 1)
+    n2 = np.maximum(n2, 1)
+    a = v1/n1
+    b = v2/n2
+    t = (m1 - m2)/(np.sqrt(a + b) + eps)
+    # Welch-Satterthwaite degrees of freedom
+    df = (a + b)**2/np.maximum(a**2/np.maximum(n1 - 1, 1) + b**2/np.maximum(n2 - 1, 1), 1e-300)
+    df = np.maximum(df, 1)
+    return scipy.stats.t.sf(t, df)
+
+
+def _block_1_vs_rest(stats, rows=None, eps=1e-8):
+    total = stats.sums.sum(1, keepdims=True)
+    sq_total = stats.sq_sums.sum(1, keepdims=True)
+    n_total = stats.counts.sum()
+    if rows is not None:
+        stats = stats.subset(rows)
+    m = stats.means()
+    v = stats.variances()
+    n = stats.counts
+    n_rest = n_total - n
+    rest_sums = total - stats.sums
+    m_rest = rest_sums/np.maximum(n_rest, 1)
+    v_rest = _variance(rest_sums, sq_total - stats.sq_sums, n_rest)
+    ratios = (m + eps)/(m_rest + eps)
+    pvals = t_test_from_stats(m, v, n, m_rest, v_rest, n_rest)
+    return ratios.T, pvals.T
+
+
+def _block_pairwise(stats, rows=None, cols=None, eps=1e-8):
+    m = stats.means().T
+    v = stats.variances().T
+    n = stats.counts[:, np.newaxis]
+    m1, v1, n1 = (m, v, n) if rows is None else (m[rows], v[rows], n[rows])
+    m2, v2, n2 = (m, v, n) if cols is None else (m[cols], v[cols], n[cols])
+    ratios = (m1[:, np.newaxis, :] + eps)/(m2[np.newaxis, :, :] + eps)
+    pvals = t_test_from_stats(m1[:, np.newaxis, :], v1[:, np.newaxis, :], n1[:, np.newaxis],
+            m2[np.newaxis, :, :], v2[np.newaxis, :, :], n2[np.newaxis, :])
+    return ratios, pvals
+
+
+def one_vs_rest_from_stats(stats, use_fdr=False, n_jobs=1, rows=None):
+    """
+    Returns two arrays of shape (k, genes): ratios and p-values of each
+    group vs all other cells. If rows is given, only those groups are
+    tested, and the arrays have shape (len(rows), genes).
+    """
+    blocks = _gene_blocks(stats.genes)
+    results = _map_blocks(_block_1_vs_rest,
+            [(stats.gene_block(start, end), rows) for start, end in blocks], n_jobs)
+    ratios = np.hstack([r[0] for r in results])
+    pvals = np.hstack([r[1] for r in results])
+    if use_fdr:
+        pvals = fdr_correction(pvals)
+    return ratios, pvals
+
+
+def pairwise_from_stats(stats, use_fdr=False, n_jobs=1, rows=None, cols=None):
+    """
+    Returns two arrays of shape (k, k, genes): ratios and p-values of
+    group i vs group j. If rows or cols are given, only those groups are
+    used as group i or group j respectively.
+    """
+    blocks = _gene_blocks(stats.genes)
+    results = _map_blocks(_block_pairwise,
+            [(stats.gene_block(start, end), rows, cols) for start, end in blocks], n_jobs)
+    ratios = np.concatenate([r[0] for r in results], axis=2)
+    pvals = np.concatenate([r[1] for r in results], axis=2)
+    if use_fdr:
+        pvals = fdr_correction(pvals)
+    return ratios, pvals
+
+
+def pair_from_stats(stats, i, j, use_fdr=False, eps=1e-8):
+    """
+    Returns two arrays of shape (genes,): ratios and p-values of group i
+    vs group j, where i and j are indices into stats.label_values.
+    """
+    m = stats.means()
+    v = stats.variances()
+    n = stats.counts
+    ratios = (m[:, i] + eps)/(m[:, j] + eps)
+    pvals = t_test_from_stats(m[:, i], v[:, i], n[i], m[:, j], v[:, j], n[j])
+    if use_fdr:
+        pvals = fdr_correction(pvals)
+    return ratios, pvals
+
+
+def to_top_genes(label_values, ratios, pvals):
+    """
+    Converts arrays of shape (k, genes) into the format used by
+    SCAnalysis.calculate_diffexp: two dicts mapping labels to lists of
+    (gene_id, value), sorted by decreasing ratio or increasing p-value.
+    """
+    top_genes = {}
+    for i, label in enumerate(label_values):
+        label = label.item() if isinstance(label, np.generic) else label
+        order = np.argsort(ratios[i])[::-1]
+        top_genes[label] = list(zip(order.tolist(), ratios[i, order].tolist()))
+    return top_genes, to_top_pvals(label_values, pvals)
+
+
+def to_top_pvals(label_values, pvals):
+    """
+    Converts an array of p-values of shape (k, genes) into a dict mapping
+    labels to lists of (gene_id, pval), sorted by increasing p-value.
+    """
+    top_pvals = {}
+    for i, label in enumerate(label_values):
+        label = label.item() if isinstance(label, np.generic) else label
+        order = np.argsort(pvals[i])
+        top_pvals[label] = list(zip(order.tolist(), pvals[i, order].tolist()))
+    return top_pvals
+
+
+def calculate_diffexp(data, labels, mode='1_vs_rest', use_fdr=False,
+        cache_dir=None, n_jobs=1):
+    """
+    Calculates differential expression for all groups of the given labels.
+
+    Args:
+        data (array or sparse matrix): array of shape (genes, cells)
+        labels (array): 1d array of length cells
+        mode (str): '1_vs_rest' or 'pairwise'
+        use_fdr (bool): whether to FDR-correct the p-values
+        cache_dir (str or None): directory where group statistics and
+            results are stored as .npz files.
+        n_jobs (int): number of processes
+
+    Returns:
+        For '1_vs_rest', two dicts mapping each label to a list of
+        (gene_id, value). For 'pairwise', two arrays of shape (k, k, genes),
+        ordered by the sorted labels.
+    """
+    filename = _diffexp_filename(cache_dir, mode, data, labels, use_fdr)
+    label_values, ratios, pvals = _load_diffexp(filename)
+    if ratios is None:
+        stats = get_group_stats(data, labels, cache_dir, n_jobs=n_jobs)
+        label_values = stats.label_values
+        if mode == 'pairwise':
+            ratios, pvals = pairwise_from_stats(stats, use_fdr=use_fdr, n_jobs=n_jobs)
+        else:
+            ratios, pvals = one_vs_rest_from_stats(stats, use_fdr=use_fdr, n_jobs=n_jobs)
+        if filename is not None:
+            np.savez(filename, label_values=label_values, ratios=ratios, pvals=pvals)
+    if mode == 'pairwise':
+        return ratios, pvals
+    return to_top_genes(label_values, ratios, pvals)
+
+
+def _diffexp_filename(cache_dir, mode, data, labels, use_fdr=False):
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, '{0}_{1}{2}.npz'.format(
+        mode, data_signature(data, labels), '_fdr' if use_fdr else ''))
+
+
+def _load_diffexp(filename):
+    """
+    Returns label_values, ratios, pvals from a saved diffexp result, or
+    three Nones if the file doesn't exist.
+    """
+    if filename is not None and os.path.exists(filename):
+        try:
+            f = np.load(filename)
+            return f['label_values'], f['ratios'], f['pvals']
+        except Exception as e:
+            print('could not load diffexp:', e)
+    return None, None, None
+
+
+def load_diffexp(data, labels, mode='1_vs_rest', use_fdr=False, cache_dir=None):
+    """
+    Returns the result of calculate_diffexp if it has already been saved in
+    cache_dir, or None otherwise.
+    """
+    filename = _diffexp_filename(cache_dir, mode, data, labels, use_fdr)
+    label_values, ratios, pvals = _load_diffexp(filename)
+    if ratios is None:
+        return None
+    if mode == 'pairwise':
+        return ratios, pvals
+    return to_top_genes(label_values, ratios, pvals)
+
+
+def match_groups(old_labels, new_labels):
+    """
+    Finds the groups that contain exactly the same cells in two labelings
+    of the same cells.
+
+    Returns a dict mapping each unchanged new label to its old label.
+    """
+    old_labels = np.asarray(old_labels)
+    new_labels = np.asarray(new_labels)
+    old_values, old_ids = np.unique(old_labels, return_inverse=True)
+    new_values, new_ids = np.unique(new_labels, return_inverse=True)
+    old_counts = np.bincount(old_ids, minlength=len(old_values))
+    new_counts = np.bincount(new_ids, minlength=len(new_values))
+    # a new group is unchanged if all of its cells come from a single old
+    # group of the same size.
+    pairs, pair_counts = np.unique(np.vstack([new_ids, old_ids]), axis=1,
+            return_counts=True)
+    matches = {}
+    for (new_id, old_id), count in zip(pairs.T, pair_counts):
+        if count == new_counts[new_id] and count == old_counts[old_id]:
+            matches[new_values[new_id]] = old_values[old_id]
+    return matches
+
+
+def update_group_stats(stats, data, old_labels, new_labels, matches=None,
+        n_jobs=1):
+    """
+    Returns GroupStats for new_labels, re-using the statistics in stats
+    (calculated for old_labels) for groups whose cells did not change.
+    Only the cells in changed groups are read from data.
+    """
+    new_labels = np.asarray(new_labels)
+    if matches is None:
+        matches = match_groups(old_labels, new_labels)
+    label_values = np.unique(new_labels)
+    k = len(label_values)
+    sums = np.zeros((stats.genes, k))
+    sq_sums = np.zeros((stats.genes, k))
+    nnz = np.zeros((stats.genes, k))
+    counts = np.zeros(k)
+    changed = []
+    for i, label in enumerate(label_values):
+        if label in matches:
+            j = np.searchsorted(stats.label_values, matches[label])
+            sums[:, i] = stats.sums[:, j]
+            sq_sums[:, i] = stats.sq_sums[:, j]
+            nnz[:, i] = stats.nnz[:, j]
+            counts[i] = stats.counts[j]
+        else:
+            changed.append(i)
+    if changed:
+        cells = np.where(np.isin(new_labels, label_values[changed]))[0]
+        if sparse.issparse(data):
+            data = sparse.csc_matrix(data)
+        changed_stats = calculate_group_stats(data[:, cells], new_labels[cells],
+                n_jobs=n_jobs)
+        sums[:, changed] = changed_stats.sums
+        sq_sums[:, changed] = changed_stats.sq_sums
+        nnz[:, changed] = changed_stats.nnz
+        counts[changed] = changed_stats.counts
+    return GroupStats(label_values, counts, sums, sq_sums, nnz)
+
+
+def update_diffexp(data, old_labels, new_labels, use_fdr=False,
+        cache_dir=None, n_jobs=1):
+    """
+    Updates the saved group statistics and 1-vs-rest and pairwise results in
+    cache_dir after the labels change from old_labels to new_labels (e.g.
+    after splitting or merging clusters).
+
+    Only the statistics that involve changed groups are recalculated: the
+    pairwise entries between two unchanged groups, and the 1-vs-rest results
+    of unchanged groups if the set of cells is the same, are copied from the
+    results for old_labels. If there are no saved results for old_labels,
+    everything is calculated from scratch. Nothing is done if the number of
+    cells changed, or if cache_dir is None.
+    """
+    if cache_dir is None:
+        # there are no saved results to update
+        return
+    old_labels = np.asarray(old_labels)
+    new_labels = np.asarray(new_labels)
+    if len(old_labels) != len(new_labels):
+        # the set of cells changed, so nothing can be re-used; the results
+        # will be calculated by calculate_diffexp when they are needed.
+        return
+    old_stats_file = os.path.join(cache_dir,
+            'group_stats_{0}.npz'.format(data_signature(data, old_labels)))
+    matches = {}
+    if os.path.exists(old_stats_file):
+        old_stats = GroupStats.load(old_stats_file)
+        matches = match_groups(old_labels, new_labels)
+        stats = update_group_stats(old_stats, data, old_labels, new_labels,
+                matches=matches, n_jobs=n_jobs)
+    else:
+        stats = calculate_group_stats(data, new_labels, n_jobs=n_jobs)
+    _makedirs(cache_dir)
+    stats.save(os.path.join(cache_dir,
+        'group_stats_{0}.npz'.format(data_signature(data, new_labels))))
+    unchanged = [i for i, label in enumerate(stats.label_values) if label in matches]
+    changed = [i for i, label in enumerate(stats.label_values) if label not in matches]
+    for mode in ['1_vs_rest', 'pairwise']:
+        old_values, old_ratios, old_pvals = _load_diffexp(
+                _diffexp_filename(cache_dir, mode, data, old_labels, use_fdr))
+        if old_ratios is not None:
+            old_index = np.searchsorted(old_values,
+                    [matches[stats.label_values[i]] for i in unchanged])
+        if old_ratios is None or not unchanged:
+            if mode == 'pairwise':
+                ratios, pvals = pairwise_from_stats(stats, use_fdr=use_fdr, n_jobs=n_jobs)
+            else:
+                ratios, pvals = one_vs_rest_from_stats(stats, use_fdr=use_fdr, n_jobs=n_jobs)
+        elif mode == 'pairwise':
+            ratios = np.zeros((stats.k, stats.k, stats.genes))
+            pvals = np.zeros((stats.k, stats.k, stats.genes))
+            ix = np.ix_(unchanged, unchanged)
+            old_ix = np.ix_(old_index, old_index)
+            ratios[ix] = old_ratios[old_ix]
+            pvals[ix] = old_pvals[old_ix]
+            if changed:
+                # rows for the changed groups vs all groups, and columns
+                # for all groups vs the changed groups.
+                r, p = pairwise_from_stats(stats, use_fdr=use_fdr, n_jobs=n_jobs,
+                        rows=changed)
+                ratios[changed] = r
+                pvals[changed] = p
+                r, p = pairwise_from_stats(stats, use_fdr=use_fdr, n_jobs=n_jobs,
+                        rows=unchanged, cols=changed)
+                ratios[np.ix_(unchanged, changed)] = r
+                pvals[np.ix_(unchanged, changed)] = p
+        else:
+            ratios = np.zeros((stats.k, stats.genes))
+            pvals = np.zeros((stats.k, stats.genes))
+            ratios[unchanged] = old_ratios[old_index]
+            pvals[unchanged] = old_pvals[old_index]
+            if changed:
+                r, p = one_vs_rest_from_stats(stats, use_fdr=use_fdr, n_jobs=n_jobs,
+                        rows=changed)
+                ratios[changed] = r
+                pvals[changed] = p
+        np.savez(_diffexp_filename(cache_dir, mode, data, new_labels, use_fdr),
+                label_values=stats.label_values, ratios=ratios, pvals=pvals)
+
+
+def _block_rank_sums(block, label_ids, k):
+    """
+    Rank sums of each group for a block of genes, where all zeros share a
+    single tied rank, so that only the nonzero values are sorted.
+
+    The nonzero values of all genes in the block are ranked at once, by
+    sorting them by (gene, value), and the rank sums of each group are taken
+    as a product with the group indicator matrix, as in _block_stats.
+
+    Args:
+        block (sparse matrix): csr matrix of shape (genes, cells)
+        label_ids (array): 1d int array of length cells, values in 0..k-1
+        k (int): number of groups
+
+    Returns:
+        rank_sums (array): array of shape (genes, k)
+        tie_sums (array): array of shape (genes,), sum of t^3 - t over all
+            groups of tied values
+    """
+    block = sparse.csr_matrix(block, dtype=float)
+    block.eliminate_zeros()
+    block.sort_indices()
+    genes, n = block.shape
+    values = block.data
+    nnz_per_gene = np.diff(block.indptr)
+    rows = np.repeat(np.arange(genes), nnz_per_gene)
+    n_zeros = n - nnz_per_gene
+    # sort the nonzero values by gene, then value, and find the groups of
+    # tied values in each gene.
+    order = np.lexsort((values, rows))
+    sorted_values = values[order]
+    sorted_rows = rows[order]
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (sorted_rows[1:] != sorted_rows[:-1]) | \
+            (sorted_values[1:] != sorted_values[:-1])
+    group_ids = np.cumsum(new_group) - 1
+    group_starts = np.flatnonzero(new_group)
+    ties = np.diff(np.append(group_starts, len(order))).astype(float)
+    # average rank of each group of ties among the nonzero values of its
+    # gene (1-based), then shifted past the zeros for positive values.
+    group_rows = sorted_rows[group_starts]
+    group_ranks = group_starts - block.indptr[group_rows] + (ties + 1)/2.0
+    positive = sorted_values[group_starts] > 0
+    group_ranks[positive] += n_zeros[group_rows[positive]]
+    ranks = np.empty(len(order))
+    ranks[order] = group_ranks[group_ids]
+    indicator = sparse.csc_matrix((np.ones(n), (np.arange(n), label_ids)),
+            shape=(n, k))
+    nonzero = sparse.csr_matrix((np.ones(len(values)), block.indices, block.indptr),
+            shape=block.shape)
+    nonzero_sums = _group_dot(sparse.csr_matrix((ranks, block.indices, block.indptr),
+        shape=block.shape), indicator)
+    zero_counts = np.bincount(label_ids, minlength=k) - _group_dot(nonzero, indicator)
+    n_neg = np.bincount(rows[values < 0], minlength=genes)
+    rank_sums = nonzero_sums + zero_counts*(n_neg + (n_zeros + 1)/2.0)[:, np.newaxis]
+    tie_sums = np.bincount(group_rows, weights=ties**3 - ties, minlength=genes) + \
+            n_zeros.astype(float)**3 - n_zeros
+    return rank_sums, tie_sums
+
+
+def _rank_sum_pvals(rank_sums, tie_sums, n1, n2):
+    """
+    One-sided p-values (group 1 greater) for the Mann-Whitney U test, using
+    the normal approximation with tie and continuity correction.
+    """
+    n = n1 + n2
+    u = rank_sums - n1*(n1 + 1)/2.0
+    mu = n1*n2/2.0
+    sigma = np.sqrt(n1*n2/12.0*((n + 1) - tie_sums/np.maximum(n*(n - 1), 1)))
+    z = (u - mu - 0.5)/np.maximum(sigma, 1e-8)
+    return scipy.stats.norm.sf(z)
+
+
+def _wilcoxon_blocks(data, label_ids, k, n_jobs=1, block_size=BLOCK_SIZE):
+    data = sparse.csr_matrix(data)
+    blocks = _gene_blocks(data.shape[0], block_size)
+    results = _map_blocks(_block_rank_sums,
+            [(data[start:end], label_ids, k) for start, end in blocks], n_jobs)
+    rank_sums = np.vstack([r[0] for r in results])
+    tie_sums = np.concatenate([r[1] for r in results])
+    return rank_sums, tie_sums
+
+
+def wilcoxon_1_vs_rest(data, labels, use_fdr=False, n_jobs=1):
+    """
+    Wilcoxon rank-sum test of each group vs all other cells.
+
+    Returns the sorted unique labels, and an array of shape (k, genes)
+    containing p-values that each gene is higher in the group than in the
+    rest of the cells.
+    """
+    label_values, label_ids = np.unique(np.asarray(labels), return_inverse=True)
+    k = len(label_values)
+    rank_sums, tie_sums = _wilcoxon_blocks(data, label_ids, k, n_jobs)
+    n1 = np.bincount(label_ids, minlength=k).astype(float)
+    n2 = len(label_ids) - n1
+    pvals = _rank_sum_pvals(rank_sums, tie_sums[:, np.newaxis], n1, n2).T
+    if use_fdr:
+        pvals = fdr_correction(pvals)
+    return label_values, pvals
+
+
+def wilcoxon_pair(data, labels, label1, label2, use_fdr=False, n_jobs=1):
+    """
+    Wilcoxon rank-sum test of label1 vs label2.
+
+    Returns a 1d array of length genes, containing p-values that each gene
+    is higher in label1 than in label2.
+    """
+    labels = np.asarray(labels)
+    cells = (labels == label1) | (labels == label2)
+    label_ids = (labels[cells] == label2).astype(int)
+    rank_sums, tie_sums = _wilcoxon_blocks(data[:, cells], label_ids, 2, n_jobs)
+    n1 = float((label_ids == 0).sum())
+    n2 = float((label_ids == 1).sum())
+    pvals = _rank_sum_pvals(rank_sums[:, 0], tie_sums, n1, n2)
+    if use_fdr:
+        pvals = fdr_correction(pvals)
+    return pvals
+
+
+def selection_diffexp(data, cells_1, cells_2, use_fdr=False, eps=1e-8):
+    """
+    Differential expression between two arbitrary cell selections, which
+    may overlap.
+
+    Args:
+        data (array or sparse matrix): array of shape (genes, cells)
+        cells_1 (array): boolean mask of length cells
+        cells_2 (array): boolean mask of length cells
+
+    Returns:
+        ratios (array): 1d array of length genes, mean ratios of selection 1 to selection 2
+        pvals_1 (array): p-values that each gene is higher in selection 1
+        pvals_2 (array): p-values that each gene is higher in selection 2
+    """
+    n = data.shape[1]
+    cells_1 = np.asarray(cells_1, dtype=bool)
+    cells_2 = np.asarray(cells_2, dtype=bool)
+    rows = np.concatenate([np.flatnonzero(cells_1), np.flatnonzero(cells_2)])
+    cols = np.concatenate([np.zeros(cells_1.sum(), dtype=int), np.ones(cells_2.sum(), dtype=int)])
+    indicator = sparse.csc_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, 2))
+    if sparse.issparse(data):
+        data = sparse.csr_matrix(data)
+    sums, sq_sums, nnz = _block_stats(data, indicator)
+    stats = GroupStats(np.array([1, 2]), [cells_1.sum(), cells_2.sum()],
+            sums, sq_sums, nnz)
+    m = stats.means()
+    v = stats.variances()
+    n1, n2 = stats.counts
+    ratios = (m[:, 0] + eps)/(m[:, 1] + eps)
+    pvals_1 = t_test_from_stats(m[:, 0], v[:, 0], n1, m[:, 1], v[:, 1], n2)
+    pvals_2 = t_test_from_stats(m[:, 1], v[:, 1], n2, m[:, 0], v[:, 0], n1)
+    if use_fdr:
+        pvals_1 = fdr_correction(pvals_1)
+        pvals_2 = fdr_correction(pvals_2)
+    return ratios, pvals_1, pvals_2
@@ -0,0 +1,304 @@
+# Client for the Enrichr API (https://maayanlab.cloud/Enrichr/).
+#
+# The client used by the app is created by get_client, from the
+# ENRICHR_URL and ENRICHR_TIMEOUT config values, unless a client object is
+# set in ENRICHR_CLIENT. ENRICHR_URL can point to the local stand-in
+# server in test/fake_enrichr.py for offline testing.
+#
+# Gene list ids and results are cached in bounded LRUs shared by all workers
+# (see cache.SharedLRU).
+#
+# Requests from the views go through start_enrich, which runs queries in a
+# thread pool shared by all requests of a worker, with a deadline for the
+# whole query (ENRICHR_DEADLINE). If the query is not done after a short
+# wait, a 'pending' response is returned and the client polls by repeating
+# the request. A circuit breaker shared by all workers makes queries fail
+# fast after repeated failures.
+
+import json
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from .cache import SharedLRU, cache
+
+DEFAULT_URL = 'https://maayanlab.cloud/Enrichr'
+# timeout for each request, and deadline for a whole query (adding the gene
+# list and getting the results), in seconds
+DEFAULT_TIMEOUT = 10
+DEFAULT_DEADLINE = 20
+# number of threads used for queries in each worker
+DEFAULT_THREADS = 4
+# how long a request waits for a query before returning a 'pending' response
+WAIT_TIME = 3
+# how long a failed query's error is kept for polling requests
+ERROR_TIMEOUT = 30
+
+# Enrichr gene list ids are kept for a day, results for a week.
+LIST_ID_TIMEOUT = 24*3600
+RESULT_TIMEOUT = 7*24*3600
+MAX_ENTRIES = 2000
+
+# number of results kept for each query
+NUM_RESULTS = 10
+
+list_ids = SharedLRU('enrichr_list_ids', max_entries=MAX_ENTRIES,
+        timeout=LIST_ID_TIMEOUT)
+results_cache = SharedLRU('enrichr_results', max_entries=MAX_ENTRIES,
+        timeout=RESULT_TIMEOUT)
+
+
+class EnrichrError(Exception):
+    pass
+
+
+class EnrichrTimeout(EnrichrError):
+    pass
+
+
+def _is_timeout(e):
+    if isinstance(e, socket.timeout):
+        return True
+    return isinstance(e, URLError) and isinstance(e.reason, socket.timeout)
+
+
+class EnrichrClient(object):
+    """
+    Minimal Enrichr API client.
+
+    Args:
+        base_url (str): url of the Enrichr API, without a trailing slash.
+        timeout (float): timeout in seconds for each request.
+    """
+
+    def __init__(self, base_url=DEFAULT_URL, timeout=DEFAULT_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, request, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            response = urlopen(request, timeout=timeout)
+            try:
+                return json.loads(response.read().decode('utf-8'))
+            finally:
+                response.close()
+        except Exception as e:
+            if _is_timeout(e):
+                raise EnrichrTimeout('Enrichr query timed out')
+            raise EnrichrError('Enrichr query failed: ' + str(e))
+
+    def add_list(self, genes, description='uncurl_app', timeout=None):
+        """
+        Uploads a gene list, returning its Enrichr user list id.
+        """
+        # addList only accepts multipart form data
+        boundary = uuid.uuid4().hex
+        body = ''
+        for name, value in [('list', '\n'.join(genes)), ('description', description)]:
+            body += '--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'.format(
+                    boundary, name, value)
+        body += '--{0}--\r\n'.format(boundary)
+        request = Request(self.base_url + '/addList', data=body.encode('utf-8'),
+                headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+        result = self._request(request, timeout)
+        if 'userListId' not in result:
+            raise EnrichrError('Enrichr addList failed')
+        return result['userListId']
+
+    def query(self, user_list_id, gene_set, timeout=None):
+        """
+        Returns the enrichment results of a gene list for a gene set library:
+        a list of [rank, term, p-value, z-score, combined score,
+        overlapping genes, adjusted p-value, ...].
+        """
+        url = self.base_url + '/enrich?' + urlencode({'userListId': user_list_id,
+            'backgroundType': gene_set})
+        result = self._request(Request(url), timeout)
+        if gene_set not in result:
+            raise EnrichrError('Enrichr query failed for gene list {0}'.format(user_list_id))
+        return result[gene_set]
+
+
+def get_client():
+    """
+    Returns the Enrichr client for the current app. Clients set in
+    ENRICHR_CLIENT must have the same add_list and query methods as
+    EnrichrClient, including the timeout arguments.
+    """
+    from flask import current_app
+    client = current_app.config.get('ENRICHR_CLIENT')
+    if client is not None:
+        return client
+    return EnrichrClient(current_app.config['ENRICHR_URL'],
+            timeout=current_app.config['ENRICHR_TIMEOUT'])
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker shared by all workers through the cache.
+
+    After max_failures consecutive failures, the breaker opens for
+    reset_timeout seconds, during which allow() returns False. After that, a
+    single failure opens it again, until a query succeeds.
+    """
+
+    def __init__(self, name, max_failures=3, reset_timeout=60):
+        self.name = name
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+
+    def _open_key(self):
+        return 'breaker_{0}_open'.format(self.name)
+
+    def _failures_key(self):
+        return 'breaker_{0}_failures'.format(self.name)
+
+    def allow(self):
+        return not cache.get(self._open_key())
+
+    def success(self):
+        cache.delete(self._failures_key())
+
+    def failure(self):
+        failures = (cache.get(self._failures_key()) or 0) + 1
+        if failures >= self.max_failures:
+            cache.set(self._open_key(), True, timeout=self.reset_timeout)
+            failures = self.max_failures - 1
+        cache.set(self._failures_key(), failures, timeout=10*self.reset_timeout)
+
+
+breaker = CircuitBreaker('enrichr')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(n_threads):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(max_workers=n_threads)
+        return _executor
+
+
+def enrich(genes, gene_set, client=None, deadline=None):
+    """
+    Returns the top NUM_RESULTS Enrichr results for a gene list and gene set
+    library, using the shared caches for the gene list id and results.
+
+    If deadline (in seconds) is given, the whole query (which can take up
+    to three requests) fails with EnrichrTimeout after that time.
+
+    Raises EnrichrTimeout or EnrichrError.
+    """
+    if client is None:
+        client = get_client()
+    genes = list(genes)
+    results = results_cache.get([genes, gene_set])
+    if results is not None:
+        return results
+    end_time = None
+    if deadline is not None:
+        end_time = time.time() + deadline
+    def timeout():
+        # timeout for the next request
+        if end_time is None:
+            return None
+        remaining = end_time - time.time()
+        if remaining <= 0:
+            raise EnrichrTimeout('Enrichr query timed out')
+        return min(remaining, getattr(client, 'timeout', remaining))
+    user_list_id = list_ids.get(genes)
+    if user_list_id is None:
+        user_list_id = client.add_list(genes, timeout=timeout())
+        list_ids.set(genes, user_list_id)
+        results = client.query(user_list_id, gene_set, timeout=timeout())
+    else:
+        try:
+            results = client.query(user_list_id, gene_set, timeout=timeout())
+        except EnrichrTimeout:
+            raise
+        except EnrichrError:
+            # the list id might have expired on the server
+            user_list_id = client.add_list(genes, timeout=timeout())
+            list_ids.set(genes, user_list_id)
+            results = client.query(user_list_id, gene_set, timeout=timeout())
+    results = results[:NUM_RESULTS]
+    results_cache.set([genes, gene_set], results)
+    return results
+
+
+def _query_key(genes, gene_set):
+    import hashlib
+    h = hashlib.sha1(json.dumps([genes, gene_set]).encode()).hexdigest()
+    return 'enrichr_query_' + h
+
+
+def _run_query(app, genes, gene_set, deadline):
+    key = _query_key(genes, gene_set)
+    with app.app_context():
+        try:
+            enrich(genes, gene_set, deadline=deadline)
+            breaker.success()
+        except EnrichrError as e:
+            breaker.failure()
+            cache.set(key + '_error', 'Error: ' + str(e), timeout=ERROR_TIMEOUT)
+        except Exception as e:
+            print(traceback.format_exc())
+            cache.set(key + '_error', 'Error: ' + str(e), timeout=ERROR_TIMEOUT)
+        finally:
+            cache.delete(key + '_pending')
+
+
+def start_enrich(genes, gene_set, wait=WAIT_TIME):
+    """
+    Starts an Enrichr query in the worker's thread pool, if it isn't cached
+    or already running, and waits up to wait seconds for it.
+
+    Returns one of:
+        ('done', results)
+        ('pending', None) - the query is still running; the client should
+            repeat the request later.
+        ('error', message)
+    """
+    from flask import current_app
+    genes = list(genes)
+    results = results_cache.get([genes, gene_set])
+    if results is not None:
+        return 'done', results
+    key = _query_key(genes, gene_set)
+    error = cache.get(key + '_error')
+    if error is not None:
+        cache.delete(key + '_error')
+        return 'error', error
+    if cache.get(key + '_pending'):
+        return 'pending', None
+    if not breaker.allow():
+        return 'error', 'Error: Enrichr is currently unavailable, please try again later.'
+    deadline = current_app.config['ENRICHR_DEADLINE']
+    cache.set(key + '_pending', True, timeout=int(deadline) + 10)
+    executor = _get_executor(current_app.config['ENRICHR_THREADS'])
+    future = executor.submit(_run_query, current_app._get_current_object(),
+            genes, gene_set, deadline)
+    try:
+        future.result(timeout=wait)
+    except Exception:
+        # still running
+        return 'pending', None
+    results = results_cache.get([genes, gene_set])
+    if results is not None:
+        return 'done', results
+    error = cache.get(key + '_error')
+    if error is not None:
+        cache.delete(key + '_error')
+        return 'error', error
+    return 'pending', None
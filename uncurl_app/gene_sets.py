@@ -0,0 +1,188 @@
+# In-memory gene set databases for enrichment tests on many gene lists at
+# once.
+#
+# Each gene set database (CellMarker, CellMeSH, KEGG) is loaded once per
+# process into a sparse (gene set x gene) membership matrix. The overlaps of
+# all query gene lists with all gene sets are then computed with a single
+# sparse matrix product, and the hypergeometric p-values with a single
+# vectorized call to hypergeom.sf, so that all clusters of a dataset can be
+# tested in one request.
+#
+# The background for each database is the set of all genes in the database,
+# and gene names are compared case-insensitively.
+
+import threading
+
+import numpy as np
+from scipy import sparse
+from scipy.stats import hypergeom
+
+# databases that can be loaded into a GeneSetMatrix
+DATABASES = ('cellmarker', 'cellmesh', 'kegg')
+
+HEADER = ['Gene set', 'P-value', 'Overlap', 'Genes']
+
+
+class GeneSetMatrix(object):
+    """
+    Sparse membership matrix of a gene set database.
+
+    Args:
+        names (list of str): name of each gene set
+        gene_sets (list of lists of str): genes of each gene set
+        gene_info (list of dicts or None): optional per-set dict of gene to
+            extra information (e.g. PMIDs), returned with the test results.
+
+    Attributes:
+        genes (list of str): all genes in the database, as given in the
+            gene sets
+        gene_index (dict): upper case gene name to column index
+        membership (csr_matrix): binary matrix of shape (n_sets, n_genes)
+        set_sizes (array): number of genes in each set
+    """
+
+    def __init__(self, names, gene_sets, gene_info=None):
+        self.names = list(names)
+        self.gene_info = gene_info
+        self.genes = []
+        self.gene_index = {}
+        rows = []
+        cols = []
+        for i, genes in enumerate(gene_sets):
+            for g in genes:
+                key = g.strip().upper()
+                if key not in self.gene_index:
+                    self.gene_index[key] = len(self.genes)
+                    self.genes.append(g.strip())
+                rows.append(i)
+                cols.append(self.gene_index[key])
+        membership = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                shape=(len(self.names), len(self.genes)))
+        # duplicate genes in a set are summed by csr_matrix
+        membership.data[:] = 1
+        self.membership = membership
+        self.set_sizes = np.asarray(membership.sum(1)).flatten()
+
+    def query_matrix(self, gene_lists):
+        """
+        Returns a binary csc_matrix of shape (n_genes, n_queries), for the
+        genes of each list that are in the database.
+        """
+        rows = []
+        cols = []
+        for j, genes in enumerate(gene_lists):
+            indices = set(self.gene_index[g] for g in
+                    (x.strip().upper() for x in genes) if g in self.gene_index)
+            rows.extend(indices)
+            cols.extend([j]*len(indices))
+        return sparse.csc_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                shape=(len(self.genes), len(gene_lists)))
+
+    def hypergeometric_test(self, gene_lists, max_results=20):
+        """
+        Runs a hypergeometric test for each gene list against all gene sets.
+
+        Returns a list with one entry for each gene list: a list of
+        (set index, p-value, overlapping genes) for the max_results sets with
+        the lowest p-values, excluding sets with no overlap.
+        """
+        queries = self.query_matrix(gene_lists)
+        query_sizes = np.asarray(queries.sum(0)).flatten()
+        # overlaps has shape (n_sets, n_queries); only sets that overlap a
+        # query are stored.
+        overlaps = self.membership.dot(queries).tocsc()
+        overlaps.sort_indices()
+        k = overlaps.data
+        rows = overlaps.indices
+        cols = np.repeat(np.arange(len(gene_lists)), np.diff(overlaps.indptr))
+        pvals = hypergeom.sf(k - 1, len(self.genes), self.set_sizes[rows],
+                query_sizes[cols])
+        results = []
+        for j in range(len(gene_lists)):
+            start, end = overlaps.indptr[j], overlaps.indptr[j+1]
+            order = start + np.lexsort((-k[start:end], pvals[start:end]))[:max_results]
+            query_genes = queries.indices[queries.indptr[j]:queries.indptr[j+1]]
+            query_result = []
+            for x in order:
+                i = rows[x]
+                set_genes = self.membership.indices[self.membership.indptr[i]:self.membership.indptr[i+1]]
+                overlap = np.intersect1d(set_genes, query_genes)
+                query_result.append((i, pvals[x], [self.genes[g] for g in overlap]))
+            results.append(query_result)
+        return results
+
+    def result_table(self, gene_lists, max_results=20, link=str):
+        """
+        Returns the hypergeometric test results as tables (lists of rows
+        starting with HEADER), one for each gene list.
+
+        If the database has gene_info, each row has an extra 'PMIDs' column
+        of 'gene: pmid, pmid, ...' for the overlapping genes, where each PMID
+        is formatted with link.
+        """
+        header = list(HEADER)
+        if self.gene_info is not None:
+            header.append('PMIDs')
+        tables = []
+        for result in self.hypergeometric_test(gene_lists, max_results):
+            table = [header]
+            for i, pval, genes in result:
+                row = [self.names[i], pval, len(genes), ', '.join(genes)]
+                if self.gene_info is not None:
+                    info = self.gene_info[i]
+                    row.append(', '.join('{0}: {1}'.format(g,
+                        ', '.join(link(x) for x in info.get(g, []))) for g in genes))
+                table.append(row)
+            tables.append(table)
+        return tables
+
+def load_cellmarker(species='all'):
+    import cellmarker
+    from . import catalogs
+    names = catalogs.get('cellmarker')
+    gene_sets = [cellmarker.get_cell_genes(name, cells_or_tissues='cells', species=species)
+            for name in names]
+    return GeneSetMatrix(names, gene_sets)
+
+
+def load_cellmesh(species='human'):
+    import cellmesh
+    names = []
+    gene_sets = []
+    gene_info = []
+    for cell_id, name in cellmesh.get_all_cell_id_names(include_cell_components=False):
+        genes = cellmesh.get_cell_genes_pmids(cell_id, species=species)
+        names.append(name)
+        gene_sets.append([g for g, _ in genes])
+        gene_info.append({g: pmids.split(',') for g, pmids in genes})
+    return GeneSetMatrix(names, gene_sets, gene_info)
+
+
+def load_kegg(species='human'):
+    import kegg_query
+    names = sorted(kegg_query.get_all_cells(species=species))
+    gene_sets = [kegg_query.get_cell_genes(name, species=species)[0] for name in names]
+    return GeneSetMatrix(names, gene_sets)
+
+
+LOADERS = {
+        'cellmarker': load_cellmarker,
+        'cellmesh': load_cellmesh,
+        'kegg': load_kegg,
+}
+
+_matrices = {}
+_lock = threading.Lock()
+
+
+def get_gene_set_matrix(db, species):
+    """
+    Returns the GeneSetMatrix for a database and species, loading it the
+    first time it's used in this process.
+    """
+    key = (db, species)
+    if key not in _matrices:
+        with _lock:
+            if key not in _matrices:
+                _matrices[key] = LOADERS[db](species)
+    return _matrices[key]
@@ -8,7 +8,7 @@ from scipy import sparse
 
 from uncurl_analysis import sc_analysis
 
-def generate_uncurl_analysis(data, output_dir,
+def generate_uncurl_analysis(data, output_dir, diffexp_n_jobs=1,
         **uncurl_kwargs):
     """
     Performs an uncurl analysis of the data, writing the results in the given
@@ -26,12 +26,14 @@ def generate_uncurl_analysis(data, output_dir,
         output_dir/gene_subset.txt (gene subset selected by uncurl)
         output_dir/gene_names.txt (list of all gene names in data subset)
         output_dir/entropy.txt (entropy of cell labels)
+        output_dir/diffexp/ (group statistics and diffexp results for the clusters, see diffexp.py)
 
     Args:
         data (array or str): either a data array, or a string containing
             the path to a data array..
         output_dir (str): directory to write output to.
             contains params.json, data.mtx/.txt/.gz, and optionally gene_names.txt.
+        diffexp_n_jobs (int): number of processes for the diffexp calculation.
         **uncurl_kwargs: arguments to pass to uncurl.run_state_estimation..
     """
     # TODO: what about init?
@@ -61,6 +63,8 @@ def generate_uncurl_analysis(data, output_dir,
         sca.add_color_track('samples', samples, True)
     try:
         sca.run_full_analysis()
+        save_cluster_diffexp(sca, os.path.join(output_dir, 'diffexp'),
+                n_jobs=diffexp_n_jobs)
     except Exception as e:
         import traceback
         text = traceback.format_exc()
@@ -71,9 +75,61 @@ def generate_uncurl_analysis(data, output_dir,
     print('done with generate_analysis')
 
 
+def save_cluster_diffexp(sca, diffexp_dir, n_jobs=1):
+    """
+    Calculates and saves the group statistics and the 1-vs-rest and pairwise
+    diffexp results for the clusters of an analysis in diffexp_dir, so that
+    they can be loaded by the views and updated incrementally after a split
+    or merge.
+    """
+    from . import diffexp
+    for mode in ['1_vs_rest', 'pairwise']:
+        diffexp.calculate_diffexp(sca.data_sampled_all_genes, sca.labels,
+                mode=mode, use_fdr=sca.params['use_fdr'],
+                cache_dir=diffexp_dir, n_jobs=n_jobs)
+
+
+# SCAnalysis attributes calculated by run_post_analysis that don't depend on
+# the diffexp results.
+POST_ANALYSIS_ATTRIBUTES = ['cluster_means', 'dim_red', 'mds_means', 'separation_scores']
+
+def _clear_sca_attributes(sca, names):
+    """
+    Makes SCAnalysis recalculate the given attributes the next time they're
+    accessed. SCAnalysis has no public way to do this, so this clears its
+    private has_<name> flags (has_cluster_means, has_dim_red, has_mds_means,
+    has_separation_scores for POST_ANALYSIS_ATTRIBUTES). Returns False, and
+    changes nothing, if any of the flags doesn't exist.
+    """
+    flags = ['has_' + name for name in names]
+    if not all(hasattr(sca, flag) for flag in flags):
+        return False
+    for flag in flags:
+        setattr(sca, flag, False)
+    return True
+
+def run_post_analysis_without_diffexp(sca):
+    """
+    Recalculates the cluster means, the visualization, the MDS of the cluster
+    means and the separation scores after the clusters change, skipping the
+    top genes, p-values and pairwise t-tests of SCAnalysis.run_post_analysis,
+    which are calculated by diffexp.py instead. If the attributes can't be
+    cleared, the full run_post_analysis is run.
+    """
+    if not _clear_sca_attributes(sca, POST_ANALYSIS_ATTRIBUTES):
+        print('run_post_analysis_without_diffexp: SCAnalysis flags not found, running run_post_analysis')
+        sca.run_post_analysis()
+        return
+    for name in POST_ANALYSIS_ATTRIBUTES:
+        getattr(sca, name)
+
+
 def generate_analysis_resubmit(sca,
         split_or_merge='split',
         clusters_to_change=[],
+        diffexp_dir=None,
+        n_jobs=1,
+        progress=None,
         **uncurl_kwargs):
     """
     Re-runs uncurl by splitting a cluster or merging clusters.
@@ -82,9 +138,32 @@ def generate_analysis_resubmit(sca,
         sca (SCAnalysis object)
         split_or_merge (str): either 'split' or 'merge'
         clusters_to_change (list): list of cluster numbers. If splitting, only the first cluster will be used. If merging, all the clusters will be merged.
+        diffexp_dir (str or None): directory containing saved diffexp
+            results (see diffexp.py). If given, the 1-vs-rest and pairwise
+            results for the new clusters are updated incrementally, only
+            recalculating the clusters that changed, and the diffexp parts
+            of SCAnalysis.run_post_analysis are skipped.
+        n_jobs (int): number of processes for the diffexp update.
+        progress (function or None): called as progress(message, fraction)
+            at the start of each stage.
     """
+    if progress is None:
+        progress = lambda message, fraction=None: None
+    old_labels = np.array(sca.labels)
+    progress('re-running UNCURL', 0.0)
     sca.recluster(split_or_merge, clusters_to_change, write_log_entry=True)
-    sca.run_post_analysis()
+    if diffexp_dir is not None:
+        from . import diffexp
+        progress('updating differential expression', 0.5)
+        diffexp.update_diffexp(sca.data_sampled_all_genes, old_labels,
+                sca.labels, use_fdr=sca.params['use_fdr'],
+                cache_dir=diffexp_dir, n_jobs=n_jobs)
+        progress('recalculating cluster statistics', 0.7)
+        run_post_analysis_without_diffexp(sca)
+    else:
+        progress('recalculating cluster statistics', 0.7)
+        sca.run_post_analysis()
+    progress('saving results', 0.9)
     sca.save_json_reset()
 
 
@@ -15,20 +15,19 @@ import scipy.io
 from flask import request, render_template, redirect, url_for, Blueprint, current_app
 from uncurl_analysis import enrichr_api, sc_analysis, custom_cell_selection
 
+from . import artifact_cache
+from . import catalogs
+from . import gene_sets
 from . import generate_analysis
-from .cache import cache
+from . import jobs
+from . import plot_pool
+from .cache import cache, dataset_context, gzip_response
 from .utils import SimpleEncoder
 from .views import state_estimation_preproc_simple
 
 interaction_views = Blueprint('interaction_views', __name__,
         template_folder='templates')
 
-# map of user_id to SCAnalysis objects
-# map of gene lists (strings of newline-separated gene names) to enrichr IDs
-interaction_views.enrichr_gene_list_ids = {}
-# map of tuples (top_genes, gene_set) to enrichr results
-interaction_views.enrichr_results = {}
-
 def pmid_to_link(pmid):
     return '<a href="https://www.ncbi.nlm.nih.gov/pubmed/{0}">{0}</a>'.format(pmid)
 
@@ -53,8 +52,10 @@ def lockfile_context(lockfile_name):
         raise Exception('Lockfile {0} exists'.format(lockfile_name))
     with open(lockfile_name, 'w') as f:
         f.write(' ')
-    yield 1
-    os.remove(lockfile_name)
+    try:
+        yield 1
+    finally:
+        os.remove(lockfile_name)
 
 def get_sca(user_id):
     path = user_id_to_path(user_id)
@@ -72,41 +73,172 @@ def get_sca_baseline_vis(user_id):
     sca = get_sca(user_id)
     return sca.baseline_vis
 
+def get_dataset_version(user_id):
+    from .utils import dataset_version
+    return dataset_version(user_id_to_path(user_id))
+
+def get_array_handle(user_id, version, name, func):
+    """
+    Returns an array_store.ArrayHandle for an array of the given version of
+    the dataset, calling func() to create the array if it isn't stored yet.
+    """
+    from . import array_store
+    return array_store.get_or_put(current_app.config['ARRAY_STORE_DIR'],
+            user_id_to_path(user_id), version, name, func,
+            max_bytes=current_app.config['ARRAY_STORE_MAX_BYTES'])
+
+def load_stored_arrays(handle_func, user_id, *args):
+    """
+    Calls handle_func(user_id, version, *args), a memoized function that
+    returns an ArrayHandle or a tuple containing ArrayHandles, and returns
+    its result with the arrays loaded. If the arrays were removed from the
+    array store after the handles were memoized (see array_store.sweep),
+    the memoized result is deleted and created again.
+    """
+    from . import array_store
+    version = get_dataset_version(user_id)
+    result = handle_func(user_id, version, *args)
+    if not array_store.all_exist(result):
+        cache.delete_memoized(handle_func, user_id, version, *args)
+        result = handle_func(user_id, version, *args)
+    if isinstance(result, tuple):
+        return tuple(array_store.load(x) for x in result)
+    return array_store.load(result)
+
 @cache.memoize()
-def get_sca_top_genes(user_id):
-    sca = get_sca(user_id)
-    return sca.top_genes
+def get_sca_pairwise_handles(user_id, version):
+    def pairwise(index):
+        return get_cluster_diffexp(user_id, 'pairwise')[index]
+    return (get_array_handle(user_id, version, 'pairwise_ratios', lambda: pairwise(0)),
+            get_array_handle(user_id, version, 'pairwise_pvals', lambda: pairwise(1)))
+
+def get_sca_pairwise_ratios(user_id):
+    return load_stored_arrays(get_sca_pairwise_handles, user_id)[0]
+
+def get_sca_pairwise_pvals(user_id):
+    return load_stored_arrays(get_sca_pairwise_handles, user_id)[1]
 
 @cache.memoize()
-def get_sca_pvals(user_id):
-    sca = get_sca(user_id)
-    return sca.pvals
+def get_sca_pval_1vr(user_id):
+    return get_cluster_diffexp(user_id, '1_vs_rest')[1]
 
 @cache.memoize()
-def get_sca_pairwise_ratios(user_id):
+def get_sca_top_1vr(user_id):
+    return get_cluster_diffexp(user_id, '1_vs_rest')[0]
+
+def get_cluster_diffexp(user_id, mode):
+    """
+    Returns the diffexp results (see diffexp.calculate_diffexp) for the
+    current clusters. These are saved when the analysis finishes and updated
+    after each split/merge, and calculated here for datasets that were
+    analyzed before they were saved.
+    """
+    from . import diffexp
     sca = get_sca(user_id)
-    return sca.t_scores
+    data = get_sca_data_sampled_all_genes(user_id)
+    return diffexp.calculate_diffexp(data, sca.labels, mode=mode,
+            use_fdr=sca.params['use_fdr'],
+            cache_dir=get_diffexp_dir(user_id),
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'])
 
 @cache.memoize()
-def get_sca_pairwise_pvals(user_id):
+@artifact_cache.memoize
+def get_sca_top_genes_custom(user_id, color_track, mode='1_vs_rest'):
+    """Output is a tuple of dicts mapping labels to lists of (gene_id, value) for 1_vs_rest, or arrays of shape [k, k, genes] for pairwise."""
+    from . import diffexp
     sca = get_sca(user_id)
-    return sca.t_pvals
+    labels, is_discrete = get_sca_color_track(user_id, color_track)
+    data = get_sca_data_sampled_all_genes(user_id)
+    return diffexp.calculate_diffexp(data, labels, mode=mode,
+            use_fdr=sca.params['use_fdr'],
+            cache_dir=get_diffexp_dir(user_id),
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'])
 
 @cache.memoize()
-def get_sca_pval_1vr(user_id):
+@artifact_cache.memoize
+def get_sca_pairwise_custom(user_id, color_track_name, cluster1, cluster2):
+    """
+    Pairwise diffexp for a single pair of labels in a custom color track.
+
+    Output is a tuple of two arrays of shape [genes]: ratios and pvals
+    of cluster1 vs cluster2, where cluster1 and cluster2 are label indices.
+    """
+    from . import diffexp
     sca = get_sca(user_id)
-    return sca.pvals_1_vs_rest
+    color_track, is_discrete = get_sca_color_track(user_id, color_track_name)
+    data = get_sca_data_sampled_all_genes(user_id)
+    stats = diffexp.get_group_stats(data, color_track,
+            cache_dir=get_diffexp_dir(user_id),
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'])
+    return diffexp.pair_from_stats(stats, cluster1, cluster2,
+            use_fdr=sca.params['use_fdr'])
 
 @cache.memoize()
-def get_sca_top_1vr(user_id):
+@artifact_cache.memoize
+def get_sca_wilcoxon_1vr(user_id, color_track_name):
+    """
+    Wilcoxon rank-sum test of each label vs the rest.
+
+    Output is a dict mapping labels to lists of (gene_id, pval), sorted by increasing p-value.
+    """
+    from . import diffexp
     sca = get_sca(user_id)
-    return sca.top_genes_1_vs_rest
+    color_track, is_discrete = get_sca_color_track(user_id, color_track_name)
+    data = get_sca_data_sampled_all_genes(user_id)
+    label_values, pvals = diffexp.wilcoxon_1_vs_rest(data, color_track,
+            use_fdr=sca.params['use_fdr'],
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'])
+    return diffexp.to_top_pvals(label_values, pvals)
 
 @cache.memoize()
-def get_sca_top_genes_custom(user_id, color_track, mode='1_vs_rest'):
-    """Output is array of shape [k, genes] for 1_vs_rest or [k, k, genes] for pairwise."""
+@artifact_cache.memoize
+def get_sca_wilcoxon_pair(user_id, color_track_name, cluster1, cluster2):
+    """
+    Wilcoxon rank-sum test of cluster1 vs cluster2, where cluster1 and
+    cluster2 are label indices.
+
+    Output is an array of shape [genes] of p-values.
+    """
+    from . import diffexp
     sca = get_sca(user_id)
-    return sca.calculate_diffexp(color_track, mode=mode)
+    color_track, is_discrete = get_sca_color_track(user_id, color_track_name)
+    color_to_index, index_to_color = color_track_map(color_track)
+    data = get_sca_data_sampled_all_genes(user_id)
+    return diffexp.wilcoxon_pair(data, color_track,
+            index_to_color[cluster1], index_to_color[cluster2],
+            use_fdr=sca.params['use_fdr'],
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'])
+
+def get_diffexp_dir(user_id):
+    """
+    Returns the directory where diffexp results are stored for the given dataset.
+    """
+    return os.path.join(user_id_to_path(user_id), 'diffexp')
+
+def start_pairwise_custom_full(user_id, color_track_name):
+    """
+    Starts calculating the full [k, k, genes] pairwise diffexp for a custom
+    color track in a background thread.
+
+    This uses its own lockfile, <track>_writing_pairwise, rather than the
+    <track>_writing_diffexp lock of the 1-vs-rest results, so that 1-vs-rest
+    requests for the same track can run while it's calculated.
+    """
+    from multiprocessing.dummy import Process
+    app = current_app._get_current_object()
+    lockfile_name = os.path.join(user_id_to_path(user_id), color_track_name + '_writing_pairwise')
+    if os.path.exists(lockfile_name):
+        return False
+    def run():
+        with app.app_context(), dataset_context(user_id_to_path(user_id)):
+            try:
+                with lockfile_context(lockfile_name) as _lock:
+                    get_sca_top_genes_custom(user_id, color_track_name, 'pairwise')
+            except Exception:
+                print(traceback.format_exc())
+    P = Process(target=run)
+    P.start()
+    return True
 
 @cache.memoize()
 def get_sca_gene_names(user_id):
@@ -114,19 +246,40 @@ def get_sca_gene_names(user_id):
     return sca.gene_names
 
 @cache.memoize()
-def get_sca_color_track(user_id, color_track, return_color=False):
+def get_sca_color_track_handle(user_id, version, color_track, return_color=False):
+    """
+    Same output as get_sca_color_track, except that the labels are an
+    array_store.ArrayHandle. version is the dataset version, so that the
+    memoized handle never refers to arrays of an older version.
+    """
     sca = get_sca(user_id)
     if color_track == 'cluster':
-        return sca.labels, True
-    if return_color:
-        return sca.get_color_track(color_track, return_colors=True)
+        result = (sca.labels, True)
+    elif return_color:
+        result = sca.get_color_track(color_track, return_colors=True)
     else:
-        return sca.get_color_track(color_track)
+        result = sca.get_color_track(color_track)
+    if result is None or result[0] is None:
+        return result
+    handle = get_array_handle(user_id, version, 'color_track/' + color_track,
+            lambda: result[0])
+    return (handle,) + tuple(result[1:])
+
+def get_sca_color_track(user_id, color_track, return_color=False):
+    return load_stored_arrays(get_sca_color_track_handle, user_id,
+            color_track, return_color)
 
 @cache.memoize()
+def get_sca_data_sampled_all_genes_handle(user_id, version):
+    return get_array_handle(user_id, version, 'data_sampled_all_genes',
+            lambda: get_sca(user_id).data_sampled_all_genes)
+
 def get_sca_data_sampled_all_genes(user_id):
-    sca = get_sca(user_id)
-    return sca.data_sampled_all_genes
+    """
+    Returns the sampled data matrix for all genes. This is a read-only
+    memory map of the array store, shared by all workers.
+    """
+    return load_stored_arrays(get_sca_data_sampled_all_genes_handle, user_id)
 
 def color_track_map(color_track):
     """
@@ -141,6 +294,13 @@ def array_to_top_genes(data_array, cluster1, cluster2, is_pvals=False, num_genes
         genes and values.
     """
     data_cluster = data_array[cluster1, cluster2, :]
+    return vector_to_top_genes(data_cluster, is_pvals=is_pvals, num_genes=num_genes)
+
+def vector_to_top_genes(data_cluster, is_pvals=False, num_genes=10):
+    """
+    Given a 1d data_cluster of shape (genes,), this returns two arrays:
+        genes and values.
+    """
     if is_pvals:
         order = data_cluster.argsort()
     else:
@@ -356,39 +516,49 @@ def scatterplot_data(dim_red, labels, colorscale='Portland', mode='cluster',
     }, cls=SimpleEncoder)
 
 
-def volcano_plot_data(user_id, colormap, cluster1, cluster2, selected_genes=None):
+def volcano_plot_data(user_id, colormap, cluster1, cluster2, selected_genes=None, diffexp_test='t'):
     """
     Returns plotly json representation of a volcano plot
+
+    diffexp_test can be 't' (default) or 'wilcoxon'.
     """
     sca = get_sca(user_id)
     gene_names = get_sca_gene_names(user_id)
+    color_track_name = 'cluster'
     # get custom colormap
     if colormap is not None and colormap not in ['cluster', 'gene', 'entropy', 'weights', 'read_counts']:
+        color_track_name = colormap
         color_track, is_discrete = get_sca_color_track(user_id, colormap)
-        lockfile_name = os.path.join(sca.data_dir, colormap + '_writing_diffexp')
-        with lockfile_context(lockfile_name) as _lock:
-            selected_diffexp, selected_pvals = get_sca_top_genes_custom(user_id, colormap, 'pairwise')
         color_to_index, index_to_color = color_track_map(color_track)
+        # only calculate the selected pair, not the full pairwise array
+        diffexp_data, pval_data = get_sca_pairwise_custom(user_id, colormap, cluster1, cluster2)
+        _, pval_2v1_data = get_sca_pairwise_custom(user_id, colormap, cluster2, cluster1)
     # default colormap
     else:
         selected_diffexp = get_sca_pairwise_ratios(user_id)
         selected_pvals = get_sca_pairwise_pvals(user_id)
         index_to_color = list(range(selected_diffexp.shape[0]))
+        # get pval data,
+        diffexp_data = selected_diffexp[cluster1, cluster2, :]
+        pval_data = selected_pvals[cluster1, cluster2, :]
+        pval_2v1_data = selected_pvals[cluster2, cluster1, :]
+    if diffexp_test == 'wilcoxon':
+        pval_data = get_sca_wilcoxon_pair(user_id, color_track_name, cluster1, cluster2)
+        pval_2v1_data = get_sca_wilcoxon_pair(user_id, color_track_name, cluster2, cluster1)
     if selected_genes is not None:
         gene_indices = {g:i for i, g in enumerate(gene_names)}
         selected_gene_indices = np.array([gene_indices[g] for g in selected_genes])
-        selected_diffexp = selected_diffexp[:,:,selected_gene_indices]
-        selected_pvals = selected_pvals[:,:,selected_gene_indices]
+        diffexp_data = diffexp_data[selected_gene_indices]
+        pval_data = pval_data[selected_gene_indices]
+        pval_2v1_data = pval_2v1_data[selected_gene_indices]
         gene_names = selected_genes
-    # get pval data, 
-    diffexp_data = selected_diffexp[cluster1, cluster2, :]
-    pval_data = selected_pvals[cluster1, cluster2, :]
-    pval_2v1_data = selected_pvals[cluster2, cluster1, :]
     pval_combined = np.fmin(pval_data, pval_2v1_data)
     if sca.params['use_fdr']:
         y_desc = '-log10 FDR'
     else:
         y_desc = '-log10 p-value'
+    if diffexp_test == 'wilcoxon':
+        y_desc += ' (Wilcoxon rank-sum)'
     data = [{
                 'x': np.log2(diffexp_data + 2e-16),
                 'y': -np.log10(pval_combined + 2e-16),
@@ -459,6 +629,7 @@ def violin_plot_data(gene_values_all, cell_labels, gene_name,
 
 
 @cache.memoize()
+@artifact_cache.memoize
 def heatmap_data(user_id, label_name_1, label_name_2, **params):
     """
     Returns a heatmap comparing two color tracks.
@@ -474,15 +645,14 @@ def heatmap_data(user_id, label_name_1, label_name_2, **params):
     return cluster_heatmap(color_track_1, color_track_2, label_name_1, label_name_2)
 
 @cache.memoize()
+@artifact_cache.memoize
 def dendrogram_data(user_id, color_track_name, selected_genes, use_log=False, use_normalize=False):
     """
     Returns a dendrogram json
     """
     if color_track_name in ['entropy', 'gene', 'weights', 'read_count']:
         color_track_name = 'cluster'
-    color_track, is_discrete = get_sca_color_track(user_id, color_track_name)
     all_genes = get_sca_gene_names(user_id)
-    data = get_sca_data_sampled_all_genes(user_id)
     if len(selected_genes) == 0:
         # get top 5 genes from each cluster
         if color_track_name == 'cluster':
@@ -493,10 +663,43 @@ def dendrogram_data(user_id, color_track_name, selected_genes, use_log=False, us
             selected_top_genes = gene_set[:5]
             selected_gene_names = [all_genes[int(x[0])] for x in selected_top_genes]
             selected_genes += selected_gene_names
-    from .advanced_plotting import dendrogram
-    return dendrogram(data, all_genes, selected_genes, color_track_name, color_track, use_log=use_log, use_normalize=use_normalize)
+    from .advanced_plotting import dendrogram_figure
+    from .utils import dataset_version
+    selected_genes, cluster_names, data_cluster_means, cluster_tree, gene_tree = get_dendrogram_trees(
+            user_id, dataset_version(user_id_to_path(user_id)), color_track_name,
+            selected_genes, use_log, use_normalize)
+    return dendrogram_figure(data_cluster_means, selected_genes, cluster_names,
+            cluster_tree=cluster_tree, gene_tree=gene_tree)
+
+@cache.memoize()
+def get_dendrogram_trees(user_id, version, color_track_name, selected_genes, use_log, use_normalize):
+    """
+    Returns the selected genes, cluster names, transformed cluster means for
+    the selected genes, and the hierarchical clusterings of the clusters and
+    genes for a dendrogram. The cluster means are taken from the group
+    statistics saved by diffexp.get_group_stats.
+
+    version is the dataset version, so that the cached trees are not used
+    after the dataset is changed.
+    """
+    from . import diffexp
+    from .advanced_plotting import dendrogram_means, dendrogram_tree
+    color_track, is_discrete = get_sca_color_track(user_id, color_track_name)
+    all_genes = get_sca_gene_names(user_id)
+    data = get_sca_data_sampled_all_genes(user_id)
+    stats = diffexp.get_group_stats(data, color_track,
+            cache_dir=get_diffexp_dir(user_id),
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'])
+    selected_genes, cluster_names, data_cluster_means = dendrogram_means(data,
+            all_genes, selected_genes, color_track,
+            use_log=use_log, use_normalize=use_normalize,
+            cluster_means=(stats.label_values, stats.means()))
+    cluster_tree = dendrogram_tree(data_cluster_means.T)
+    gene_tree = dendrogram_tree(data_cluster_means)
+    return selected_genes, cluster_names, data_cluster_means, cluster_tree, gene_tree
 
 @cache.memoize()
+@artifact_cache.memoize
 def cluster_correlation_heatmap_data(user_id, color_track_name, method='spearman'):
     """
     Correlation between the mean gene expression profiles of all clusters for the given color track.
@@ -603,12 +806,8 @@ def view_plots(user_id):
         test_or_user = 'test'
         data_user_id = user_id[5:]
     sca = get_sca(user_id)
-    import cellmesh
-    anatomy_id_names = cellmesh.get_all_cell_id_names(db_dir=cellmesh.ANATOMY_DB_DIR,
-            include_cell_lines=True, include_chromosomes=True)
-    anatomy_names = [x[1] for x in anatomy_id_names]
-    cell_id_names = cellmesh.get_all_cell_id_names(include_cell_components=False)
-    cell_names = [x[1] for x in cell_id_names]
+    anatomy_names = catalogs.get('anatomy_names')
+    cell_names = catalogs.get('cell_names')
     return render_template('state_estimation_static.html', user_id=user_id,
             test_or_user=test_or_user,
             data_user_id=data_user_id,
@@ -633,8 +832,8 @@ def update_barplot(user_id):
     num_genes = int(request.form['num_genes'])
     data_form = request.form.copy()
     try:
-        return update_barplot_result(user_id, top_or_bulk, input_value, num_genes,
-                data_form)
+        return gzip_response(update_barplot_result(user_id, top_or_bulk,
+            input_value, num_genes, data_form))
     except Exception as e:
         text = traceback.format_exc()
         print(text)
@@ -657,6 +856,10 @@ def update_barplot_result(user_id, top_or_bulk, input_value, num_genes,
     selected_gene = ''
     selected_gene_names = None
     gene_names = get_sca_gene_names(user_id)
+    # statistical test used for p-values: 't' or 'wilcoxon'
+    diffexp_test = 't'
+    if 'diffexp_test' in data_form:
+        diffexp_test = data_form['diffexp_test']
     if 'selected_gene' in data_form:
         selected_gene = data_form['selected_gene']
     if len(selected_gene.strip()) > 0:
@@ -668,7 +871,8 @@ def update_barplot_result(user_id, top_or_bulk, input_value, num_genes,
         colormap = str(data_form['cell_color'])
         cluster1 = int(data_form['cluster1'])
         cluster2 = int(data_form['cluster2'])
-        return volcano_plot_data(user_id, colormap, cluster1, cluster2, selected_genes=selected_gene_names)
+        return volcano_plot_data(user_id, colormap, cluster1, cluster2, selected_genes=selected_gene_names,
+                diffexp_test=diffexp_test)
     elif top_or_bulk == 'top_gene_expression':
         # get top genes by raw average expression
         colormap = str(data_form['cell_color'])
@@ -717,8 +921,10 @@ def update_barplot_result(user_id, top_or_bulk, input_value, num_genes,
     elif top_or_bulk == 'top_1_vs_rest' or top_or_bulk == 'pval_1_vs_rest':
         colormap = str(data_form['cell_color'])
         input_label = int(input_value)
+        color_track_name = 'cluster'
         # custom colormap
         if colormap is not None and colormap not in ['cluster', 'gene', 'entropy', 'weights', 'read_counts']:
+            color_track_name = colormap
             color_track, is_discrete = get_sca_color_track(user_id, colormap)
             lockfile_name = os.path.join(sca.data_dir, colormap + '_writing_diffexp')
             with lockfile_context(lockfile_name) as _lock:
@@ -734,6 +940,8 @@ def update_barplot_result(user_id, top_or_bulk, input_value, num_genes,
                 selected_diffexp = get_sca_top_1vr(user_id)[input_label]
             else:
                 selected_diffexp = get_sca_pval_1vr(user_id)[input_label]
+        if top_or_bulk == 'pval_1_vs_rest' and diffexp_test == 'wilcoxon':
+            selected_diffexp = get_sca_wilcoxon_1vr(user_id, color_track_name)[input_label]
         x_label = 'Fold change (1 vs rest)'
         if top_or_bulk == 'selected_color_pval':
             x_label = 'p-value of fold change (1 vs rest)'
@@ -745,6 +953,8 @@ def update_barplot_result(user_id, top_or_bulk, input_value, num_genes,
                 x_label = 'FDR'
             else:
                 x_label = 'p-value of fold change'
+            if diffexp_test == 'wilcoxon':
+                x_label += ' (Wilcoxon rank-sum)'
         # selected genes
         if selected_gene_names:
             selected_top_genes = [x for x in selected_diffexp if gene_names[int(x[0])] in set(selected_gene_names)]
@@ -776,20 +986,25 @@ def update_barplot_result(user_id, top_or_bulk, input_value, num_genes,
             print('using default clustering')
             # Data is a numpy array of shape (k, k, genes)
             if top_or_bulk == 'top_pairwise':
-                data = get_sca_pairwise_ratios(user_id)
-                genes, values = array_to_top_genes(data, cluster1, cluster2, is_pvals=False, num_genes=num_genes)
+                data = get_sca_pairwise_ratios(user_id)[cluster1, cluster2, :]
+                genes, values = vector_to_top_genes(data, is_pvals=False, num_genes=num_genes)
                 desc = 'ratios'
             else:
-                data = get_sca_pairwise_pvals(user_id)
-                genes, values = array_to_top_genes(data, cluster1, cluster2, is_pvals=True, num_genes=num_genes)
+                if diffexp_test == 'wilcoxon':
+                    data = get_sca_wilcoxon_pair(user_id, 'cluster', cluster1, cluster2)
+                else:
+                    data = get_sca_pairwise_pvals(user_id)[cluster1, cluster2, :]
+                genes, values = vector_to_top_genes(data, is_pvals=True, num_genes=num_genes)
                 is_fdr = sca.params['use_fdr']
                 if is_fdr:
                     desc = 'FDR of ratios'
                 else:
                     desc = 'p-value of ratios'
+                if diffexp_test == 'wilcoxon':
+                    desc = desc.replace('ratios', 'Wilcoxon rank-sum test')
             # generate barplot
             if len(selected_gene.strip()) > 0:
-                genes, values = array_to_top_genes(data, cluster1, cluster2, is_pvals=(top_or_bulk=='top_pairwise'), num_genes=1000000)
+                genes, values = vector_to_top_genes(data, is_pvals=(top_or_bulk=='top_pairwise'), num_genes=1000000)
                 gene_data = list(zip(genes, values))
                 gene_data = [x for x in gene_data if gene_names[int(x[0])] in set(selected_gene_names)]
             else:
@@ -804,25 +1019,28 @@ def update_barplot_result(user_id, top_or_bulk, input_value, num_genes,
             color_track, is_discrete = get_sca_color_track(user_id, colormap)
             color_to_index, index_to_color = color_track_map(color_track)
             print('using custom clustering')
-            lockfile_name = os.path.join(sca.data_dir, colormap + '_writing_diffexp')
-            with lockfile_context(lockfile_name) as _lock:
-                selected_diffexp, selected_pvals = get_sca_top_genes_custom(user_id, colormap, 'pairwise')
+            # only calculate the selected pair, not the full pairwise array
+            selected_diffexp, selected_pvals = get_sca_pairwise_custom(user_id, colormap, cluster1, cluster2)
+            if diffexp_test == 'wilcoxon':
+                selected_pvals = get_sca_wilcoxon_pair(user_id, colormap, cluster1, cluster2)
             desc = ''
             if top_or_bulk == 'top_pairwise':
-                genes, values = array_to_top_genes(selected_diffexp, cluster1, cluster2, is_pvals=False, num_genes=num_genes)
+                genes, values = vector_to_top_genes(selected_diffexp, is_pvals=False, num_genes=num_genes)
                 desc = 'ratios'
             else:
-                genes, values = array_to_top_genes(selected_pvals, cluster1, cluster2, is_pvals=True, num_genes=num_genes)
+                genes, values = vector_to_top_genes(selected_pvals, is_pvals=True, num_genes=num_genes)
                 is_fdr = sca.params['use_fdr']
                 if is_fdr:
                     desc = 'FDR of ratios'
                 else:
                     desc = 'p-value of ratios'
+                if diffexp_test == 'wilcoxon':
+                    desc = desc.replace('ratios', 'Wilcoxon rank-sum test')
             if len(selected_gene.strip()) > 0:
                 if top_or_bulk == 'top_pairwise':
-                    genes, values = array_to_top_genes(selected_diffexp, cluster1, cluster2, is_pvals=(top_or_bulk=='top_pairwise'), num_genes=1000000)
+                    genes, values = vector_to_top_genes(selected_diffexp, is_pvals=(top_or_bulk=='top_pairwise'), num_genes=1000000)
                 else:
-                    genes, values = array_to_top_genes(selected_pvals, cluster1, cluster2, is_pvals=(top_or_bulk=='top_pairwise'), num_genes=1000000)
+                    genes, values = vector_to_top_genes(selected_pvals, is_pvals=(top_or_bulk=='top_pairwise'), num_genes=1000000)
                 gene_data = list(zip(genes, values))
                 gene_data = [x for x in gene_data if gene_names[int(x[0])] in set(selected_gene_names)]
             else:
@@ -990,6 +1208,95 @@ def get_double_pairs_comparison_data(user_id, colormap, c1, c2, c3, c4, nonzero_
     }
     return json.dumps(output, cls=SimpleEncoder)
 
+@interaction_views.route('/user/<user_id>/view/pairwise_full', methods=['POST'])
+def pairwise_full(user_id):
+    """
+    Starts calculating the full pairwise diffexp for a custom color track
+    in the background. Pairwise barplots and volcano plots only calculate
+    the selected pair, so this is only needed when all pairs are required.
+    """
+    colormap = str(request.form['cell_color'])
+    if colormap in ['cluster', 'gene', 'entropy', 'weights', 'read_counts']:
+        return 'Error: pairwise diffexp for the default clustering is already calculated.'
+    try:
+        color_track, is_discrete = get_sca_color_track(user_id, colormap)
+        if not is_discrete:
+            return 'Error: color track should be discrete.'
+        if start_pairwise_custom_full(user_id, colormap):
+            return 'Started calculating pairwise diffexp for ' + colormap
+        else:
+            return 'Pairwise diffexp for ' + colormap + ' is already being calculated'
+    except Exception as e:
+        text = traceback.format_exc()
+        print(text)
+        return 'Error: ' + str(e)
+
+def selection_to_mask(user_id, selection, n_cells):
+    """
+    Converts a cell selection into a boolean mask over the sampled cells.
+
+    A selection is either a comma-separated list of cell ids, or a handle
+    of the form '<color track>:<label index>', which selects all cells
+    with the given label.
+    """
+    mask = np.zeros(n_cells, dtype=bool)
+    selection = selection.strip()
+    if ':' in selection:
+        color_track_name, label_index = selection.rsplit(':', 1)
+        color_track, is_discrete = get_sca_color_track(user_id, color_track_name)
+        color_to_index, index_to_color = color_track_map(color_track)
+        mask[np.asarray(color_track) == index_to_color[int(label_index)]] = True
+    else:
+        cell_ids = [int(x) for x in selection.split(',') if len(x.strip()) > 0]
+        mask[cell_ids] = True
+    return mask
+
+@interaction_views.route('/user/<user_id>/view/selection_diffexp', methods=['POST'])
+def selection_diffexp(user_id):
+    """
+    Differential expression between two cell selections, without creating
+    a color track.
+
+    Form inputs:
+        selection_1, selection_2: cell selections (see selection_to_mask)
+        num_genes (int): number of genes to return
+        mode (str): 'top' for fold change, or 'pval' for p-values
+
+    Returns:
+        json corresponding to Plotly barplot
+    """
+    from . import diffexp
+    try:
+        num_genes = int(request.form['num_genes'])
+        mode = 'top'
+        if 'mode' in request.form:
+            mode = request.form['mode']
+        sca = get_sca(user_id)
+        data = get_sca_data_sampled_all_genes(user_id)
+        gene_names = get_sca_gene_names(user_id)
+        cells_1 = selection_to_mask(user_id, request.form['selection_1'], data.shape[1])
+        cells_2 = selection_to_mask(user_id, request.form['selection_2'], data.shape[1])
+        if cells_1.sum() == 0 or cells_2.sum() == 0:
+            return 'Error: empty selection'
+        ratios, pvals_1, pvals_2 = diffexp.selection_diffexp(data, cells_1, cells_2,
+                use_fdr=sca.params['use_fdr'])
+        if mode == 'pval':
+            genes, values = vector_to_top_genes(pvals_1, is_pvals=True, num_genes=num_genes)
+            if sca.params['use_fdr']:
+                x_label = 'FDR'
+            else:
+                x_label = 'p-value'
+        else:
+            genes, values = vector_to_top_genes(ratios, is_pvals=False, num_genes=num_genes)
+            x_label = 'Fold change'
+        return barplot_data(list(zip(genes, values)), [gene_names[int(g)] for g in genes], None,
+                title='Top genes for selection 1 ({0} cells) vs selection 2 ({1} cells)'.format(cells_1.sum(), cells_2.sum()),
+                x_label=x_label)
+    except Exception as e:
+        text = traceback.format_exc()
+        print(text)
+        return 'Error: ' + str(e)
+
 @interaction_views.route('/user/<user_id>/view/update_scatterplot', methods=['GET', 'POST'])
 def update_scatterplot(user_id):
     """
@@ -1003,14 +1310,72 @@ def update_scatterplot(user_id):
     plot_type = request.form['scatter_type']
     cell_color_value = request.form['cell_color']
     try:
-        return update_scatterplot_result(user_id, plot_type, cell_color_value,
-                request.form.copy())
+        if cell_color_value == 'neural_network_classifier' and plot_type in ('Cells', 'Baseline'):
+            color_track, is_discrete = get_sca_color_track(user_id, cell_color_value)
+            if color_track is None:
+                # the classifier takes a while, so it runs as a background
+                # job; the frontend polls the job and then re-requests the plot.
+                return submit_dataset_job(user_id, 'neural_network_classifier',
+                        run_nn_classifier, [])
+        if plot_type in plot_pool.DEADLINES:
+            # CPU-heavy plots are computed in the plot process pool; this
+            # returns a 'pending' response if the plot isn't ready yet.
+            return gzip_response(plot_pool.run_plot(plot_type,
+                    scatterplot_key_args(user_id, plot_type, request.form),
+                    update_scatterplot_result,
+                    (user_id, plot_type, cell_color_value, request.form.copy())))
+        # large plot json is stored compressed in the cache, and sent to the
+        # client without decompressing it.
+        return gzip_response(update_scatterplot_result(user_id, plot_type,
+            cell_color_value, request.form.copy()))
+    except Exception as e:
+        text = traceback.format_exc()
+        print(text)
+        return 'Error: ' + str(e)
+
+def scatterplot_key_args(user_id, plot_type, data_form):
+    """
+    Returns the values identifying a scatterplot in the plot pool.
+    """
+    from .utils import dataset_version
+    return [user_id, dataset_version(user_id_to_path(user_id)), plot_type,
+            sorted(data_form.to_dict().items())]
+
+@interaction_views.route('/user/<user_id>/view/cancel_scatterplot', methods=['POST'])
+def cancel_scatterplot(user_id):
+    """
+    Cancels a scatterplot that is being computed in the plot pool. Takes the
+    same form as update_scatterplot.
+    """
+    plot_type = request.form['scatter_type']
+    if plot_type not in plot_pool.DEADLINES:
+        return 'Error: plot cannot be cancelled'
+    try:
+        if plot_pool.cancel_plot(plot_type,
+                scatterplot_key_args(user_id, plot_type, request.form)):
+            return 'Plot cancelled'
+        return 'Error: plot is not running'
     except Exception as e:
         text = traceback.format_exc()
         print(text)
         return 'Error: ' + str(e)
 
+def run_nn_classifier(progress, user_id):
+    """
+    Creates the 'neural_network_classifier' color track using the default
+    classifier in mouse_cell_query.
+    """
+    from mouse_cell_query import nn_query
+    sca = get_sca(user_id)
+    progress('running classifier', 0.0)
+    cell_names, results, class_names = nn_query.predict_using_default_classifier(sca.data.T, sca.genes)
+    sca.add_color_track('neural_network_classifier', cell_names, is_discrete=True)
+    # adding the color track changes the dataset version, so the color track
+    # handle doesn't have to be removed from the cache.
+    return 'Finished running classifier.'
+
 @cache.memoize()
+@artifact_cache.memoize
 def update_scatterplot_result(user_id, plot_type, cell_color_value, data_form):
     """
     Returns the plotly JSON representation of the scatterplot.
@@ -1082,10 +1447,10 @@ def update_scatterplot_result(user_id, plot_type, cell_color_value, data_form):
             # TODO: change colorscale so that zero=gray? mixed continuous/discrete color scale
             return scatterplot_data(dim_red, sca.labels,
                     mode='entropy', color_vals=gene_data)
-        elif cell_color_value == 'cluster':
-            return scatterplot_data(dim_red, sca.labels)
-        elif cell_color_value == 'new':
-            # this usually happens by mistake...
+        elif cell_color_value in ('cluster', 'new'):
+            # 'new' usually happens by mistake...
+            if plot_type in ('Cells', 'Baseline'):
+                return cluster_scatterplot_data(user_id, plot_type)
             return scatterplot_data(dim_red, sca.labels)
         # if the mode is 'cluster', color based on w
         elif cell_color_value == 'weights':
@@ -1102,17 +1467,10 @@ def update_scatterplot_result(user_id, plot_type, cell_color_value, data_form):
                     colorscale='Viridis',
                     mode='entropy', color_vals=read_counts)
         elif cell_color_value == 'neural_network_classifier':
-            # get NN results
+            # the color track is created by run_nn_classifier (see
+            # update_scatterplot).
             color_track, is_discrete = get_sca_color_track(user_id, cell_color_value)
-            # set cell class...
-            if color_track is None:
-                from mouse_cell_query import nn_query
-                cell_names, results, class_names = nn_query.predict_using_default_classifier(sca.data.T, sca.genes)
-                sca.add_color_track('neural_network_classifier', cell_names, is_discrete=True)
-                color_track, is_discrete = get_sca_color_track(user_id, cell_color_value)
-                return scatterplot_data(dim_red, color_track)
-            else:
-                return scatterplot_data(dim_red, color_track)
+            return scatterplot_data(dim_red, color_track)
         elif cell_color_value == 'gene_set':
             # TODO: get a gene set from cellmesh/cellmarker/go/kegg
             # TODO: more params
@@ -1132,6 +1490,55 @@ def update_scatterplot_result(user_id, plot_type, cell_color_value, data_form):
                     return scatterplot_data(dim_red, sca.labels,
                             mode='entropy', color_vals=color_track)
 
+@cache.memoize()
+@artifact_cache.memoize
+def cluster_scatterplot_data(user_id, plot_type):
+    """
+    Returns the default scatterplot of the cells, colored by cluster, for
+    plot_type 'Cells' or 'Baseline'.
+    """
+    sca = get_sca(user_id)
+    if plot_type == 'Baseline':
+        dim_red = get_sca_baseline_vis(user_id)
+    else:
+        dim_red = get_sca_dim_red(user_id)
+    return scatterplot_data(dim_red, sca.labels)
+
+def warm_up_cache(user_id, progress=None):
+    """
+    Precomputes the results needed for the first views of a dataset: the
+    data stats, the default scatterplots, the top genes for each cluster,
+    and the cluster correlation heatmap. This is run after an analysis is
+    completed, so that the first page load is as fast as the later ones.
+
+    Errors in each stage are printed and don't stop the later stages.
+    """
+    from . import data_stats
+    path = user_id_to_path(user_id)
+    def run_stage(message, fraction, func, *args):
+        if progress is not None:
+            progress(message, fraction)
+        try:
+            func(*args)
+        except Exception:
+            print(traceback.format_exc())
+    def stats():
+        # this writes the histogram json files used by the stats page; it
+        # goes first since it changes the dataset version.
+        sca = get_sca(user_id)
+        summary = data_stats.Summary(data_paths=None, gene_paths=None,
+                base_path=path, data=sca.data)
+        summary.load_plotly_json()
+    def top_genes():
+        get_sca_top_1vr(user_id)
+        get_sca_pval_1vr(user_id)
+    run_stage('data stats', 0.0, stats)
+    run_stage('Cells scatterplot', 0.2, cluster_scatterplot_data, user_id, 'Cells')
+    run_stage('Baseline scatterplot', 0.3, cluster_scatterplot_data, user_id, 'Baseline')
+    run_stage('top genes', 0.4, top_genes)
+    run_stage('cluster correlation heatmap', 0.8,
+            cluster_correlation_heatmap_data, user_id, 'cluster')
+
 @cache.memoize()
 def get_gene_data(user_id, gene_name, use_mw=False):
     """
@@ -1217,44 +1624,29 @@ def update_enrichr(user_id):
     gene_set = request.form['gene_set']
     return update_enrichr_result(user_id, top_genes, gene_set)
 
-# TODO: cache this function??? but we don't want to cache timeouts
 def update_enrichr_result(user_id, top_genes, gene_set):
-    user_list_id = 0
-    if top_genes not in interaction_views.enrichr_gene_list_ids:
-        gene_list = split_gene_names(top_genes)
-        user_list_id = enrichr_api.enrichr_add_list(gene_list)
-        if user_list_id == 'timeout':
-            return 'Error: Enrichr query timed out'
-        interaction_views.enrichr_gene_list_ids[top_genes] = user_list_id
-    else:
-        user_list_id = interaction_views.enrichr_gene_list_ids[top_genes]
-    results = []
-    if (top_genes, gene_set) in interaction_views.enrichr_results:
-        results = interaction_views.enrichr_results[(top_genes, gene_set)]
-    else:
-        try:
-            results = enrichr_api.enrichr_query(user_list_id, gene_set)
-            if results == 'timeout':
-                return 'Error: Enrichr query timed out'
-            interaction_views.enrichr_results[(top_genes, gene_set)] = results[:10]
-        except:
-            gene_list = split_gene_names(top_genes)
-            user_list_id = enrichr_api.enrichr_add_list(gene_list)
-            if user_list_id == 'timeout':
-                return 'Error: Enrichr query timed out'
-            interaction_views.enrichr_gene_list_ids[top_genes] = user_list_id
-            results = enrichr_api.enrichr_query(user_list_id, gene_set)
-            if results == 'timeout':
-                return 'Error: Enrichr query timed out'
-            interaction_views.enrichr_results[(top_genes, gene_set)] = results[:10]
-    # only take top 10 results (maybe have this value be variable?)
-    results = results[:10]
-    interaction_views.last_enrichr_results = [['gene set name',
-                                 'p-value',
-                                 'z-score',
-                                 'combined score']] + \
+    """
+    Queries Enrichr for a gene list (a string of newline-separated genes).
+    Gene list ids and results are cached in bounded LRUs shared by all
+    workers (see enrichr_client.py); timeouts and errors are not cached.
+
+    The query runs in a thread pool; if it isn't done after a few seconds,
+    this returns a 'pending' json response, and the client should repeat
+    the request.
+    """
+    from . import enrichr_client
+    gene_list = split_gene_names(top_genes)
+    status, results = enrichr_client.start_enrich(gene_list, gene_set)
+    if status == 'pending':
+        return plot_pool.pending_response('Enrichr query in progress...')
+    elif status == 'error':
+        return results
+    results = [['gene set name',
+                'p-value',
+                'z-score',
+                'combined score']] + \
             [[r[1], r[2], r[3], r[4]] for r in results]
-    return json.dumps(interaction_views.last_enrichr_results, cls=SimpleEncoder)
+    return json.dumps(results, cls=SimpleEncoder)
 
 @interaction_views.route('/user/<user_id>/view/update_cellmarker', methods=['GET', 'POST'])
 def update_cellmarker(user_id):
@@ -1268,6 +1660,7 @@ def update_cellmarker(user_id):
     return update_cellmarker_result(user_id, top_genes, test_type, cells_or_tissues, species)
 
 @cache.memoize()
+@artifact_cache.memoize
 def update_cellmarker_result(user_id, top_genes, test, cells_or_tissues, species):
     """
     Gets the CellMarker result for a set of genes.
@@ -1305,6 +1698,7 @@ def update_cellmesh(user_id):
     return update_cellmesh_result(user_id, top_genes, test_type, species)
 
 @cache.memoize()
+@artifact_cache.memoize
 def update_cellmesh_result(user_id, top_genes, test, species='human', return_json=True):
     """
     Gets the CellMesh result for a set of genes.
@@ -1395,7 +1789,7 @@ def update_go(user_id):
         fdr_threshold = float(request.form['go_fdr_threshold'])
     print('update_go:', top_genes)
     # gene_set is a string.
-    return update_go_result(top_genes, species=species, fdr_threshold=fdr_threshold)
+    return update_go_dataset_result(user_id, top_genes, species, fdr_threshold)
 
 @cache.memoize()
 def update_go_result(top_genes, species='mouse', fdr_threshold=0.2, **kwargs):
@@ -1406,6 +1800,16 @@ def update_go_result(top_genes, species='mouse', fdr_threshold=0.2, **kwargs):
         r[3] = ', '.join(r[3])
     return json.dumps(result, cls=SimpleEncoder)
 
+@cache.memoize()
+@artifact_cache.memoize
+def update_go_dataset_result(user_id, top_genes, species, fdr_threshold):
+    """
+    update_go_result for the genes of a dataset, which is also stored as a
+    dataset artifact, so that results precomputed after the analysis (see
+    precompute.precompute_enrichment) are kept with the dataset.
+    """
+    return update_go_result(top_genes, species=species, fdr_threshold=fdr_threshold)
+
 @interaction_views.route('/user/<user_id>/view/update_subtiwiki', methods=['GET', 'POST'])
 def update_subtiwiki(user_id):
     """
@@ -1453,44 +1857,283 @@ def update_kegg_result(top_genes, species='human', **kwargs):
     print('update_kegg_result:', result)
     return json.dumps(result, cls=SimpleEncoder)
 
+# cell colors that aren't groups of cells; queries use the clusters instead
+CONTINUOUS_CELL_COLORS = ['entropy', 'gene', 'weights', 'read_counts']
+
+# databases that can be queried by batch_enrichment
+BATCH_ENRICHMENT_DATABASES = ('cellmarker', 'cellmesh', 'go', 'kegg')
+# number of threads used to query the groups of a color track
+BATCH_ENRICHMENT_THREADS = 4
+
+def get_top_gene_names(user_id, color_track_name, num_genes):
+    """
+    Returns a dict mapping each label of a color track to the names of its
+    top num_genes genes (1 vs rest).
+    """
+    gene_names = get_sca_gene_names(user_id)
+    if color_track_name == 'cluster':
+        top_genes = get_sca_top_1vr(user_id)
+    else:
+        lockfile_name = os.path.join(user_id_to_path(user_id), color_track_name + '_writing_diffexp')
+        with lockfile_context(lockfile_name) as _lock:
+            top_genes, pvals = get_sca_top_genes_custom(user_id, color_track_name)
+    return {k: [str(gene_names[int(x[0])]) for x in v[:num_genes]]
+            for k, v in top_genes.items()}
+
+def enrichment_species(db, species):
+    """
+    Converts species ('human', 'mouse' or 'all') to the species argument
+    used by each database.
+    """
+    if db == 'cellmarker':
+        return {'human': 'Human', 'mouse': 'Mouse'}.get(species, 'all')
+    elif db == 'cellmesh':
+        if species == 'all':
+            return 'both'
+    elif db == 'go':
+        if species == 'all':
+            return 'mouse'
+    elif db == 'kegg':
+        if species == 'all':
+            return 'human'
+    else:
+        raise ValueError('unknown database: ' + db)
+    return species
+
+def enrichment_query(user_id, db, genes, species, test='hypergeom'):
+    """
+    Runs a single enrichment query, with the same defaults as the update_<db>
+    views. Returns a list of rows, starting with the header.
+    """
+    upper_genes = [x.strip().upper() for x in genes]
+    species = enrichment_species(db, species)
+    if db == 'cellmarker':
+        result = update_cellmarker_result(user_id, upper_genes, test, 'cells', species)
+    elif db == 'cellmesh':
+        result = update_cellmesh_result(user_id, upper_genes, test, species)
+    elif db == 'go':
+        result = update_go_result(upper_genes, species=species)
+    elif db == 'kegg':
+        result = update_kegg_result(genes, species=species)
+    return json.loads(result)
+
+@cache.memoize()
+@artifact_cache.memoize
+def batch_enrichment_table(user_id, version, color_track_name, num_genes, db, species,
+        num_results=5):
+    """
+    Queries a database with the top genes of every label of a color track.
+    Databases in gene_sets.DATABASES are tested for all labels at once with
+    the in-memory gene set matrix; other databases are queried concurrently,
+    one label at a time.
+
+    version is the dataset version, so that cached tables are not used after
+    the dataset is changed.
+
+    Returns the database's header, and a list of rows [label] + result row,
+    with the top num_results results for each label.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    top_genes = get_top_gene_names(user_id, color_track_name, num_genes)
+    labels = sorted(top_genes.keys())
+    if db in gene_sets.DATABASES:
+        matrix = gene_sets.get_gene_set_matrix(db, enrichment_species(db, species))
+        results = matrix.result_table([top_genes[label] for label in labels],
+                max_results=num_results, link=pmid_to_link)
+    else:
+        app = current_app._get_current_object()
+        def run(label):
+            with app.app_context():
+                return enrichment_query(user_id, db, top_genes[label], species)
+        with ThreadPoolExecutor(max_workers=BATCH_ENRICHMENT_THREADS) as executor:
+            results = list(executor.map(run, labels))
+    header = []
+    rows = []
+    for label, result in zip(labels, results):
+        if len(result) == 0:
+            continue
+        header = result[0]
+        for row in result[1:num_results + 1]:
+            rows.append([str(label)] + list(row))
+    return header, rows
+
+@interaction_views.route('/user/<user_id>/view/batch_enrichment', methods=['POST'])
+def batch_enrichment(user_id):
+    """
+    Runs enrichment queries for the top genes of all labels in a color track.
+
+    Form fields:
+        color_track (str, default 'cluster')
+        num_genes (int, default 20): number of top genes for each label
+        databases (str, default all): comma-separated list of databases,
+            from 'cellmarker', 'cellmesh', 'go', 'kegg'
+        species (str, default 'human'): 'human', 'mouse' or 'all'
+        num_results (int, default 5): number of results for each label
+
+    Returns:
+        json object with 'headers' (map of database to the header of its
+        result rows) and 'rows', a single table of
+        [database, label, result columns...].
+    """
+    from .utils import dataset_version
+    try:
+        color_track_name = request.form.get('color_track', 'cluster')
+        if color_track_name in CONTINUOUS_CELL_COLORS:
+            color_track_name = 'cluster'
+        num_genes = int(request.form.get('num_genes', 20))
+        num_results = int(request.form.get('num_results', 5))
+        species = request.form.get('species', 'human')
+        databases = request.form.get('databases', ','.join(BATCH_ENRICHMENT_DATABASES))
+        databases = [x.strip() for x in databases.split(',') if x.strip()]
+        for db in databases:
+            if db not in BATCH_ENRICHMENT_DATABASES:
+                return 'Error: unknown database ' + db
+        version = dataset_version(user_id_to_path(user_id))
+        headers = {}
+        rows = []
+        for db in databases:
+            header, db_rows = batch_enrichment_table(user_id, version,
+                    color_track_name, num_genes, db, species,
+                    num_results=num_results)
+            headers[db] = header
+            rows += [[db] + row for row in db_rows]
+        return json.dumps({'headers': headers, 'rows': rows}, cls=SimpleEncoder)
+    except Exception as e:
+        text = traceback.format_exc()
+        print(text)
+        return 'Error: ' + str(e)
+
+@cache.memoize()
+def get_group_means_handle(user_id, version, color_track_name):
+    """
+    Returns an array handle for the mean expression of each group of a color
+    track, an array of shape (genes, groups), with groups in the order of
+    color_track_map. All groups are computed in one sparse matrix product.
+    """
+    import hashlib
+    def group_means():
+        from scipy import sparse
+        sca = get_sca(user_id)
+        if color_track_name == 'cluster':
+            return sca.cluster_means
+        labels, is_discrete = sca.get_color_track(color_track_name)
+        color_to_index, index_to_color = color_track_map(labels)
+        indices = np.array([color_to_index[x] for x in labels])
+        counts = np.bincount(indices, minlength=len(color_to_index))
+        # (cells, groups) matrix of 1/(group size) for the cells in each group
+        weights = sparse.csr_matrix((1.0/counts[indices], (np.arange(len(indices)), indices)),
+                shape=(len(indices), len(counts)))
+        data = get_sca_data_sampled_all_genes(user_id)
+        means = weights.T.dot(data.T).T
+        if sparse.issparse(means):
+            means = means.toarray()
+        return np.asarray(means)
+    name = 'group_means_' + hashlib.sha1(color_track_name.encode()).hexdigest()[:16]
+    return get_array_handle(user_id, version, name, group_means)
+
+def get_group_means(user_id, color_track_name):
+    return load_stored_arrays(get_group_means_handle, user_id, color_track_name)
+
+def get_group_names(user_id, color_track_name):
+    """
+    Returns the names of the groups of a color track, in the order of the
+    columns of get_group_means.
+    """
+    sca = get_sca(user_id)
+    if color_track_name == 'cluster':
+        return list(range(sca.cluster_means.shape[1]))
+    labels, is_discrete = sca.get_color_track(color_track_name)
+    color_to_index, index_to_color = color_track_map(labels)
+    return [index_to_color[i] for i in range(len(index_to_color))]
+
+@cache.memoize()
+def db_query_result(user_id, version, color_track_name, group_index, db, method):
+    """
+    Searches a mouse_cell_query reference db with the mean expression of
+    one group of a color track.
+
+    version is the dataset version, so that cached results are not used
+    after the dataset is changed.
+    """
+    import mouse_cell_query
+    sca = get_sca(user_id)
+    means = get_group_means(user_id, color_track_name)[:, group_index]
+    return mouse_cell_query.search_db(means, sca.gene_names, method=method, db=db)
+
+@cache.memoize()
+@artifact_cache.memoize
+def db_query_table(user_id, version, color_track_name, db, method, num_results=5):
+    """
+    Searches a mouse_cell_query reference db with the mean expression of
+    every group of a color track, running the searches concurrently.
+
+    Returns a list of rows [group, cell type, score], with the top
+    num_results results for each group.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    group_names = get_group_names(user_id, color_track_name)
+    # the group means are computed once, before the searches
+    get_group_means(user_id, color_track_name)
+    app = current_app._get_current_object()
+    def run(index):
+        with app.app_context():
+            return db_query_result(user_id, version, color_track_name, index, db, method)
+    with ThreadPoolExecutor(max_workers=BATCH_ENRICHMENT_THREADS) as executor:
+        results = list(executor.map(run, range(len(group_names))))
+    rows = []
+    for name, result in zip(group_names, results):
+        for cell_type, score in result[:num_results]:
+            rows.append([str(name), cell_type, score])
+    return rows
+
 @interaction_views.route('/user/<user_id>/view/db_query', methods=['POST'])
 def db_query(user_id):
     """
     Queries a single cell db for cell types
     """
-    import mouse_cell_query
-    sca = get_sca(user_id)
     form_data = request.form.copy()
     db = form_data['cell_search_db']
     cell_color = form_data['cell_color']
     cell_label = form_data['cell_search_cluster']
-    means = None
+    if cell_color in CONTINUOUS_CELL_COLORS:
+        cell_color = 'cluster'
     if cell_color == 'cluster':
         cell_label = cell_label.split()[-1]
-        means = sca.cluster_means[:, int(cell_label)]
-    else:
-        try:
-            labels, is_discrete = sca.get_color_track(cell_color)
-            color_to_index, index_to_color = color_track_map(labels)
-            labels = index_to_color[int(cell_label)]
-            data = get_sca_data_sampled_all_genes(user_id)
-            data_labels = data[:, labels==cell_label]
-            means = np.array(data_labels.mean(1)).flatten()
-        except Exception as e:
-            text = traceback.format_exc()
-            print(str(e))
-            print(text)
-            means = sca.cluster_means[:, int(cell_label)]
-    # TODO: cache db query
     try:
-        results = mouse_cell_query.search_db(means, sca.gene_names, method=form_data['method'], db=db)
-        results = [('Cell type', 'Score')] + results
+        results = db_query_result(user_id, get_dataset_version(user_id),
+                cell_color, int(cell_label), db, form_data['method'])
+        results = [('Cell type', 'Score')] + list(results)
         return json.dumps(results, cls=SimpleEncoder)
     except Exception as e:
         text = traceback.format_exc()
         print(text)
         return 'Error: ' + str(e)
 
+@interaction_views.route('/user/<user_id>/view/db_query_all', methods=['POST'])
+def db_query_all(user_id):
+    """
+    Queries a single cell db with every group of a color track.
+
+    Form fields: cell_color, cell_search_db, method, num_results (default 5)
+
+    Returns a json table of [group, cell type, score] rows, starting with
+    the header.
+    """
+    try:
+        cell_color = request.form['cell_color']
+        if cell_color in CONTINUOUS_CELL_COLORS:
+            cell_color = 'cluster'
+        db = request.form['cell_search_db']
+        method = request.form['method']
+        num_results = int(request.form.get('num_results', 5))
+        rows = db_query_table(user_id, get_dataset_version(user_id),
+                cell_color, db, method, num_results=num_results)
+        return json.dumps([('Group', 'Cell type', 'Score')] + rows, cls=SimpleEncoder)
+    except Exception as e:
+        text = traceback.format_exc()
+        print(text)
+        return 'Error: ' + str(e)
+
 
 @interaction_views.route('/user/<user_id>/view/history')
 def get_history(user_id):
@@ -1527,27 +2170,15 @@ def restore_history(user_id, action_id):
         return 'Error: ' + str(e)
 
 
-@interaction_views.route('/user/<user_id>/view/split_or_merge_cluster', methods=['POST'])
-def split_or_merge_cluster(user_id):
-    if user_id.startswith('test_'):
-        return 'Error: test datasets cannot be modified. Copy the dataset if you wish to modify it.'
-    split_or_merge = request.form['split_or_merge']
-    selected_clusters = request.form['selected_clusters']
-    selected_clusters = selected_clusters.split(',')
-    selected_clusters = [int(x) for x in selected_clusters]
-    print('split_or_merge:', split_or_merge)
-    print('selected_clusters:', selected_clusters)
-    sca = get_sca(user_id)
-    selected_clusters = list(set(selected_clusters))
-    if len(selected_clusters) == 0:
-        return 'Error: no selected clusters.'
+def clear_sca_cache(user_id):
+    """
+    Clears cached results after the clusters of a dataset are changed.
+    """
     # TODO: have a more fine-grained key control. don't just clear the entire
     # cache, but clear some keys selectively from redis.
     if 'DEPLOY' in current_app.config and current_app.config['DEPLOY']:
         print('clearing cache')
-        cache.delete_memoized(get_sca_top_genes, user_id)
         cache.delete_memoized(get_sca_top_1vr, user_id)
-        cache.delete_memoized(get_sca_pvals, user_id)
         cache.delete_memoized(get_sca_pval_1vr, user_id)
         cache.delete_memoized(update_barplot_result)
         cache.delete_memoized(update_scatterplot_result)
@@ -1560,46 +2191,73 @@ def split_or_merge_cluster(user_id):
     else:
         print('clearing cache')
         cache.clear()
-    # split clusters
+
+# messages returned by a finished split_or_merge job
+SPLIT_OR_MERGE_MESSAGES = {
+        'split': 'Finished splitting selected cluster: ',
+        'merge': 'Finished merging selected clusters: ',
+        'new': 'Finished creating new cluster from selected cells: ',
+        'delete': 'Finished deleting selected cells: ',
+}
+
+def run_split_or_merge(progress, user_id, split_or_merge, selected_clusters):
+    """
+    Runs a split/merge/new/delete operation; this is run as a background job.
+    """
+    sca = get_sca(user_id)
+    generate_analysis.generate_analysis_resubmit(sca,
+            split_or_merge, selected_clusters,
+            diffexp_dir=get_diffexp_dir(user_id),
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'],
+            progress=progress)
     if split_or_merge == 'split':
-        try:
-            generate_analysis.generate_analysis_resubmit(sca,
-                    'split', selected_clusters)
-            return 'Finished splitting selected cluster: ' + str(selected_clusters[0])
-        except Exception as e:
-            text = traceback.format_exc()
-            print(text)
-            return 'Error in splitting clusters: ' + str(e)
-    # merge clusters
-    elif  split_or_merge == 'merge':
-        try:
-            generate_analysis.generate_analysis_resubmit(sca,
-                    'merge', selected_clusters)
-            return 'Finished merging selected clusters: ' + ' '.join(map(str, selected_clusters))
-        except Exception as e:
-            text = traceback.format_exc()
-            print(text)
-            return 'Error in merging clusters: ' + str(e)
-    # create new cluster from selected cells
-    elif split_or_merge == 'new':
-        try:
-            generate_analysis.generate_analysis_resubmit(sca,
-                    'new', selected_clusters)
-            return 'Finished creating new cluster from selected cells: ' + ' '.join(map(str, selected_clusters))
-        except Exception as e:
-            text = traceback.format_exc()
-            print(text)
-            return 'Error in creating new cluster: ' + str(e)
-    # delete selected cells
-    elif split_or_merge == 'delete':
-        try:
-            generate_analysis.generate_analysis_resubmit(sca,
-                    'delete', selected_clusters)
-            return 'Finished deleting selected cells: ' + ' '.join(map(str, selected_clusters))
-        except Exception as e:
-            text = traceback.format_exc()
-            print(text)
-            return 'Error in deleting cells: ' + str(e)
+        return SPLIT_OR_MERGE_MESSAGES['split'] + str(selected_clusters[0])
+    return SPLIT_OR_MERGE_MESSAGES[split_or_merge] + ' '.join(map(str, selected_clusters))
+
+@interaction_views.route('/user/<user_id>/view/split_or_merge_cluster', methods=['POST'])
+def split_or_merge_cluster(user_id):
+    """
+    Starts a split, merge, new cluster or delete operation as a background
+    job. Returns a json object containing the job_id, which can be polled
+    using job_status.
+    """
+    if user_id.startswith('test_'):
+        return 'Error: test datasets cannot be modified. Copy the dataset if you wish to modify it.'
+    split_or_merge = request.form['split_or_merge']
+    if split_or_merge not in SPLIT_OR_MERGE_MESSAGES:
+        return 'Error: unknown operation ' + split_or_merge
+    selected_clusters = request.form['selected_clusters']
+    selected_clusters = selected_clusters.split(',')
+    selected_clusters = [int(x) for x in selected_clusters]
+    print('split_or_merge:', split_or_merge)
+    print('selected_clusters:', selected_clusters)
+    selected_clusters = list(set(selected_clusters))
+    if len(selected_clusters) == 0:
+        return 'Error: no selected clusters.'
+    path = user_id_to_path(user_id)
+    clear_sca_cache(user_id)
+    # results cached while the job was running are out of date. Only one
+    # split/merge job can run at a time for each dataset.
+    def on_done(status):
+        clear_sca_cache(user_id)
+        artifact_cache.remove_old_versions(path)
+    job_id = jobs.submit(path, 'split_or_merge', run_split_or_merge,
+            args=(user_id, split_or_merge, selected_clusters),
+            on_done=on_done, key=[path, 'split_or_merge'], exclusive=True)
+    if job_id is None:
+        return 'Error: a split/merge operation is already running for this dataset.'
+    return json.dumps({'job_id': job_id})
+
+@interaction_views.route('/user/<user_id>/view/job_status/<job_id>')
+def job_status(user_id, job_id):
+    """
+    Returns the status of a background job as a json object (see
+    jobs.get_status).
+    """
+    status = jobs.get_status(user_id_to_path(user_id), job_id)
+    if status is None:
+        return 'Error: job not found'
+    return json.dumps(status)
 
 
 @interaction_views.route('/user/<user_id>/view/upload_color_track', methods=['POST'])
@@ -1756,10 +2414,13 @@ def update_colormap_label_criteria(user_id):
         print('deleting cached results...')
         cache.delete_memoized(update_barplot_result)
         cache.delete_memoized(update_scatterplot_result)
-        cache.delete_memoized(get_sca_color_track)
+        cache.delete_memoized(get_sca_color_track_handle)
         cache.delete_memoized(dendrogram_data)
         cache.delete_memoized(heatmap_data)
         cache.delete_memoized(get_sca_top_genes_custom)
+        cache.delete_memoized(get_sca_pairwise_custom)
+        cache.delete_memoized(get_sca_wilcoxon_1vr)
+        cache.delete_memoized(get_sca_wilcoxon_pair)
     else:
         sca.update_custom_color_track_label(colormap_name, label_name)
     colormap = sca.custom_selections[colormap_name]
@@ -1778,7 +2439,11 @@ def copy_dataset(user_id):
     try:
         new_user_id = str(uuid.uuid4())
         new_user_id = new_user_id + user_id[36:]
-        shutil.copytree(path, user_id_to_path(new_user_id, use_secondary=False))
+        # artifacts are keyed by user id, so they aren't copied. Jobs, diffexp
+        # results and diffexp lockfiles belong to the source dataset.
+        shutil.copytree(path, user_id_to_path(new_user_id, use_secondary=False),
+                ignore=shutil.ignore_patterns(artifact_cache.ARTIFACT_DIR,
+                    'jobs', 'diffexp', '*_writing_diffexp', '*_writing_pairwise'))
         # change user id in json files (this is a bad hack lol)
         import subprocess
         subprocess.call("sed -i 's/{0}/{1}/g' /tmp/uncurl/{1}/*.json".format(user_id, new_user_id), shell=True)
@@ -1798,68 +2463,105 @@ def delete_rerun(user_id):
         return 'Error: unable to delete test results'
     sca = get_sca(user_id)
     try:
+        from . import array_store
         # clear cache
         cache.clear()
         sca.delete_uncurl_results()
+        array_store.remove_dataset(current_app.config['ARRAY_STORE_DIR'],
+                user_id_to_path(user_id))
+        artifact_cache.remove_artifacts(user_id_to_path(user_id))
         return redirect(url_for('views.state_estimation_result', user_id=user_id))
     except Exception as e:
         text = traceback.format_exc()
         print(text)
         return 'Error: ' + str(e)
 
+def clear_labels_cache(user_id):
+    """
+    Clears cached results that depend on the cluster labels, and removes the
+    artifacts of older versions of the dataset. Run after the labels change.
+    """
+    artifact_cache.remove_old_versions(user_id_to_path(user_id))
+    cache.delete_memoized(get_sca_top_1vr, user_id)
+    cache.delete_memoized(get_sca_pval_1vr, user_id)
+    cache.delete_memoized(update_barplot_result)
+    cache.delete_memoized(update_scatterplot_result)
+    cache.delete_memoized(heatmap_data)
+    cache.delete_memoized(dendrogram_data)
+
+def dataset_job_key(version, name, params):
+    """
+    Returns the deduplication key of a dataset job (see submit_dataset_job);
+    its job id is jobs.job_id_for_key(dataset_job_key(...)).
+    """
+    return [version, name, list(params)]
+
+def submit_dataset_job(user_id, name, func, params, on_done=None):
+    """
+    Submits a background job that modifies a dataset, deduplicated on
+    (dataset version, name, params), see dataset_job_key. func is called as
+    func(progress, user_id, *params).
+
+    Returns a json object containing the job_id.
+    """
+    from .utils import dataset_version
+    path = user_id_to_path(user_id)
+    key = dataset_job_key(dataset_version(path), name, params)
+    job_id = jobs.submit(path, name, func, args=[user_id] + list(params),
+            on_done=on_done, key=key)
+    return json.dumps({'job_id': job_id})
+
+def run_relabel(progress, user_id, clustering_method):
+    sca = get_sca(user_id)
+    progress('re-clustering', 0.0)
+    sca.relabel(clustering_method)
+    return 'Finished re-clustering.'
+
 @interaction_views.route('/user/<user_id>/view/recluster', methods=['POST'])
 def recluster(user_id):
     """
     Re-clusters - re-runs the labeling method...
+
+    Runs as a background job; returns a json object containing the job_id.
     """
     print('reclustering ', user_id)
     if user_id.startswith('test_'):
         return 'Error: test datasets cannot be modified. Copy the dataset if you wish to modify it.'
-    sca = get_sca(user_id)
     data_form = request.form.copy()
     try:
-        sca.relabel(data_form['clustering_method'])
+        return submit_dataset_job(user_id, 'relabel', run_relabel,
+                [data_form['clustering_method']],
+                on_done=lambda status: clear_labels_cache(user_id))
     except Exception as e:
         text = traceback.format_exc()
         print(text)
         return 'Error: ' + str(e)
-    # clear caches?
-    cache.delete_memoized(get_sca_top_genes, user_id)
-    cache.delete_memoized(get_sca_top_1vr, user_id)
-    cache.delete_memoized(get_sca_pvals, user_id)
-    cache.delete_memoized(get_sca_pval_1vr, user_id)
-    cache.delete_memoized(update_barplot_result)
-    cache.delete_memoized(update_scatterplot_result)
-    cache.delete_memoized(heatmap_data)
-    cache.delete_memoized(dendrogram_data)
-    return 'success'
+
+def run_batch_effect_correction(progress, user_id, colormap):
+    sca = get_sca(user_id)
+    progress('running batch effect correction', 0.0)
+    sca.run_batch_effect_correction(colormap)
+    return 'Finished batch effect correction.'
 
 @interaction_views.route('/user/<user_id>/view/run_batch_correction', methods=['POST'])
 def run_batch_correction(user_id):
     """
     Runs batch effect correction on the provided color map
+
+    Runs as a background job; returns a json object containing the job_id.
     """
     # TODO
     print('run_batch_correction ', user_id)
-    sca = get_sca(user_id)
     data_form = request.form.copy()
     try:
         colormap = data_form['colormap']
-        sca.run_batch_effect_correction(colormap)
+        return submit_dataset_job(user_id, 'batch_correction',
+                run_batch_effect_correction, [colormap],
+                on_done=lambda status: clear_labels_cache(user_id))
     except Exception as e:
         text = traceback.format_exc()
         print(text)
         return 'Error: ' + str(e)
-    # clear caches
-    cache.delete_memoized(get_sca_top_genes, user_id)
-    cache.delete_memoized(get_sca_top_1vr, user_id)
-    cache.delete_memoized(get_sca_pvals, user_id)
-    cache.delete_memoized(get_sca_pval_1vr, user_id)
-    cache.delete_memoized(update_barplot_result)
-    cache.delete_memoized(update_scatterplot_result)
-    cache.delete_memoized(heatmap_data)
-    cache.delete_memoized(dendrogram_data)
-    return 'success'
 
 @interaction_views.route('/user/<user_id>/view/subset', methods=['POST'])
 def rerun_uncurl(user_id):
@@ -0,0 +1,270 @@
+# Background jobs for long-running operations on a dataset.
+#
+# The state of each job is stored as a json file in <dataset dir>/jobs/, so
+# that a job started by one web worker can be polled from any other worker.
+# Jobs run in a thread of the worker that submitted them, which records its
+# host and pid in the status and updates a heartbeat timestamp while the job
+# is queued or running. A job whose worker died (stale heartbeat, or pid no
+# longer running on this host) is reported as failed, so it can be
+# resubmitted.
+
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing.dummy import Process
+
+from flask import current_app
+
+from .cache import dataset_context
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+# seconds between heartbeats of a job
+HEARTBEAT_INTERVAL = 10
+# seconds without a heartbeat after which a queued or running job is
+# considered failed
+STALE_TIMEOUT = 60
+
+# serializes the status updates of the jobs in this process
+_lock = threading.Lock()
+
+
+def get_job_dir(path):
+    return os.path.join(path, 'jobs')
+
+
+def _job_filename(path, job_id):
+    return os.path.join(get_job_dir(path), '{0}.json'.format(job_id))
+
+
+def get_status(path, job_id):
+    """
+    Returns a dict containing the status of a job, or None if the job
+    doesn't exist.
+
+    Keys: id, name, status (one of 'queued', 'running', 'done', 'error'),
+    progress (str), fraction (float or None), result (str),
+    submitted, started, finished, heartbeat (timestamps), host, pid.
+
+    A queued or running job whose worker died is returned with status
+    'error'.
+    """
+    status = _read_status(path, job_id)
+    if status is not None and is_stale(status):
+        status['status'] = ERROR
+        status['result'] = 'Error: the job stopped responding.'
+    return status
+
+
+def _read_status(path, job_id):
+    """
+    Returns the status as it was written by the job, or None if the job
+    doesn't exist.
+    """
+    # job ids are only ever hex strings generated by submit.
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+        return None
+    filename = _job_filename(path, job_id)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # the process exists, but belongs to another user
+        pass
+    return True
+
+
+def is_stale(status):
+    """
+    Returns True if a queued or running job has no heartbeat for
+    STALE_TIMEOUT seconds, or its worker is no longer running on this host.
+    """
+    if status['status'] not in (QUEUED, RUNNING):
+        return False
+    heartbeat = status.get('heartbeat') or status.get('submitted')
+    if heartbeat is None:
+        # the status file was just created by _claim_job
+        return False
+    if time.time() - heartbeat > STALE_TIMEOUT:
+        return True
+    if status.get('host') == socket.gethostname() and status.get('pid') is not None:
+        return not _pid_exists(status['pid'])
+    return False
+
+
+def _write_status(path, job_id, status):
+    filename = _job_filename(path, job_id)
+    # write to a temporary file first, so that readers never see a partial
+    # file
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_filename, filename)
+
+
+def update_status(path, job_id, **kwargs):
+    """
+    Updates the given fields of a job's status.
+    """
+    with _lock:
+        status = _read_status(path, job_id) or {'id': job_id}
+        status.update(kwargs)
+        _write_status(path, job_id, status)
+    return status
+
+
+def _claim_job(path, job_id, exclusive=False):
+    """
+    Creates a new status for a job id, unless the job is queued or running,
+    or is done and exclusive is False. Returns True if the job was claimed.
+
+    Claims are serialized between processes by a lock on
+    <job id>.json.lock, so that two workers can't claim the same job.
+    """
+    with open(_job_filename(path, job_id) + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            status = get_status(path, job_id)
+            if status is not None and status['status'] in (QUEUED, RUNNING):
+                return False
+            if status is not None and status['status'] == DONE and not exclusive:
+                return False
+            with _lock:
+                _write_status(path, job_id, {'id': job_id, 'status': QUEUED})
+            return True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def find_jobs(path, name=None, running_only=False):
+    """
+    Returns a list of job statuses for the dataset, optionally filtered by
+    job name, sorted by submission time.
+    """
+    job_dir = get_job_dir(path)
+    if not os.path.exists(job_dir):
+        return []
+    jobs = []
+    for filename in os.listdir(job_dir):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            status = get_status(path, filename[:-len('.json')])
+        except ValueError:
+            # the file is being written
+            continue
+        if status is None:
+            continue
+        if name is not None and status.get('name') != name:
+            continue
+        if running_only and status['status'] not in (QUEUED, RUNNING):
+            continue
+        jobs.append(status)
+    jobs.sort(key=lambda x: x.get('submitted', 0))
+    return jobs
+
+
+def job_id_for_key(key):
+    """
+    Returns the job id used for a deduplication key (see submit).
+    """
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:32]
+
+
+def submit(path, name, func, args=(), kwargs=None, on_done=None, key=None,
+        exclusive=False):
+    """
+    Runs func in a background thread with the current app context, and
+    returns a job id immediately.
+
+    If key is given (a json-serializable value, e.g. a list of the dataset
+    version, the operation and its parameters), at most one job is run for
+    each key: if a job with the same key has already been submitted and did
+    not fail, its job id is returned and func is not run again.
+
+    If exclusive is True, the key only keeps jobs from running at the same
+    time (e.g. [path, 'split_or_merge'] for operations that can't run
+    concurrently on a dataset): a finished job with the same key is run
+    again, and if one is queued or running, None is returned.
+
+    func is called as func(progress, *args, **kwargs), where
+    progress(message, fraction=None) updates the job's progress. The return
+    value of func (converted to str) is stored as the job's result. If
+    on_done is given, it is called with the job's final status, whether or
+    not func succeeded.
+    """
+    if kwargs is None:
+        kwargs = {}
+    app = current_app._get_current_object()
+    try:
+        os.makedirs(get_job_dir(path))
+    except OSError:
+        pass
+    if key is None:
+        job_id = uuid.uuid4().hex
+    else:
+        job_id = job_id_for_key(key)
+        if not _claim_job(path, job_id, exclusive):
+            return None if exclusive else job_id
+    now = time.time()
+    update_status(path, job_id, name=name, status=QUEUED, progress='',
+            fraction=None, result='', submitted=now,
+            started=None, finished=None, heartbeat=now,
+            host=socket.gethostname(), pid=os.getpid())
+
+    def progress(message, fraction=None):
+        update_status(path, job_id, progress=message, fraction=fraction,
+                heartbeat=time.time())
+
+    finished = threading.Event()
+
+    def heartbeat():
+        while not finished.wait(HEARTBEAT_INTERVAL):
+            try:
+                update_status(path, job_id, heartbeat=time.time())
+            except Exception:
+                print(traceback.format_exc())
+
+    def run():
+        with app.app_context(), dataset_context(path):
+            update_status(path, job_id, status=RUNNING, started=time.time(),
+                    heartbeat=time.time())
+            heartbeat_thread = Process(target=heartbeat)
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+            try:
+                result = func(progress, *args, **kwargs)
+                status = update_status(path, job_id, status=DONE,
+                        result='' if result is None else str(result),
+                        fraction=1.0, finished=time.time())
+            except Exception as e:
+                text = traceback.format_exc()
+                print(text)
+                status = update_status(path, job_id, status=ERROR,
+                        result='Error: ' + str(e), finished=time.time())
+            finished.set()
+            if on_done is not None:
+                try:
+                    on_done(status)
+                except Exception:
+                    print(traceback.format_exc())
+    P = Process(target=run)
+    P.start()
+    return job_id
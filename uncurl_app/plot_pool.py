@@ -0,0 +1,243 @@
+# Bounded pool of worker processes for CPU-heavy plot builders
+# (dendrograms, cluster heatmaps, correlation heatmaps).
+#
+# Each plot runs in its own process, so that it can be terminated when it
+# runs past its deadline or is cancelled. The processes are started with the
+# 'forkserver' method ('spawn' where it isn't available) rather than forked
+# from the web worker, since the web worker has other threads (jobs,
+# other plots) whose locks could be held at the time of the fork. The plot
+# function and its arguments are pickled, and each process creates an app
+# with the web worker's config and cache config. At most PLOT_PROCESSES
+# plots run at the same time in each web worker; other plots wait for a free
+# slot. Results, and a marker for plots that are still being computed, are
+# stored in the shared cache, so that a plot started by one web worker can be
+# polled from any other worker.
+#
+# Plot processes are daemonic, so that they don't outlive the web worker, and
+# daemonic processes can't start processes of their own. Plot functions must
+# not use multiprocessing; the app in each plot process has DIFFEXP_PROCESSES
+# set to 1, so that diffexp runs in the plot process itself.
+
+import hashlib
+import json
+import multiprocessing
+import pickle
+import threading
+import time
+import traceback
+
+from flask import current_app
+
+from .cache import cache
+
+# deadline in seconds for each plot type
+DEADLINES = {
+        'Cluster_heatmap': 60,
+        'Dendrogram': 120,
+        'Correlation_heatmap': 120,
+        'Gene_heatmap': 60,
+        'Diffcorr_heatmap': 120,
+}
+DEFAULT_DEADLINE = 120
+
+# how long a request waits for the plot before returning a 'pending' response
+WAIT_TIME = 5
+
+# how long an error result is kept before the plot can be retried
+ERROR_TIMEOUT = 60
+
+_slots = None
+_slots_lock = threading.Lock()
+_context = None
+
+
+def _get_slots(n_processes):
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(n_processes)
+        return _slots
+
+
+def plot_key(name, *args):
+    """
+    Returns the cache key used for a plot.
+    """
+    h = hashlib.sha1(json.dumps([name] + list(args), sort_keys=True).encode())
+    return 'plot_pool_' + h.hexdigest()
+
+
+def pending_response(message='Still computing, please wait.'):
+    return json.dumps({'status': 'pending', 'message': message})
+
+
+def get_context():
+    """
+    Returns the multiprocessing context used for plot processes. The fork
+    server preloads the app's modules, so that starting a plot process
+    doesn't import them again.
+    """
+    global _context
+    with _slots_lock:
+        if _context is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                _context = multiprocessing.get_context('forkserver')
+                _context.set_forkserver_preload(['uncurl_app.interaction_views'])
+            else:
+                _context = multiprocessing.get_context('spawn')
+        return _context
+
+
+def _picklable_items(config):
+    items = {}
+    for k, v in config.items():
+        try:
+            pickle.dumps(v)
+        except Exception:
+            continue
+        items[k] = v
+    return items
+
+
+def _child_app(config, cache_config):
+    """
+    Creates an app in a plot process, with the config and cache of the web
+    worker's app. diffexp is run in a single process, since the plot process
+    can't start processes.
+    """
+    from flask import Flask
+    app = Flask('uncurl_app')
+    app.config.update(config)
+    app.config['DIFFEXP_PROCESSES'] = 1
+    if cache_config is not None:
+        cache.config = cache_config
+    cache.init_app(app)
+    return app
+
+
+def _run_child(conn, config, cache_config, func, args):
+    try:
+        app = _child_app(config, cache_config)
+        with app.app_context():
+            result = func(*args)
+        conn.send(result)
+    except Exception as e:
+        print(traceback.format_exc())
+        conn.send('Error: ' + str(e))
+    finally:
+        conn.close()
+
+
+def _run_process(key, app, func, args, deadline_time):
+    """
+    Runs func(*args) in a new process, terminating it if it runs past
+    deadline_time or the plot is cancelled. Returns the result.
+    """
+    ctx = get_context()
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_child,
+            args=(child_conn, _picklable_items(app.config),
+                getattr(cache, 'config', None), func, args))
+    process.daemon = True
+    try:
+        process.start()
+    except Exception as e:
+        # e.g. func or args can't be pickled
+        print(traceback.format_exc())
+        child_conn.close()
+        parent_conn.close()
+        return 'Error: could not start plot process: ' + str(e)
+    child_conn.close()
+    result = None
+    while result is None:
+        if parent_conn.poll(0.5):
+            try:
+                result = parent_conn.recv()
+            except EOFError:
+                result = 'Error: plot process exited unexpectedly'
+        elif not process.is_alive() and not parent_conn.poll():
+            result = 'Error: plot process exited unexpectedly'
+        elif time.time() > deadline_time:
+            result = 'Error: plot took too long to compute'
+        elif cache.get(key + '_cancel'):
+            result = 'Error: plot was cancelled'
+    if process.is_alive():
+        process.terminate()
+    process.join()
+    parent_conn.close()
+    return result
+
+
+def _run(app, key, func, args, deadline, n_processes, done):
+    slots = _get_slots(n_processes)
+    deadline_time = time.time() + deadline
+    with app.app_context():
+        # the deadline includes time spent waiting for a free process
+        if not slots.acquire(timeout=deadline):
+            result = 'Error: plot timed out while waiting for a free process'
+        else:
+            try:
+                if cache.get(key + '_cancel'):
+                    result = 'Error: plot was cancelled'
+                else:
+                    result = _run_process(key, app, func, args, deadline_time)
+            finally:
+                slots.release()
+        if result.startswith('Error'):
+            cache.set(key, result, timeout=ERROR_TIMEOUT)
+        else:
+            cache.set(key, result)
+        cache.delete(key + '_pending')
+        cache.delete(key + '_cancel')
+    done.set()
+
+
+def run_plot(name, key_args, func, args=(), deadline=None, wait=WAIT_TIME):
+    """
+    Returns the result of func(*args), a json string, computing it in the
+    process pool if it isn't cached. If the plot is not finished after wait
+    seconds, returns a 'pending' json response ({"status": "pending"}), and
+    the client should retry the same request later.
+
+    Args:
+        name (str): plot type, used to look up the deadline.
+        key_args (list): json-serializable values identifying the plot.
+        func (function): called as func(*args) in a plot process with an
+            app context. func and args must be picklable, so func must be a
+            module-level function.
+        deadline (float or None): seconds after which the plot process is
+            terminated. Defaults to DEADLINES[name].
+        wait (float): seconds to wait for the result before returning.
+    """
+    key = plot_key(name, *key_args)
+    result = cache.get(key)
+    if result is not None:
+        return result
+    if cache.get(key + '_pending'):
+        return pending_response()
+    if deadline is None:
+        deadline = DEADLINES.get(name, DEFAULT_DEADLINE)
+    cache.set(key + '_pending', time.time(), timeout=int(deadline) + 10)
+    cache.delete(key + '_cancel')
+    app = current_app._get_current_object()
+    done = threading.Event()
+    t = threading.Thread(target=_run, args=(app, key, func, args, deadline,
+        current_app.config.get('PLOT_PROCESSES', 2), done))
+    t.daemon = True
+    t.start()
+    if done.wait(wait):
+        result = cache.get(key)
+        if result is not None:
+            return result
+    return pending_response()
+
+
+def cancel_plot(name, key_args):
+    """
+    Cancels a plot that is queued or running.
+    """
+    key = plot_key(name, *key_args)
+    if cache.get(key + '_pending'):
+        cache.set(key + '_cancel', True, timeout=DEADLINES.get(name, DEFAULT_DEADLINE) + 10)
+        return True
+    return False
@@ -0,0 +1,165 @@
+# Precomputes the default views of the read-only datasets in TEST_DATA_DIR,
+# so that demo traffic is served from precomputed results.
+#
+# Usage: uncurl_app_precompute [--test-data-dir DIR] [--datasets NAME ...]
+#
+# For each dataset (a subdirectory containing params.json), this:
+#   - stores the sampled data matrix and the pairwise diffexp arrays in the
+#     array store (memory-mapped .npy files, see array_store.py), and the
+#     per-cluster statistics in the dataset's diffexp directory.
+#   - runs interaction_views.warm_up_cache (stats, default scatterplots,
+#     top genes, cluster correlation heatmap).
+#   - runs the default CellMarker, CellMeSH and GO queries for the top genes
+#     of each cluster (this also runs after each analysis in the web app, if
+#     PRECOMPUTE_ENRICHMENT is set).
+# Plots and enrichment results are stored as dataset artifacts (see
+# artifact_cache.py), which are used by the web app even after the redis
+# cache is cleared.
+
+import argparse
+import os
+import sys
+import time
+import traceback
+
+# default number of top genes per cluster, as in the view's "Number of top
+# genes" input.
+NUM_TOP_GENES = 20
+
+
+def find_datasets(test_data_dir):
+    """
+    Returns the names of all dataset directories in test_data_dir.
+    """
+    names = []
+    for name in sorted(os.listdir(test_data_dir)):
+        if os.path.exists(os.path.join(test_data_dir, name, 'params.json')):
+            names.append(name)
+    return names
+
+
+def top_gene_lists(user_id, num_genes=NUM_TOP_GENES):
+    """
+    Returns a dict of cluster id to the list of top genes (1 vs rest, upper
+    case), the same lists that the view sends to the enrichment queries by
+    default.
+    """
+    from .interaction_views import get_top_gene_names
+    top_genes = get_top_gene_names(user_id, 'cluster', num_genes)
+    return {k: [x.strip().upper() for x in v] for k, v in top_genes.items()}
+
+
+def store_arrays(user_id):
+    """
+    Stores the data matrix and diffexp arrays of a dataset in the array store.
+    """
+    from flask import current_app
+    from . import diffexp
+    from . import interaction_views as iv
+    data = iv.get_sca_data_sampled_all_genes(user_id)
+    sca = iv.get_sca(user_id)
+    diffexp.get_group_stats(data, sca.labels, cache_dir=iv.get_diffexp_dir(user_id),
+            n_jobs=current_app.config['DIFFEXP_PROCESSES'])
+    iv.get_sca_pairwise_ratios(user_id)
+
+
+def precompute_enrichment(user_id, num_genes=NUM_TOP_GENES, progress=None):
+    """
+    Runs the CellMarker, CellMeSH and GO queries for the top genes of each
+    cluster, with the default options of the view's annotation panels. The
+    results are stored as dataset artifacts, so that the panels don't run
+    the queries on the first click.
+
+    Errors in a query are printed and don't stop the other queries.
+    """
+    from .interaction_views import update_cellmarker_result, update_cellmesh_result, update_go_dataset_result
+    queries = [('CellMarker', lambda genes: update_cellmarker_result(user_id, genes, 'hypergeom', 'cells', 'all')),
+               ('CellMeSH', lambda genes: update_cellmesh_result(user_id, genes, 'prob', 'human')),
+               ('GO', lambda genes: update_go_dataset_result(user_id, genes, 'human', 0.2))]
+    top_genes = sorted(top_gene_lists(user_id, num_genes).items())
+    for i, (cluster, genes) in enumerate(top_genes):
+        if progress is not None:
+            progress('enrichment queries for cluster {0}'.format(cluster),
+                    float(i)/len(top_genes))
+        for name, query in queries:
+            try:
+                query(genes)
+            except Exception:
+                print(traceback.format_exc())
+                print('  {0}: {1} query failed for cluster {2}'.format(user_id, name, cluster))
+
+
+def precompute_dataset(user_id, enrichment=True):
+    """
+    Runs all precomputation stages for a dataset. Returns True if all stages
+    succeeded.
+    """
+    from . import artifact_cache
+    from .cache import dataset_context
+    from .interaction_views import warm_up_cache, user_id_to_path
+    ok = True
+    def progress(message, fraction=None):
+        print('  {0}: {1}'.format(user_id, message))
+    # warm_up_cache goes first, since it can write the stats files, which
+    # changes the dataset version.
+    stages = [('default views', lambda: warm_up_cache(user_id, progress)),
+              ('arrays', lambda: store_arrays(user_id))]
+    if enrichment:
+        stages.append(('enrichment', lambda: precompute_enrichment(user_id)))
+    for name, func in stages:
+        t0 = time.time()
+        try:
+            with dataset_context(user_id_to_path(user_id)):
+                func()
+            print('  {0}: {1} done in {2:.1f}s'.format(user_id, name, time.time() - t0))
+        except Exception:
+            print(traceback.format_exc())
+            print('  {0}: {1} failed'.format(user_id, name))
+            ok = False
+    # the stages can change the dataset version
+    artifact_cache.remove_old_versions(user_id_to_path(user_id))
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Precompute the default views of the datasets in TEST_DATA_DIR.')
+    parser.add_argument('--test-data-dir', default=None,
+            help='directory containing the datasets (default: TEST_DATA_DIR)')
+    parser.add_argument('--datasets', nargs='*', default=None,
+            help='names of the datasets to precompute (default: all)')
+    parser.add_argument('--no-enrichment', action='store_true',
+            help="don't run the enrichment queries")
+    parser.add_argument('--redis', action='store_true',
+            help='also store the results in the redis cache used by wsgi.py')
+    args = parser.parse_args(argv)
+
+    if args.test_data_dir is not None:
+        os.environ['TEST_DATA_DIR'] = args.test_data_dir
+    from . import create_app
+    from .cache import cache
+    app = create_app()
+    if args.redis:
+        cache.config = {'CACHE_TYPE': 'uncurl_app.cache.TwoTierRedisCache',
+                        'CACHE_REDIS_HOST': '127.0.0.1',
+                        'CACHE_REDIS_PORT': 6379,
+                        'CACHE_KEY_PREFIX': 'uncurl',
+                        'CACHE_DEFAULT_TIMEOUT': 1000}
+    else:
+        cache.config = {'CACHE_TYPE': 'simple'}
+    cache.init_app(app)
+    app.config['ARTIFACT_CACHE'] = True
+
+    test_data_dir = app.config['TEST_DATA_DIR']
+    names = args.datasets
+    if not names:
+        names = find_datasets(test_data_dir)
+    failed = []
+    with app.app_context():
+        for name in names:
+            print('precomputing {0}'.format(os.path.join(test_data_dir, name)))
+            if not precompute_dataset('test_' + name, enrichment=not args.no_enrichment):
+                failed.append(name)
+    if failed:
+        print('failed: ' + ', '.join(failed))
+        return 1
+    return 0
@@ -5,12 +5,27 @@
 # 2. list of top 50 genes per cluster using 1-vs-rest ratio
 # 3. list of top 10 cell types per cluster using prob method on cellmesh
 # 4. basic information about each cluster: num cells, mean/median read counts, mean/median gene counts
+import base64
 import json
+import os
+import time
+import uuid
 
-from flask import render_template
+import numpy as np
+from flask import render_template, current_app, request, send_file
 
-from .utils import SimpleEncoder
-from .interaction_views import interaction_views, get_sca, get_sca_gene_names, get_sca_top_1vr, scatterplot_data, update_cellmesh_result
+from . import artifact_cache
+from . import jobs
+from .cache import cache, gzip_compress
+from .utils import SimpleEncoder, dataset_version
+from .interaction_views import interaction_views, get_sca, get_sca_gene_names, get_sca_top_1vr, scatterplot_data, update_cellmesh_result, user_id_to_path, dataset_job_key, submit_dataset_job, BATCH_ENRICHMENT_THREADS
+
+# number of top genes per cluster used for the cellmesh queries
+REPORT_TOP_GENES = 50
+REPORT_COLOR_TRACK = 'Cell type report'
+# file name of the static report, in the artifact directory of each dataset
+# version
+STATIC_REPORT_FILENAME = 'report.html'
 
 @interaction_views.route('/user/<user_id>/report_preview')
 def report_preview(user_id):
@@ -20,43 +35,201 @@ def report_preview(user_id):
     # TODO
     # also include heatmap in report? show heatmap of clusters, with labels attached to...
 
-@interaction_views.route('/user/<user_id>/report')
-def generate_report(user_id):
+def cluster_read_stats(labels, read_counts):
     """
-    Returns a rendered template for a report identifying the cell types
-    for each cluster.
+    Returns the cluster ids, and the number of cells and mean read count of
+    each cluster, computed in one pass over the cells.
     """
+    cluster_ids, inverse = np.unique(labels, return_inverse=True)
+    cell_counts = np.bincount(inverse)
+    read_sums = np.bincount(inverse, weights=read_counts)
+    return cluster_ids, cell_counts, read_sums/cell_counts
+
+@cache.memoize()
+@artifact_cache.memoize
+def report_data(user_id, version):
+    """
+    Computes the data for the cell type report: the top genes, number of
+    cells, mean read count and cellmesh results ('prob' method) of each
+    cluster. The cellmesh queries for all clusters run concurrently.
+
+    version is the dataset version, so that cached reports are not used after
+    the dataset is changed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
     sca = get_sca(user_id)
     top_genes = get_sca_top_1vr(user_id)
     gene_names = get_sca_gene_names(user_id)
-    cellmesh_results_clusters = {}
-    cluster_top_genes = {}
+    read_counts = sca.read_counts[sca.cell_subset][sca.cell_sample]
+    cluster_ids, cell_counts, mean_reads = cluster_read_stats(sca.labels, read_counts)
     cluster_cell_counts = {}
     cluster_mean_reads = {}
-    # scatterplot data
-    # for each cluster
+    for cluster_id, count, mean in zip(cluster_ids, cell_counts, mean_reads):
+        cluster_cell_counts[int(cluster_id)] = int(count)
+        cluster_mean_reads[int(cluster_id)] = float(mean)
+    cluster_top_genes = {}
     for cluster_id in top_genes.keys():
-        # TODO: barplot?
-        cluster_cells = (sca.labels == cluster_id)
-        cluster_cell_counts[cluster_id] = cluster_cells.sum()
-        cluster_mean_reads[cluster_id] = sca.read_counts[sca.cell_subset][sca.cell_sample][cluster_cells].mean()
-        top_50_genes = top_genes[cluster_id][:50]
-        selected_gene_names = [gene_names[x[0]].strip().upper() for x in top_50_genes]
-        cluster_top_genes[cluster_id] = selected_gene_names
-        # do a cellmesh query
-        cellmesh_results = update_cellmesh_result(user_id, selected_gene_names, 'prob', return_json=False)
-        cellmesh_results_clusters[cluster_id] = cellmesh_results
-    import numpy as np
-    new_labels = np.array([str(x) + ' ' +  cellmesh_results_clusters[x][1][1] for x in sca.labels])
-    # add labels as colormap
-    sca.add_color_track('Cell type report', new_labels, is_discrete=True)
+        top_50_genes = top_genes[cluster_id][:REPORT_TOP_GENES]
+        cluster_top_genes[cluster_id] = [gene_names[x[0]].strip().upper() for x in top_50_genes]
+    app = current_app._get_current_object()
+    def run(cluster_id):
+        with app.app_context():
+            return update_cellmesh_result(user_id, cluster_top_genes[cluster_id], 'prob', return_json=False)
+    query_ids = sorted(top_genes.keys())
+    with ThreadPoolExecutor(max_workers=BATCH_ENRICHMENT_THREADS) as executor:
+        results = list(executor.map(run, query_ids))
+    return {
+            'cluster_ids': query_ids,
+            'top_genes': cluster_top_genes,
+            'cell_counts': cluster_cell_counts,
+            'mean_reads': cluster_mean_reads,
+            'results': dict(zip(query_ids, results)),
+    }
+
+def report_labels(labels, results):
+    """
+    Returns the label of each cell in the report: the cluster id and the
+    top cell type of its cluster.
+    """
+    return np.array([str(x) + ' ' + results[x][1][1] for x in labels])
+
+def get_static_report_filename(path, version):
+    return os.path.join(artifact_cache.get_artifact_dir(path, version), STATIC_REPORT_FILENAME)
+
+def export_static_report(user_id, version):
+    """
+    Writes the report as a single static HTML file (with plotly and the
+    gzipped report data inlined) to the dataset's artifact directory for
+    this version, along with a gzipped copy. Does nothing if the file
+    already exists.
+
+    Returns the file name.
+    """
+    path = user_id_to_path(user_id)
+    filename = get_static_report_filename(path, version)
+    if os.path.exists(filename):
+        return filename
+    data = report_data(user_id, version)
+    sca = get_sca(user_id)
+    new_labels = report_labels(sca.labels, data['results'])
+    report = dict(data)
+    report['scatterplot'] = json.loads(scatterplot_data(sca.baseline_vis, new_labels))
+    report = json.dumps(report, cls=SimpleEncoder).encode('utf-8')
+    with open(os.path.join(current_app.static_folder, 'plotly-latest.min.js')) as f:
+        plotly_js = f.read()
+    html = render_template('report_static.html', user_id=user_id,
+            data=base64.b64encode(gzip_compress(report, 9)).decode('ascii'),
+            plotly_js=plotly_js).encode('utf-8')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # the gzipped copy is written first, since the html file marks the
+    # export as done.
+    for name, contents in [(filename + '.gz', gzip_compress(html, 9)), (filename, html)]:
+        tmp_filename = name + '.tmp' + uuid.uuid4().hex
+        with open(tmp_filename, 'wb') as f:
+            f.write(contents)
+        os.replace(tmp_filename, name)
+    return filename
+
+def run_report(progress, user_id, version):
+    progress('running cell type queries', 0.0)
+    data = report_data(user_id, version)
+    sca = get_sca(user_id)
+    add_report_color_track(sca, report_labels(sca.labels, data['results']))
+    # adding the color track can change the dataset version
+    new_version = dataset_version(user_id_to_path(user_id))
+    if new_version != version:
+        rekey_report(user_id, version, new_version, data)
+    progress('exporting static report', 0.9)
+    export_static_report(user_id, new_version)
+    return 'Finished generating report.'
+
+def rekey_report(user_id, version, new_version, data):
+    """
+    Stores the report data computed for version under new_version, the
+    dataset version after the report's color track was added, and marks the
+    report job for new_version as done. The color track doesn't change the
+    report, so this keeps the report from being computed again for the new
+    version.
+    """
+    path = user_id_to_path(user_id)
+    key = artifact_cache.artifact_key(report_data.__name__, (user_id, new_version), {})
+    artifact_cache.store(path, new_version, key, data)
+    job_id = jobs.job_id_for_key(dataset_job_key(new_version, 'report', [new_version]))
+    jobs.update_status(path, job_id, name='report', status=jobs.DONE,
+            progress='', fraction=1.0, result='Finished generating report.',
+            submitted=time.time(), started=None, finished=time.time())
+
+def start_report_job(user_id, version):
+    """
+    Returns the report job for a dataset version if it is done, or submits
+    it (if it isn't already running) and returns a page that polls it.
+    """
+    path = user_id_to_path(user_id)
+    job_id = jobs.job_id_for_key(dataset_job_key(version, 'report', [version]))
+    status = jobs.get_status(path, job_id)
+    if status is not None and status['status'] == jobs.DONE:
+        return None
+    job_id = json.loads(submit_dataset_job(user_id, 'report', run_report, [version]))['job_id']
+    return render_template('report_pending.html', user_id=user_id, job_id=job_id)
+
+@interaction_views.route('/user/<user_id>/report.html')
+def static_report(user_id):
+    """
+    Returns the exported static report for the current dataset version. The
+    file is sent as-is (gzipped if the client accepts gzip), without loading
+    the analysis.
+    """
+    path = user_id_to_path(user_id)
+    version = dataset_version(path)
+    filename = get_static_report_filename(path, version)
+    if not os.path.exists(filename):
+        pending = start_report_job(user_id, version)
+        if pending is not None:
+            return pending
+        # the report job for this version is done, but the file was removed
+        filename = export_static_report(user_id, version)
+    if request.accept_encodings['gzip'] > 0 and os.path.exists(filename + '.gz'):
+        response = send_file(filename + '.gz', mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    return send_file(filename, mimetype='text/html')
+
+def add_report_color_track(sca, new_labels):
+    """
+    Adds the report's cell type labels as a color track, unless the track
+    already has these labels (adding a color track changes the dataset
+    version, see rekey_report).
+    """
+    if REPORT_COLOR_TRACK in sca.get_color_track_names():
+        labels, is_discrete = sca.get_color_track(REPORT_COLOR_TRACK)
+        if len(labels) == len(new_labels) and (np.asarray(labels) == new_labels).all():
+            return
+    sca.add_color_track(REPORT_COLOR_TRACK, new_labels, is_discrete=True)
+
+@interaction_views.route('/user/<user_id>/report')
+def generate_report(user_id):
+    """
+    Returns a rendered template for a report identifying the cell types
+    for each cluster.
+
+    The report is computed in a background job; until it is done, this
+    returns a page that polls the job and reloads.
+    """
+    version = dataset_version(user_id_to_path(user_id))
+    pending = start_report_job(user_id, version)
+    if pending is not None:
+        return pending
+    data = report_data(user_id, version)
+    sca = get_sca(user_id)
+    results = data['results']
+    new_labels = report_labels(sca.labels, results)
     scatterplot = scatterplot_data(sca.baseline_vis, new_labels)
     return render_template('report.html',
             user_id=user_id,
-            results=cellmesh_results_clusters, #json.dumps(cellmesh_results_clusters, cls=SimpleEncoder),
-            top_genes=cluster_top_genes,
-            mean_reads=cluster_mean_reads,
-            cell_counts=cluster_cell_counts,
+            results=results, #json.dumps(cellmesh_results_clusters, cls=SimpleEncoder),
+            top_genes=data['top_genes'],
+            mean_reads=data['mean_reads'],
+            cell_counts=data['cell_counts'],
             scatterplot=scatterplot,
-            cluster_ids=sorted(top_genes.keys()))
-
+            cluster_ids=data['cluster_ids'])
@@ -76,6 +76,7 @@ function update_barplot(cluster_number) {
                "cell_color": cell_color,
                "cluster1": cluster1,
                "cluster2": cluster2,
+               "diffexp_test": $("#diffexp-test").val(),
                "selected_gene": selected_gene};
     if (top_or_bulk == 'double_pairs_comparison') {
         data['cluster1'] = $('#double_pair_cluster_1').val();
@@ -255,6 +256,9 @@ function toggle_scatterplot_type() {
     }
 }
 
+// scatterplot that is still being computed on the server: {key, data}
+var pending_scatterplot = null;
+
 // this function is called on startup, and whenever the radio buttons
 // corresponding to different input types are clicked.
 function update_scatterplot() {
@@ -298,6 +302,14 @@ function update_scatterplot() {
     $("#update-area").empty();
     $("#update-area").append('Updating scatterplot <img src="/static/ajax-loader.gif"/>');
     var key = JSON.stringify(upload_data);
+    // cancel a plot that is still being computed, if it's not the same plot
+    if (pending_scatterplot != null && pending_scatterplot.key != key) {
+        $.ajax({url: window.location.pathname + "/cancel_scatterplot",
+            type: "POST",
+            data: pending_scatterplot.data,
+        });
+        pending_scatterplot = null;
+    }
     // if the plot parameters have been used before, we retrieve them from the cache...
     if (cache.scatterplots.hasOwnProperty(key)) {
         var data = cache.scatterplots[key];
@@ -322,6 +334,35 @@ function update_scatterplot() {
             return false;
         }
         data = JSON.parse(data);
+        if (data.status == 'pending') {
+            // the plot is still being computed - retry the same request,
+            // unless another plot has been requested in the meantime.
+            pending_scatterplot = {'key': key, 'data': upload_data};
+            $("#update-area").empty();
+            $("#update-area").append(data.message + ' <img src="/static/ajax-loader.gif"/>');
+            setTimeout(function() {
+                if (pending_scatterplot != null && pending_scatterplot.key == key) {
+                    pending_scatterplot = null;
+                    update_scatterplot();
+                }
+            }, 3000);
+            return true;
+        }
+        if (data.hasOwnProperty('job_id')) {
+            // the color track is being computed in the background
+            poll_job(data.job_id, function(status) {
+                $("#update-area").empty();
+                $("#update-area").append('Updating scatterplot: ' + status.progress + ' <img src="/static/ajax-loader.gif"/>');
+            }, function(status) {
+                if (status.status == 'done') {
+                    update_scatterplot();
+                } else {
+                    $("#update-area").empty();
+                    $("#update-area").append(status.result);
+                }
+            });
+            return true;
+        }
         cache.scatterplots[key] = data;
         Plotly.newPlot("means-scatter-plot", data.data, data.layout, config={showSendToCloud:true});
         current_scatterplot_data = data;
@@ -399,19 +440,29 @@ function update_gene_query(query) {
     var update_url = '/update_' + query;
     results_view.empty();
     results_view.append("<br>" + "Query in progress..." + '<img src="/static/ajax-loader.gif"/>');
-    $.ajax({url: window.location.pathname + update_url,
-        type: "POST",
-        data: data,
-    }).done(function(results) {
-        results_view.empty();
-        if (results.startsWith('Error')) {
-            results_view.append(results);
-        } else {
+    var send_query = function() {
+        $.ajax({url: window.location.pathname + update_url,
+            type: "POST",
+            data: data,
+        }).done(function(results) {
+            if (results.startsWith('Error')) {
+                results_view.empty();
+                results_view.append(results);
+                return;
+            }
             results = JSON.parse(results);
+            if (results.status == 'pending') {
+                // the query is still running on the server (e.g. Enrichr);
+                // repeat the request until the results are ready.
+                setTimeout(send_query, 3000);
+                return;
+            }
+            results_view.empty();
             cache.enrichr[key] = results;
             set_enrichr_results(results, query);
-        }
-    });
+        });
+    };
+    send_query();
     return true;
 }
 
@@ -555,22 +606,98 @@ function split_or_merge_cluster(split_or_merge, cells_or_clusters) {
                'selected_clusters': selected_clusters.join(',')},
         method: 'POST',
     }).done(function(data) {
-        currently_merging = false;
-        $('.overlay').hide();
         if (data.startsWith('Error')) {
+            currently_merging = false;
+            $('.overlay').hide();
             $('#update-area').empty();
             $('#update-area').append(data);
-        } else {
+            return false;
+        }
+        var job_id = JSON.parse(data).job_id;
+        poll_job(job_id, function(status) {
+            $('#update-area').empty();
+            $('#update-area').append(split_or_merge + " clusters in progress: " + status.progress + ' <img src="/static/ajax-loader.gif"/>');
+        }, function(status) {
+            currently_merging = false;
+            $('.overlay').hide();
             $('#update-area').empty();
+            $('#update-area').append(status.result);
+            if (status.status == 'done') {
+                // reload page?
+                cache.barplots = {};
+                cache.scatterplots = {};
+                update_scatterplot();
+                update_barplot(0);
+                //location.reload(true);
+                get_history();
+            }
+        });
+    });
+}
+
+// polls a background job until it is finished.
+// on_progress and on_done are called with the job status.
+function poll_job(job_id, on_progress, on_done, interval) {
+    if (interval == undefined) {
+        interval = 2000;
+    }
+    $.ajax({url: window.location.pathname + "/job_status/" + job_id,
+        method: 'GET',
+    }).done(function(data) {
+        if (data.startsWith('Error')) {
+            on_done({'status': 'error', 'result': data});
+            return false;
+        }
+        var status = JSON.parse(data);
+        if (status.status == 'done' || status.status == 'error') {
+            on_done(status);
+        } else {
+            on_progress(status);
+            setTimeout(function() {
+                poll_job(job_id, on_progress, on_done, interval);
+            }, interval);
+        }
+    });
+}
+
+// cell selections used for ad-hoc differential expression
+var diffexp_selections = {1: [], 2: []};
+
+function set_diffexp_selection(i) {
+    diffexp_selections[i] = current_selected_cells.slice();
+    $('#update-area').empty();
+    $('#update-area').append('Selection ' + String(i) + ': ' + String(diffexp_selections[i].length) + ' cells');
+}
+
+// shows the top differentially expressed genes between the two selections
+function compare_selections() {
+    if (diffexp_selections[1].length == 0 || diffexp_selections[2].length == 0) {
+        window.alert('Warning: both selections must contain cells.');
+        return false;
+    }
+    var top_or_bulk = $("#top-or-bulk").val();
+    $('#update-area').empty();
+    $("#update-area").append('Comparing selections <img src="/static/ajax-loader.gif"/>');
+    $.ajax({url: window.location.pathname + "/selection_diffexp",
+        data: {'selection_1': diffexp_selections[1].join(','),
+               'selection_2': diffexp_selections[2].join(','),
+               'num_genes': $("#num-genes").val(),
+               'mode': top_or_bulk.startsWith('pval') ? 'pval' : 'top'},
+        method: 'POST',
+    }).done(function(data) {
+        $('#update-area').empty();
+        if (data.startsWith('Error')) {
             $('#update-area').append(data);
-            // reload page?
-            cache.barplots = {};
-            cache.scatterplots = {};
-            update_scatterplot();
-            update_barplot(0);
-            //location.reload(true);
-            get_history();
+            return false;
         }
+        data = JSON.parse(data);
+        var gene_names = data.data[0].y;
+        $('#top-genes-view').val(gene_names.join('\n'));
+        data.data[0].x.reverse();
+        data.data[0].y.reverse();
+        current_barplot_data = data;
+        Plotly.newPlot("top-genes", data.data, data.layout, config={showSendToCloud: true});
+        $("#update-area").append('Barplot updated');
     });
 }
 
@@ -596,21 +723,29 @@ function run_batch_correction() {
         method: 'POST',
         data: {'colormap': cell_color,},
     }).done(function(data) {
-        $('.overlay').hide();
         if (data.startsWith('Error')) {
+            $('.overlay').hide();
             $('#update-area').empty();
             $('#update-area').append(data);
-        } else {
-            $('#update-area').empty();
-            $('#update-area').append(data);
-            // reload page?
-            cache.barplots = {};
-            cache.scatterplots = {};
-            update_scatterplot();
-            update_barplot(0);
-            //location.reload(true);
-            get_history();
+            return false;
         }
+        poll_job(JSON.parse(data).job_id, function(status) {
+            $('#update-area').empty();
+            $('#update-area').append('Batch effect correction in progress: ' + status.progress + ' <img src="/static/ajax-loader.gif"/>');
+        }, function(status) {
+            $('.overlay').hide();
+            $('#update-area').empty();
+            $('#update-area').append(status.result);
+            if (status.status == 'done') {
+                // reload page?
+                cache.barplots = {};
+                cache.scatterplots = {};
+                update_scatterplot();
+                update_barplot(0);
+                //location.reload(true);
+                get_history();
+            }
+        });
     });
 }
 
@@ -712,19 +847,24 @@ function rerun_clustering() {
         },
         method: 'POST'
     }).done(function(data) {
-        $('.overlay').hide();
         if (data.startsWith('Error')) {
+            $('.overlay').hide();
             $('#update-area').empty();
             $('#update-area').append(data);
-        } else {
-            var new_user_id = data;
-            $('#update-area').empty();
-            $('#update-area').append('Finished re-clustering.');
-            // clear cache
-            cache.barplots = {};
-            cache.scatterplots = {};
-            update_scatterplot();
+            return false;
         }
+        poll_job(JSON.parse(data).job_id, function(status) {
+        }, function(status) {
+            $('.overlay').hide();
+            $('#update-area').empty();
+            $('#update-area').append(status.result);
+            if (status.status == 'done') {
+                // clear cache
+                cache.barplots = {};
+                cache.scatterplots = {};
+                update_scatterplot();
+            }
+        });
     });
 }
 
@@ -755,6 +895,31 @@ function submit_db_query() {
     });
 }
 
+// runs the cell search query for all groups of the current cell color
+function submit_db_query_all() {
+    var form_data = $('#cell_search_form').serializeArray();
+    var data = {};
+    $(form_data).each(function(index, obj){
+        data[obj.name] = obj.value;
+    });
+    data['cell_color'] = $('#cell-color').val();
+    $("#update-area").empty();
+    $('#update-area').append('Cell search query <img src="/static/ajax-loader.gif"/>');
+    $.ajax({url: window.location.pathname + '/db_query_all',
+        data: data,
+        method: 'POST'
+    }).done(function(data) {
+        $("#update-area").empty();
+        if (data.startsWith('Error')) {
+            $("#update-area").append(data);
+            return false;
+        }
+        $('#update-area').append('Completed cell search query');
+        var results = JSON.parse(data);
+        set_enrichr_results(results, 'cell_search');
+    });
+}
+
 // called whenever cell color is changed.
 function on_cell_color_change() {
     var cell_color = $("#cell-color").val();
@@ -1,4 +1,6 @@
+import hashlib
 import json
+import os
 
 import numpy as np
 
@@ -31,3 +33,27 @@ def get_matrix_header(filename):
             rows = int(line[1])
             cols = int(line[2])
         return entries, rows, cols
+
+
+# files in a dataset directory that don't change its contents
+UNVERSIONED_SUFFIXES = ('_writing_diffexp', '_writing_pairwise', '.tmp', 'submitted')
+
+
+def dataset_version(path):
+    """
+    Returns a short string identifying the current state of a dataset
+    directory, based on the names, sizes and modification times of the
+    files in it (not including subdirectories). The version changes whenever
+    the analysis is modified, e.g. by reclustering or adding a color track.
+    """
+    h = hashlib.sha1()
+    try:
+        entries = sorted(os.scandir(path), key=lambda x: x.name)
+    except OSError:
+        return ''
+    for entry in entries:
+        if entry.name.endswith(UNVERSIONED_SUFFIXES) or not entry.is_file():
+            continue
+        stat = entry.stat()
+        h.update('{0}:{1}:{2}\n'.format(entry.name, stat.st_size, stat.st_mtime_ns).encode())
+    return h.hexdigest()[:16]
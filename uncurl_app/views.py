@@ -170,7 +170,8 @@ def state_estimation_start(user_id):
     # params.json contains all input parameters to the state estimation, as well as all stats from preprocess.json.
     with open(os.path.join(path, 'params.json'), 'w') as f:
         json.dump(preprocess, f)
-    P = Process(target=state_estimation_thread, args=(user_id, gene_names_file, init_path, path, preprocess, current_app.config.copy()))
+    P = Process(target=state_estimation_thread, args=(user_id, gene_names_file, init_path, path, preprocess, current_app.config.copy(),
+        current_app._get_current_object()))
     P.start()
     return redirect(url_for('views.state_estimation_result', user_id=user_id))
 
@@ -320,7 +321,7 @@ def state_estimation_preproc_simple(user_id, base_path, data_path):
 
 
 
-def state_estimation_thread(user_id, gene_names=None, init_path=None, path=None, preprocess=None, config=None):
+def state_estimation_thread(user_id, gene_names=None, init_path=None, path=None, preprocess=None, config=None, app=None):
     """
     Uses a new process to do state estimation. Assumes that the input data is already saved in a directory named /tmp/uncurl/<user_id>/.
 
@@ -331,6 +332,7 @@ def state_estimation_thread(user_id, gene_names=None, init_path=None, path=None,
         path (str, optional): Path where data and results are saved.
         preprocess (dict): dict containing additional parameters: min_reads, max_reads, normalize, is_sparse, is_gz, disttype, genes_frac, cell_frac, vismethod, baseline_vismethod
         config (dict): current_app.config
+        app (Flask app, optional): if given, the cache is warmed up for the default views after the analysis is done (see interaction_views.warm_up_cache), and if config['PRECOMPUTE_ENRICHMENT'] is set, the enrichment queries for each cluster are precomputed (see precompute.precompute_enrichment).
     """
     if path is None:
         path = os.path.join(config['USER_DATA_DIR'], user_id)
@@ -364,8 +366,22 @@ def state_estimation_thread(user_id, gene_names=None, init_path=None, path=None,
     if init_path is not None:
         pass
     # params.json is saved in path, so it does not need to be passed.
-    generate_uncurl_analysis(data, path,
+    result = generate_uncurl_analysis(data, path,
+            diffexp_n_jobs=config['DIFFEXP_PROCESSES'],
             **uncurl_args)
+    if app is not None and result is None:
+        # precompute the default views
+        from .cache import dataset_context
+        from .interaction_views import warm_up_cache
+        with app.app_context(), dataset_context(path):
+            warm_up_cache(user_id)
+            if config.get('PRECOMPUTE_ENRICHMENT', False):
+                from .precompute import precompute_enrichment
+                try:
+                    precompute_enrichment(user_id)
+                except Exception:
+                    import traceback
+                    print(traceback.format_exc())
 
 
 @views.route('/qual2quant')
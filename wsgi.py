@@ -5,11 +5,15 @@ app = create_app()
 
 app.config['DEPLOY'] = True
 
-cache.config = {'CACHE_TYPE': 'redis',
+# redis, with an in-process cache of large values in each worker;
+# large values are stored compressed
+cache.config = {'CACHE_TYPE': 'uncurl_app.cache.TwoTierRedisCache',
                 'CACHE_REDIS_HOST': '127.0.0.1',
                 'CACHE_REDIS_PORT': 6379,
                 'CACHE_KEY_PREFIX': 'uncurl',
-                'CACHE_DEFAULT_TIMEOUT': 1000,}
+                'CACHE_DEFAULT_TIMEOUT': 1000,
+                'CACHE_L1_MAX_BYTES': 256*1024*1024,
+                'CACHE_COMPRESS_MIN_BYTES': 32*1024,}
 cache.init_app(app)
 
 if __name__ == '__main__':